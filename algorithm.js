@@ -6,6 +6,16 @@ const activeEventTypes=new Map();
 
 let updateDisplayTimeout=null;
 
+// Layout pushed by the server (/api/v1/subscribe?layout=1). Once the first
+// message arrives the server owns active/recent and the local state machine
+// below only runs if the proxy does not offer it.
+let serverLayout=false;
+let layoutVersion=0;
+// Bumped by every on-connect full layout, to discard older /layout.json fetches
+let layoutEpoch=0;
+let layoutTiles={};
+const serverRecentShown=[];
+
 // Used to keep Recent_Shown stable when the number of active cameras changes.
 // When the shown count shrinks (e.g., 12 -> 8), we rotate the *previously shown*
 // list so previousReplacement becomes the first visible item, then take N.
@@ -19,6 +29,7 @@ function rotateToStart(arr,startValue){
 }
 
 function getRecentShown(){
+    if(serverLayout)return serverRecentShown.slice();
     const activeCount=active.length;
     let countToShow=16;
     if(activeCount===1)countToShow=12;
@@ -31,7 +42,7 @@ function getRecentShown(){
     
     // If we don't have enough cameras, supplement with missing non-active cameras
     if(recentNonActive.length<countToShow){
-        const allCameras=Array.from({length:26},(_,i)=>i+1);
+        const allCameras=workingCameras.slice();
         const nonActive=allCameras.filter(c=>!active.includes(c)&&!recent.includes(c));
         // Add missing cameras at the end (they're less recent)
         recentNonActive.push(...nonActive);
@@ -66,6 +77,45 @@ function getActiveShown(){
     return active;
 }
 
+// Apply a layout message: {v, tiles:{a0..a3:[cam,eventType,priority]|null, r0..r15:cam|null}, full}
+// The full message sent on (re)connect is always taken, even with a lower
+// version (a restarted proxy counts from 0); only a /layout.json response
+// that arrives after newer changes, or after a reconnect, is dropped as stale
+function applyLayout(message,fetchedEpoch){
+    if(fetchedEpoch!==undefined&&(fetchedEpoch!==layoutEpoch||message.v<layoutVersion))return;
+    if(!message.full&&message.v!==layoutVersion+1){
+        // Missed a change; start again from the full layout
+        const epoch=layoutEpoch;
+        fetch('/layout.json')
+            .then(response=>response.json())
+            .then(full=>applyLayout({...full,full:true},epoch))
+            .catch(()=>{});
+        return;
+    }
+    if(message.full&&fetchedEpoch===undefined)layoutEpoch++;
+    if(message.full)layoutTiles={};
+    Object.assign(layoutTiles,message.tiles);
+    layoutVersion=message.v;
+    serverLayout=true;
+    
+    active.length=0;
+    activeEventTypes.clear();
+    for(let slot=0;slot<4;slot++){
+        const tile=layoutTiles[`a${slot}`];
+        if(!tile)continue;
+        const [camNum,eventType,priority]=tile;
+        active.push(camNum);
+        activeEventTypes.set(camNum,eventType);
+        priorityMap.set(`${camNum}-${eventType}`,priority);
+    }
+    serverRecentShown.length=0;
+    for(let tile=0;tile<16;tile++){
+        const camNum=layoutTiles[`r${tile}`];
+        if(camNum)serverRecentShown.push(camNum);
+    }
+    updateDisplay();
+}
+
 function onCameraActivate(camNum,eventType){
     const idx=recent.indexOf(camNum);
     if(idx!==-1)recent.splice(idx,1);
@@ -81,7 +131,7 @@ function onCameraActivate(camNum,eventType){
     activeQueue.set(camNum,timeoutId);
     
     // Ensure recent contains all non-active cameras (should be automatic, but double-check)
-    const allCameras=Array.from({length:26},(_,i)=>i+1);
+    const allCameras=workingCameras.slice();
     const nonActive=allCameras.filter(c=>!active.includes(c));
     const missing=nonActive.filter(c=>!recent.includes(c));
     // Add missing cameras at the end (they're the least recent)
@@ -167,7 +217,7 @@ function onCameraDeactivate(camNum){
     }
     
     // Ensure recent contains all non-active cameras
-    const allCameras=Array.from({length:26},(_,i)=>i+1);
+    const allCameras=workingCameras.slice();
     const nonActive=allCameras.filter(c=>!active.includes(c));
     const missing=nonActive.filter(c=>!recent.includes(c));
     // Add missing cameras at the end (they're the least recent)
@@ -360,6 +410,7 @@ function updateDisplay(){
         // Filter recentShown to exclude active cameras (in case there's overlap)
         const activeSet = new Set(activeShown);
         const recentToShow = recentShown.filter(cam => !activeSet.has(cam));
+        reportLayout(activeShown, recentToShow);
         
         const usedBackgroundElements = new Set();
         
@@ -405,7 +456,7 @@ function updateDisplay(){
             mediaElement.style.gridRow = '';
             mediaElement.style.display = '';
             // setImageSource may replace img with video, update reference
-            mediaElement = setImageSource(mediaElement, camNum);
+            mediaElement = previewsEnabled ? setPreviewSource(mediaElement, camNum) : setImageSource(mediaElement, camNum);
         }
         
         // Hide unused background elements
@@ -0,0 +1,590 @@
+#!/usr/bin/env python3
+"""
+asyncio server mode for the camera proxy
+Serves static files, /Images/, /video*, /mpegts/* and /api/v1/subscribe on
+every configured port from a single event loop instead of one OS thread per
+connection. Camera ingests stay on one thread per camera (shared by all
+viewers, as does the single SSE upstream in sse_hub); clients are woken from
+those threads via call_soon_threadsafe.
+"""
+
+import json
+import asyncio
+import logging
+import urllib.parse
+from http import HTTPStatus
+
+import mpegts_stream
+import mjpeg_stream
+import camera_pool
+import clips
+import egress
+import ffmpeg_supervisor
+import health
+import layout
+import logs
+import metrics
+import topology
+import preview
+import quality
+import sse_hub
+import priorities
+import static_assets
+import workers
+
+logger = logging.getLogger(__name__)
+
+CORS_HEADERS = [
+    ('Access-Control-Allow-Origin', '*'),
+    ('Access-Control-Allow-Methods', 'GET, POST, OPTIONS'),
+    ('Access-Control-Allow-Headers', 'Content-Type'),
+]
+
+# Read size for large files that cannot go through sendfile
+SENDFILE_CHUNK = 256 * 1024
+
+NO_CACHE_HEADERS = [
+    ('Cache-Control', 'no-cache, no-store, must-revalidate'),
+    ('Pragma', 'no-cache'),
+    ('Expires', '0'),
+]
+
+
+class Request:
+    """Parsed HTTP/1.x request line and headers"""
+
+    def __init__(self, method, path, version, headers):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+
+    def head(self):
+        """The request head as received, for handing it to another worker"""
+        lines = [f'{self.method} {self.path} {self.version}']
+        lines.extend(f'{key}: {value}' for key, value in self.headers.items())
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+async def read_request(reader):
+    """Read one request head; returns None on EOF or a malformed request"""
+    line = await reader.readline()
+    if not line:
+        return None
+    parts = line.decode('latin-1').split()
+    if len(parts) != 3:
+        return None
+    method, path, version = parts
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    return Request(method, path, version, headers)
+
+
+def write_head(writer, status, headers=(), keep_alive=False):
+    """Write the status line and headers (CORS headers always included)"""
+    send_head = getattr(writer, 'send_head', None)
+    if send_head is not None:
+        # HTTP/2 stream (see http2_server.py)
+        send_head(status, list(headers) + CORS_HEADERS)
+        return
+    lines = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}']
+    for key, value in list(headers) + CORS_HEADERS:
+        lines.append(f'{key}: {value}')
+    lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+
+async def send_body(writer, status, body, content_type='text/plain', keep_alive=False, head_only=False):
+    if isinstance(body, str):
+        body = body.encode()
+    write_head(writer, status, [
+        ('Content-Type', content_type),
+        ('Content-Length', str(len(body))),
+    ], keep_alive)
+    if not head_only:
+        writer.write(body)
+    await writer.drain()
+
+
+async def send_error(writer, status, message=None):
+    await send_body(writer, status, message or HTTPStatus(status).phrase)
+
+
+async def send_unavailable(writer, reason):
+    """503 for a camera the health prober knows is down"""
+    body = reason.encode()
+    write_head(writer, 503, [
+        ('Content-Type', 'text/plain'),
+        ('Content-Length', str(len(body))),
+        ('Retry-After', str(health.prober.retry_after())),
+    ])
+    writer.write(body)
+    await writer.drain()
+
+
+class ProxyServer:
+    """Routes requests for all listening ports on one event loop"""
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.loop = None
+
+    async def handle_client(self, reader, writer, adopted=False):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                # A connection handed to us by another worker is answered here
+                if not adopted and await self.hand_off(request, reader, writer):
+                    break
+                adopted = False
+                keep_alive = await self.dispatch(request, writer)
+                if not keep_alive:
+                    break
+        except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+            # Client disconnected
+            pass
+        except Exception:
+            logger.exception("Unhandled error in asyncio handler")
+        finally:
+            writer.close()
+
+    async def hand_off(self, request, reader, writer):
+        """Pass the connection to the worker owning the camera; True if it was"""
+        worker = workers.route(request.path)
+        if worker is None or worker == workers.index:
+            return False
+        sock = writer.get_extra_info('socket')
+        port = writer.get_extra_info('sockname')[1]
+        writer.transport.pause_reading()
+        # Whatever the client sent after the head (a pipelined request) goes
+        # along; StreamReader has no public way to take its buffered bytes
+        buffered = bytes(reader._buffer)
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, workers.hand_off, sock, worker, port, request.head() + buffered)
+        except OSError as e:
+            logger.warning("Cannot hand %s to worker %s, serving it here: %s", request.path, worker, e)
+            writer.transport.resume_reading()
+            return False
+        reader._buffer.clear()
+        return True
+
+    async def adopt(self, sock, head):
+        """Serve a connection another worker handed over (see workers.py)"""
+        reader = asyncio.StreamReader()
+        reader.feed_data(head)
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport, _ = await self.loop.connect_accepted_socket(lambda: protocol, sock)
+        writer = asyncio.StreamWriter(transport, protocol, reader, self.loop)
+        await self.handle_client(reader, writer, adopted=True)
+
+    async def dispatch(self, request, writer):
+        """Handle one request; returns True if the connection may be reused"""
+        path = request.path
+
+        if request.method == 'OPTIONS':
+            # Handle CORS preflight requests
+            write_head(writer, 200, [('Content-Length', '0')], request.keep_alive)
+            await writer.drain()
+            return request.keep_alive
+        if request.method not in ('GET', 'HEAD'):
+            await send_error(writer, 501, 'Unsupported method')
+            return False
+
+        if path.startswith('/mpegts/'):
+            await self.serve_mpegts(request, writer)
+            return False
+        if path == '/cleanup_mpegts':
+            await asyncio.get_running_loop().run_in_executor(None, mpegts_stream.cleanup_all_mpegts)
+            await send_body(writer, 200, 'MPEG-TS streams cleaned up', keep_alive=request.keep_alive)
+            return request.keep_alive
+        if path == '/pool_stats':
+            body = json.dumps(camera_pool.pool.get_stats(), indent=2)
+            await send_body(writer, 200, body, 'application/json', request.keep_alive)
+            return request.keep_alive
+        if path == '/event_stats':
+            body = json.dumps(sse_hub.hub.coalescer.get_stats(), indent=2)
+            await send_body(writer, 200, body, 'application/json', request.keep_alive)
+            return request.keep_alive
+        if path == '/metrics':
+            await send_body(writer, 200, metrics.registry.render(), metrics.CONTENT_TYPE, request.keep_alive)
+            return request.keep_alive
+        if path == '/topology.json':
+            # Over HTTP/2 every camera can share the page's connection
+            body = json.dumps(topology.topology.to_json(multiplexed=request.version == 'HTTP/2'), indent=2)
+            await send_body(writer, 200, body, 'application/json', request.keep_alive)
+            return request.keep_alive
+        if path == '/worker_stats':
+            body = json.dumps(workers.get_stats(), indent=2)
+            await send_body(writer, 200, body, 'application/json', request.keep_alive)
+            return request.keep_alive
+        if path == '/status':
+            body = json.dumps(health.prober.get_stats(), indent=2)
+            await send_body(writer, 200, body, 'application/json', request.keep_alive)
+            return request.keep_alive
+        if path == '/layout.json':
+            body = json.dumps(layout.engine.snapshot(), indent=2)
+            await send_body(writer, 200, body, 'application/json', request.keep_alive)
+            return request.keep_alive
+        if path == '/layout_stats':
+            body = json.dumps(layout.engine.get_stats(), indent=2)
+            await send_body(writer, 200, body, 'application/json', request.keep_alive)
+            return request.keep_alive
+        if path.split('?')[0] == '/quality':
+            # A display reporting its layout to the quality policy
+            query = urllib.parse.urlsplit(path).query
+            if query:
+                try:
+                    client, active, recent = quality.parse_report(query)
+                except ValueError as e:
+                    await send_error(writer, 400, str(e))
+                    return False
+                await asyncio.get_running_loop().run_in_executor(
+                    None, quality.policy.report, client, active, recent)
+            body = json.dumps(quality.policy.get_stats(), indent=2)
+            await send_body(writer, 200, body, 'application/json', request.keep_alive)
+            return request.keep_alive
+        if path.split('?')[0] == '/log_level':
+            # Log levels and writer statistics; level=..&logger=.. changes one
+            try:
+                change = logs.parse_level_request(urllib.parse.urlsplit(path).query)
+            except ValueError as e:
+                await send_error(writer, 400, str(e))
+                return False
+            if change:
+                logs.set_level(*change)
+            body = json.dumps(logs.get_stats(), indent=2)
+            await send_body(writer, 200, body, 'application/json', request.keep_alive)
+            return request.keep_alive
+        if path == '/egress_stats':
+            body = json.dumps(egress.scheduler.get_stats(), indent=2)
+            await send_body(writer, 200, body, 'application/json', request.keep_alive)
+            return request.keep_alive
+        if path == '/ffmpeg_stats':
+            body = json.dumps(ffmpeg_supervisor.supervisor.get_stats(), indent=2)
+            await send_body(writer, 200, body, 'application/json', request.keep_alive)
+            return request.keep_alive
+        if path.startswith('/preview/'):
+            return await self.serve_preview(request, writer)
+        if path.startswith('/video'):
+            await self.serve_mjpeg(request, writer)
+            return False
+        if path.startswith('/api/v1/subscribe'):
+            await self.serve_sse(request, writer)
+            return False
+        if path.startswith('/clips'):
+            return await self.serve_clip(request, writer)
+        return await self.serve_file(request, writer, static_assets.resolve(path))
+
+    async def serve_clip(self, request, writer):
+        """/clips/<id>/<ts>.ts, or the clip list for /clips/ and /clips/<id>/"""
+        try:
+            file_path, cam_id = clips.resolve(request.path)
+        except LookupError as e:
+            await send_body(writer, 404, str(e), keep_alive=request.keep_alive)
+            return request.keep_alive
+        except ValueError:
+            await send_body(writer, 404, 'Clip not found', keep_alive=request.keep_alive)
+            return request.keep_alive
+        if file_path is not None:
+            return await self.serve_file(request, writer, file_path)
+        body = await asyncio.get_running_loop().run_in_executor(None, clips.list_clips, cam_id)
+        await send_body(writer, 200, json.dumps(body, indent=2), 'application/json', request.keep_alive)
+        return request.keep_alive
+
+    async def serve_file(self, request, writer, file_path):
+        loop = asyncio.get_running_loop()
+        # A changed file is re-read (and compressed) off the loop
+        response = await loop.run_in_executor(
+            None, static_assets.cache.respond, file_path, request.headers, request.method == 'HEAD')
+        write_head(writer, response.status, response.headers, request.keep_alive)
+        if response.file_path is None:
+            writer.write(response.body)
+            await writer.drain()
+            return request.keep_alive
+        try:
+            with open(response.file_path, 'rb') as f:
+                transport = getattr(writer, 'transport', None)
+                if transport is not None:
+                    # Zero-copy on plain sockets; asyncio falls back to copying under TLS
+                    await writer.drain()
+                    await loop.sendfile(transport, f, response.offset, response.length)
+                else:
+                    # HTTP/2 streams have no transport of their own; copy in chunks
+                    f.seek(response.offset)
+                    remaining = response.length
+                    while remaining > 0:
+                        chunk = await loop.run_in_executor(None, f.read, min(remaining, SENDFILE_CHUNK))
+                        if not chunk:
+                            break
+                        writer.write(chunk)
+                        await writer.drain()
+                        remaining -= len(chunk)
+        except OSError as e:
+            # Headers are already out; all we can do is drop the connection
+            logger.warning("Error sending %s: %s", response.file_path, e)
+            return False
+        return request.keep_alive
+
+    def _make_waker(self):
+        event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        return event, lambda: loop.call_soon_threadsafe(event.set)
+
+    async def serve_mpegts(self, request, writer):
+        url = urllib.parse.urlsplit(request.path)
+        cam_id_str = url.path.split('/')[-1]
+        try:
+            cam_id = int(cam_id_str)
+        except ValueError:
+            await send_error(writer, 400, "Invalid camera ID")
+            return
+        try:
+            tier = quality.parse_tier(url.query)
+        except ValueError as e:
+            await send_error(writer, 400, str(e))
+            return
+        if not self.password:
+            await send_error(writer, 500, "Camera password not configured")
+            return
+        reason = health.prober.unavailable(cam_id, health.MPEGTS)
+        if reason:
+            await send_unavailable(writer, reason)
+            return
+
+        write_head(writer, 200, [('Content-Type', 'video/mp2t')] + NO_CACHE_HEADERS)
+
+        loop = asyncio.get_running_loop()
+        # Creating the broadcaster may spawn FFmpeg; keep that off the loop
+        viewer = await loop.run_in_executor(
+            None, mpegts_stream.open_viewer, cam_id, self.username, self.password, tier)
+        event, waker = self._make_waker()
+        viewer.waker = waker
+        flow = egress.scheduler.open(egress.TS, cam_id)
+        try:
+            while True:
+                # Hold small amounts back briefly so writes go out in batches
+                delay = viewer.coalesce_delay()
+                if delay:
+                    await asyncio.sleep(delay)
+                chunks = viewer.get_chunks(timeout=0, coalesce=False)
+                if chunks is None:
+                    return
+                if chunks:
+                    size = sum(len(chunk) for chunk in chunks)
+                    if not await flow.acquire_async(size):
+                        # Over the egress budget: skip to the next keyframe
+                        viewer.resync(size // mpegts_stream.TS_PACKET_SIZE)
+                        continue
+                    writer.writelines(chunks)
+                    await writer.drain()
+                    metrics.egress_bytes.inc(cam_id, 'ts', amount=size)
+                    continue
+                await event.wait()
+                event.clear()
+        except (ConnectionResetError, BrokenPipeError):
+            logger.info("Camera %s: Client disconnected", cam_id)
+        finally:
+            flow.close()
+            viewer.waker = None
+            await loop.run_in_executor(None, viewer.close)
+
+    async def serve_mjpeg(self, request, writer):
+        path_parts = request.path.split('?')
+        try:
+            cam_id = int(path_parts[0].strip("/video"))
+        except ValueError:
+            await send_error(writer, 400, "Invalid camera ID")
+            return
+        if not self.password:
+            await send_error(writer, 500, "Camera password not configured")
+            return
+        reason = health.prober.unavailable(cam_id, health.MJPEG)
+        if reason:
+            await send_unavailable(writer, reason)
+            return
+
+        broadcaster = mjpeg_stream.subscribe(cam_id, self.username, self.password)
+        event, waker = self._make_waker()
+        broadcaster.add_waker(waker)
+        flow = None
+        try:
+            # Wait for the first frame so failures can still be sent as 502
+            try:
+                await asyncio.wait_for(self._next_frame(broadcaster, event, 0), 10)
+            except asyncio.TimeoutError:
+                pass
+            seq, frame = broadcaster.latest()
+            if frame is None:
+                err = broadcaster.error or 'no frames received'
+                logger.debug('Camera %s: %s', cam_id, err)
+                await send_error(writer, 502, f'Camera {cam_id} unavailable: {err}')
+                return
+
+            write_head(writer, 200, [
+                ('Content-Type', f"multipart/x-mixed-replace; boundary={mjpeg_stream.OUTPUT_BOUNDARY}"),
+                ('Cache-Control', 'no-cache, no-store, must-revalidate'),
+            ])
+            flow = egress.scheduler.open(egress.MJPEG, cam_id)
+            while frame is not None:
+                part = mjpeg_stream.format_part(frame)
+                # A frame over the egress budget is skipped for a newer one
+                if await flow.acquire_async(len(part)):
+                    writer.write(part)
+                    await writer.drain()
+                    metrics.egress_bytes.inc(cam_id, 'mjpeg', amount=len(part))
+                seq, frame = await self._next_frame(broadcaster, event, seq)
+        finally:
+            if flow is not None:
+                flow.close()
+            broadcaster.remove_waker(waker)
+            broadcaster.remove_viewer()
+
+    async def _next_frame(self, broadcaster, event, last_seq):
+        """Wait for a frame newer than last_seq; frame is None once closed"""
+        while True:
+            seq, frame = broadcaster.latest()
+            if seq != last_seq and frame is not None:
+                return seq, frame
+            if broadcaster.closed:
+                return seq, None
+            await event.wait()
+            event.clear()
+
+    async def serve_preview(self, request, writer):
+        url = urllib.parse.urlsplit(request.path)
+        name = url.path[len('/preview/'):]
+        params = urllib.parse.parse_qs(url.query)
+        try:
+            if name == 'mosaic':
+                cams, cols = preview.parse_mosaic_query(url.query)
+                fetch = lambda: preview.manager.request_mosaic(cams, cols)
+                stream = True
+            else:
+                cam_id = preview.parse_camera(name)
+                fetch = lambda: preview.manager.request(cam_id)
+                stream = params.get('stream', ['0'])[0] == '1'
+        except ValueError as e:
+            await send_error(writer, 400, f"Invalid preview request: {e}")
+            return False
+        except LookupError as e:
+            await send_error(writer, 404, str(e))
+            return False
+
+        event, waker = self._make_waker()
+        preview.manager.add_waker(waker)
+        try:
+            try:
+                seq, jpeg = await asyncio.wait_for(self._next_preview(fetch, event, 0), 10)
+            except asyncio.TimeoutError:
+                await send_error(writer, 503, "Preview not available yet")
+                return False
+            if not stream:
+                await send_body(writer, 200, jpeg, 'image/jpeg', request.keep_alive,
+                                head_only=request.method == 'HEAD')
+                return request.keep_alive
+
+            write_head(writer, 200, [
+                ('Content-Type', f"multipart/x-mixed-replace; boundary={preview.OUTPUT_BOUNDARY}"),
+                ('Cache-Control', 'no-cache, no-store, must-revalidate'),
+            ])
+            while True:
+                writer.write(preview.format_part(jpeg))
+                await writer.drain()
+                seq, jpeg = await self._next_preview(fetch, event, seq)
+        finally:
+            preview.manager.remove_waker(waker)
+
+    async def _next_preview(self, fetch, event, last_seq):
+        """Wait for a preview newer than last_seq, re-requesting it so it stays alive"""
+        while True:
+            seq, jpeg = fetch()
+            if seq != last_seq and jpeg is not None:
+                return seq, jpeg
+            try:
+                await asyncio.wait_for(event.wait(), preview.PREVIEW_INTERVAL * 2)
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+
+    async def serve_sse(self, request, writer):
+        query = urllib.parse.urlsplit(request.path).query
+        try:
+            event_filter = priorities.EventFilter.from_query(query)
+        except ValueError as e:
+            await send_error(writer, 400, f"Invalid filter: {e}")
+            return
+
+        write_head(writer, 200, [
+            ('Content-Type', 'text/event-stream'),
+            ('Cache-Control', 'no-cache, no-transform'),
+            ('X-Accel-Buffering', 'no'),  # Disable nginx buffering
+        ])
+        writer.write(b': connected\n\n')
+        await writer.drain()
+
+        client = sse_hub.hub.subscribe(request.headers.get('last-event-id'), event_filter)
+        if layout.wants_layout(query):
+            layout.engine.attach(client)
+        event, waker = self._make_waker()
+        client.waker = waker
+        flow = egress.scheduler.open(egress.SSE)
+        try:
+            while True:
+                data = client.get(timeout=0)
+                if data is None:
+                    return
+                if data:
+                    await flow.acquire_async(len(data), droppable=False)
+                    writer.write(data)
+                    await writer.drain()
+                    continue
+                await event.wait()
+                event.clear()
+        finally:
+            flow.close()
+            client.waker = None
+            layout.engine.detach(client)
+            sse_hub.hub.unsubscribe(client)
+
+    async def serve(self, ports, http2_port=None, ssl_context=None):
+        self.loop = asyncio.get_running_loop()
+        servers = []
+        for port in ports:
+            server = await asyncio.start_server(self.handle_client, '', port, reuse_address=True,
+                                                reuse_port=workers.enabled() or None)
+            servers.append(server)
+        logger.info("asyncio server listening on ports %s", ', '.join(str(p) for p in ports))
+        if workers.enabled():
+            workers.serve_handoffs(
+                lambda sock, port, head: asyncio.run_coroutine_threadsafe(self.adopt(sock, head), self.loop))
+        tasks = [server.serve_forever() for server in servers]
+        if http2_port:
+            import http2_server
+            tasks.append(http2_server.Http2Listener(self, ssl_context).serve(http2_port))
+        await asyncio.gather(*tasks)
+
+
+def run(ports, username, password, http2_port=None, ssl_context=None):
+    """Run the asyncio server on all ports (plus the HTTP/2 listener) until interrupted"""
+    server = ProxyServer(username, password)
+    preview.manager.configure(username, password)
+    try:
+        asyncio.run(server.serve(ports, http2_port, ssl_context))
+    finally:
+        mpegts_stream.cleanup_all_mpegts()
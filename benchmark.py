@@ -0,0 +1,695 @@
+#!/usr/bin/env python3
+"""
+Offline load test for the camera proxy
+Runs main.py against local stand-ins for everything it talks to: an HTTPS
+MJPEG camera server with Digest authentication, a fake FFmpeg emitting
+synthetic MPEG-TS (through FFMPEG_PATH) and an SSE event server replaying
+JSONL event bursts or generating random ones (through SOVEREIGN_URL). The
+cameras point at the stand-ins through a generated priorities file
+(PRIORITIES_FILE). Simulated viewers then watch MPEG-TS, MJPEG and the
+event feed. The report covers throughput, time to first byte, latency
+percentiles (overall and for the worst client) and the proxy's CPU and RSS.
+
+    python benchmark.py --viewers 40 --duration 30 [--asyncio] [--events bursts.jsonl]
+
+Every payload carries the wall-clock time it was produced, so latency is
+measured end to end through the proxy. An events file has one JSON event
+per line ({"camera": 3, "event_type": "intrusion"}); a line with "delay"
+waits that many seconds first, so lines without one form a burst. The fake
+cameras' certificate is made with the openssl command line tool.
+"""
+
+import os
+import re
+import ssl
+import sys
+import json
+import time
+import queue
+import random
+import socket
+import struct
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+import http.server
+import socketserver
+
+import digest_auth
+
+# Marker in front of the 8-byte big-endian wall-clock time in every payload
+STAMP = b'BENCHTS'
+STAMP_SIZE = len(STAMP) + 8
+
+TS_PACKET_SIZE = 188
+PMT_PID = 0x1000
+VIDEO_PID = 0x100
+STAMP_PID = 0x1FF0
+
+DIGEST_REALM = 'bench'
+BENCH_USERNAME = 'bench'
+BENCH_PASSWORD = 'bench'
+
+EVENT_TYPES = ['intrusion', 'line_crossing', 'face_detection', 'loitering', 'smart_motion', 'tampering']
+
+
+def stamp():
+    return STAMP + struct.pack('>d', time.time())
+
+
+def find_stamps(data):
+    """Latencies in seconds of every stamp in data"""
+    now = time.time()
+    latencies = []
+    i = data.find(STAMP)
+    while i != -1 and i + STAMP_SIZE <= len(data):
+        sent, = struct.unpack('>d', data[i + len(STAMP):i + STAMP_SIZE])
+        latencies.append(now - sent)
+        i = data.find(STAMP, i + STAMP_SIZE)
+    return latencies
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+# ---------------------------------------------------------------------------
+# Fake FFmpeg: synthetic MPEG-TS on stdout
+# ---------------------------------------------------------------------------
+
+def crc32_mpeg(data):
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+            crc &= 0xFFFFFFFF
+    return crc
+
+
+class TSWriter:
+    """Builds TS packets with per-PID continuity counters"""
+
+    def __init__(self):
+        self.counters = {}
+
+    def packet(self, pid, payload, pusi=False, random_access=False):
+        cc = self.counters.get(pid, 0)
+        self.counters[pid] = (cc + 1) & 0x0F
+        header = bytes([0x47, (0x40 if pusi else 0) | (pid >> 8), pid & 0xFF])
+        if random_access:
+            header += bytes([0x30 | cc, 1, 0x40])
+        else:
+            header += bytes([0x10 | cc])
+        packet = header + payload[:TS_PACKET_SIZE - len(header)]
+        return packet + b'\xff' * (TS_PACKET_SIZE - len(packet))
+
+    def section(self, pid, table):
+        return self.packet(pid, b'\x00' + table + struct.pack('>I', crc32_mpeg(table)), pusi=True)
+
+    def tables(self):
+        pat = bytes([0x00, 0xB0, 0x0D, 0x00, 0x01, 0xC1, 0x00, 0x00,
+                     0x00, 0x01, 0xE0 | (PMT_PID >> 8), PMT_PID & 0xFF])
+        pmt = bytes([0x02, 0xB0, 0x17, 0x00, 0x01, 0xC1, 0x00, 0x00,
+                     0xE0 | (VIDEO_PID >> 8), VIDEO_PID & 0xFF, 0xF0, 0x00,
+                     0x1B, 0xE0 | (VIDEO_PID >> 8), VIDEO_PID & 0xFF, 0xF0, 0x00,
+                     0x06, 0xE0 | (STAMP_PID >> 8), STAMP_PID & 0xFF, 0xF0, 0x00])
+        return self.section(0, pat) + self.section(PMT_PID, pmt)
+
+    def frame(self, size, keyframe):
+        """One video frame of about size bytes followed by a timestamp packet"""
+        nal = b'\x00\x00\x00\x01\x67\x00\x00\x00\x01\x65' if keyframe else b'\x00\x00\x00\x01\x41'
+        pes = b'\x00\x00\x01\xe0\x00\x00\x80\x00\x00' + nal
+        packets = [self.packet(VIDEO_PID, pes, pusi=True, random_access=keyframe)]
+        filler = b'\x00' * 184
+        for _ in range(max(size // 184 - 1, 0)):
+            packets.append(self.packet(VIDEO_PID, filler))
+        packets.append(self.packet(STAMP_PID, stamp(), pusi=True))
+        return b''.join(packets)
+
+
+def run_fake_ffmpeg(kbps, fps=25):
+    """Stand-in for FFmpeg: paced synthetic TS on stdout until the pipe closes"""
+    writer = TSWriter()
+    out = sys.stdout.buffer
+    frame_size = int(kbps * 1000 / 8 / fps)
+    interval = 1 / fps
+    next_frame = time.monotonic()
+    frame = 0
+    try:
+        while True:
+            keyframe = frame % fps == 0
+            data = writer.tables() + writer.frame(frame_size, True) if keyframe else writer.frame(frame_size, False)
+            out.write(data)
+            out.flush()
+            frame += 1
+            next_frame += interval
+            time.sleep(max(next_frame - time.monotonic(), 0))
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+
+
+# ---------------------------------------------------------------------------
+# Fake camera: HTTPS multipart MJPEG behind Digest authentication
+# ---------------------------------------------------------------------------
+
+class FakeCameraHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _authorized(self):
+        params = digest_auth.parse_challenge(self.headers.get('Authorization'))
+        if params is None or params.get('nonce') not in self.server.nonces:
+            return False
+        ha1 = digest_auth.H(f"{params.get('username')}:{DIGEST_REALM}:{BENCH_PASSWORD}")
+        ha2 = digest_auth.H(f"GET:{params.get('uri')}")
+        if params.get('qop'):
+            expected = digest_auth.H(f"{ha1}:{params['nonce']}:{params.get('nc')}:"
+                                     f"{params.get('cnonce')}:{params['qop']}:{ha2}")
+        else:
+            expected = digest_auth.H(f"{ha1}:{params['nonce']}:{ha2}")
+        return params.get('response') == expected
+
+    def do_GET(self):
+        if not self._authorized():
+            nonce = os.urandom(8).hex()
+            self.server.nonces.add(nonce)
+            self.send_response(401)
+            self.send_header('WWW-Authenticate',
+                             f'Digest realm="{DIGEST_REALM}", nonce="{nonce}", qop="auth", algorithm=MD5')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.server.stats['streams'] += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=camera')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        interval = 1 / self.server.fps
+        padding = b'\x00' * max(self.server.frame_size - 20, 0)
+        next_frame = time.monotonic()
+        try:
+            while not self.server.stopping.is_set():
+                jpeg = b'\xff\xd8\xff\xfe\x00\x11' + stamp() + b'\xff\xe0' + padding + b'\xff\xd9'
+                self.wfile.write(b'--camera\r\nContent-Type: image/jpeg\r\nContent-Length: '
+                                 + str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg + b'\r\n')
+                next_frame += interval
+                time.sleep(max(next_frame - time.monotonic(), 0))
+        except (BrokenPipeError, ConnectionResetError, ssl.SSLError, OSError):
+            pass
+
+
+class FakeCameraServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, certfile, keyfile, fps, frame_size):
+        super().__init__(('', port), FakeCameraHandler)
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(certfile, keyfile)
+        self.nonces = set()
+        self.fps = fps
+        self.frame_size = frame_size
+        self.stopping = threading.Event()
+        self.stats = {'streams': 0}
+
+    def finish_request(self, request, client_address):
+        # TLS handshake in the connection's own thread, not the accept loop
+        try:
+            request = self.context.wrap_socket(request, server_side=True)
+        except (ssl.SSLError, OSError):
+            return
+        super().finish_request(request, client_address)
+
+
+# ---------------------------------------------------------------------------
+# Fake event server: text/event-stream of replayed or generated bursts
+# ---------------------------------------------------------------------------
+
+class FakeEventHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        client = queue.Queue()
+        self.server.add_client(client)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            while not self.server.stopping.is_set():
+                try:
+                    message = client.get(timeout=1)
+                except queue.Empty:
+                    continue
+                self.wfile.write(message)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.server.remove_client(client)
+
+
+class FakeEventServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, cameras, rate, burst, events_file=None):
+        super().__init__(('127.0.0.1', port), FakeEventHandler)
+        self.cameras = cameras
+        self.rate = rate
+        self.burst = burst
+        self.replay = self._load(events_file) if events_file else None
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.stopping = threading.Event()
+        self.next_id = 1
+        self.sent = 0
+
+    @staticmethod
+    def _load(path):
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def add_client(self, client):
+        with self.lock:
+            self.clients.add(client)
+
+    def remove_client(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def emit(self, event):
+        data = dict(event)
+        data.pop('delay', None)
+        data['sent'] = time.time()
+        with self.lock:
+            message = f"id: {self.next_id}\ndata: {json.dumps(data)}\n\n".encode()
+            self.next_id += 1
+            self.sent += 1
+            clients = list(self.clients)
+        for client in clients:
+            client.put(message)
+
+    def run_generator(self):
+        while not self.stopping.is_set():
+            if self.replay:
+                for event in self.replay:
+                    if self.stopping.wait(float(event.get('delay', 0))):
+                        return
+                    self.emit(event)
+                if self.stopping.wait(1 / self.rate):
+                    return
+                continue
+            for _ in range(random.randint(1, self.burst)):
+                self.emit({'camera': random.choice(self.cameras), 'event_type': random.choice(EVENT_TYPES)})
+            if self.stopping.wait(1 / self.rate):
+                return
+
+
+# ---------------------------------------------------------------------------
+# Simulated viewers
+# ---------------------------------------------------------------------------
+
+class Viewer(threading.Thread):
+    """One client reading a stream and recording TTFB, bytes and latencies"""
+
+    def __init__(self, kind, path, port, stop):
+        super().__init__(name=f'viewer-{kind}', daemon=True)
+        self.kind = kind
+        self.path = path
+        self.port = port
+        self.stop = stop
+        self.ttfb = None
+        self.bytes = 0
+        self.latencies = []
+        self.error = None
+
+    def run(self):
+        start = time.monotonic()
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=2)
+        tail = b''
+        try:
+            conn.request('GET', self.path)
+            response = conn.getresponse()
+            if response.status != 200:
+                self.error = f'HTTP {response.status}'
+                return
+            while not self.stop.is_set():
+                try:
+                    data = response.read1(65536)
+                except socket.timeout:
+                    continue
+                if not data:
+                    if not self.stop.is_set():
+                        self.error = 'closed by proxy'
+                    return
+                if self.ttfb is None:
+                    self.ttfb = time.monotonic() - start
+                self.bytes += len(data)
+                data = tail + data
+                if self.kind == 'sse':
+                    now = time.time()
+                    self.latencies.extend(now - float(sent) for sent in re.findall(rb'"sent":\s*([0-9.]+)', data))
+                    cut = data.rfind(b'\n')
+                    tail = data[cut + 1:]
+                else:
+                    self.latencies.extend(find_stamps(data))
+                    tail = data[-STAMP_SIZE:]
+        except (OSError, http.client.HTTPException) as e:
+            self.error = str(e) or type(e).__name__
+        finally:
+            conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Proxy process sampling
+# ---------------------------------------------------------------------------
+
+class ProcessSampler(threading.Thread):
+    """CPU time and peak RSS of the proxy from /proc (Linux only)
+
+    With workers the proxy process only supervises; its children (the
+    workers) are measured instead.
+    """
+
+    def __init__(self, pid, stop, workers=False):
+        super().__init__(name='sampler', daemon=True)
+        self.pid = pid
+        self.stop = stop
+        self.workers = workers
+        self.ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self.cpu_start = self.cpu_end = None
+        self.rss_peak = None
+        self.started = self.ended = None
+
+    def pids(self):
+        if not self.workers:
+            return [self.pid]
+        try:
+            with open(f'/proc/{self.pid}/task/{self.pid}/children') as f:
+                return [int(pid) for pid in f.read().split()]
+        except (OSError, ValueError):
+            return [self.pid]
+
+    def cpu_seconds(self):
+        total = 0
+        try:
+            for pid in self.pids():
+                with open(f'/proc/{pid}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                total += int(fields[11]) + int(fields[12])
+        except (OSError, IndexError, ValueError):
+            return None
+        return total / self.ticks
+
+    def rss_bytes(self):
+        total = None
+        for pid in self.pids():
+            try:
+                with open(f'/proc/{pid}/status') as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total = (total or 0) + int(line.split()[1]) * 1024
+            except (OSError, ValueError):
+                pass
+        return total
+
+    def run(self):
+        self.started = time.monotonic()
+        self.cpu_start = self.cpu_seconds()
+        while not self.stop.wait(0.5):
+            rss = self.rss_bytes()
+            if rss is not None:
+                self.rss_peak = max(self.rss_peak or 0, rss)
+        self.cpu_end = self.cpu_seconds()
+        self.ended = time.monotonic()
+
+    def cpu_percent(self):
+        if self.cpu_start is None or self.cpu_end is None:
+            return None
+        return 100 * (self.cpu_end - self.cpu_start) / (self.ended - self.started)
+
+
+# ---------------------------------------------------------------------------
+# Harness
+# ---------------------------------------------------------------------------
+
+def make_certificate(directory):
+    certfile = os.path.join(directory, 'camera.pem')
+    keyfile = os.path.join(directory, 'camera.key')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=bench-camera', '-keyout', keyfile, '-out', certfile],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+def camera_host(cam_id, port):
+    # Each camera gets its own loopback address on Linux so per-host pools behave
+    if sys.platform.startswith('linux'):
+        return f'127.0.0.{cam_id + 1}:{port}'
+    return f'127.0.0.1:{port}'
+
+
+def write_priorities(path, cameras, ports, camera_port):
+    config = {
+        str(cam_id): {
+            'description': f'Bench camera {cam_id}',
+            'events': {event_type: 'HIGH' if event_type == 'intrusion' else 'LOW' for event_type in EVENT_TYPES},
+            'ip': camera_host(cam_id, camera_port),
+            'zone': 1 + cam_id % 4,
+        }
+        for cam_id in cameras
+    }
+    config['topology'] = {'ports': ports}
+    with open(path, 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+def write_ffmpeg_wrapper(path, kbps):
+    with open(path, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" --fake-ffmpeg --ts-kbps {kbps}\n')
+    os.chmod(path, 0o755)
+
+
+def wait_for_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def fetch_json(port, path):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        conn.request('GET', path)
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in ('mpegts', 'mjpeg', 'sse'):
+            raise ValueError(f"Unknown viewer kind: {kind}")
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def summarize(viewers, elapsed):
+    results = {}
+    for kind in ('mpegts', 'mjpeg', 'sse'):
+        group = [viewer for viewer in viewers if viewer.kind == kind]
+        if not group:
+            continue
+        latencies = [latency for viewer in group for latency in viewer.latencies]
+        ttfbs = [viewer.ttfb for viewer in group if viewer.ttfb is not None]
+        client_p99 = [percentile(viewer.latencies, 0.99) for viewer in group if viewer.latencies]
+        results[kind] = {
+            'clients': len(group),
+            'errors': sum(1 for viewer in group if viewer.error),
+            'mbit_per_second': sum(viewer.bytes for viewer in group) * 8 / 1e6 / elapsed,
+            'ttfb_ms': {'p50': _ms(percentile(ttfbs, 0.5)), 'p99': _ms(percentile(ttfbs, 0.99))},
+            'latency_ms': {'p50': _ms(percentile(latencies, 0.5)), 'p90': _ms(percentile(latencies, 0.9)),
+                           'p99': _ms(percentile(latencies, 0.99)), 'max': _ms(max(latencies, default=None))},
+            'worst_client_p99_ms': _ms(max(client_p99, default=None)),
+            'samples': len(latencies),
+        }
+    return results
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def print_report(results, process):
+    print('')
+    print(f"{'kind':<8}{'clients':>8}{'errors':>8}{'Mbit/s':>10}{'ttfb p50/p99 ms':>20}"
+          f"{'latency p50/p90/p99/max ms':>32}{'worst p99':>11}")
+    for kind, result in results.items():
+        ttfb = result['ttfb_ms']
+        latency = result['latency_ms']
+        print(f"{kind:<8}{result['clients']:>8}{result['errors']:>8}{result['mbit_per_second']:>10.1f}"
+              f"{_fmt(ttfb['p50']) + '/' + _fmt(ttfb['p99']):>20}"
+              f"{'/'.join(_fmt(latency[key]) for key in ('p50', 'p90', 'p99', 'max')):>32}"
+              f"{_fmt(result['worst_client_p99_ms']):>11}")
+    print('')
+    cpu = process.get('cpu_percent')
+    rss = process.get('rss_peak_mb')
+    print(f"proxy CPU {_fmt(cpu)}%  peak RSS {_fmt(rss)} MB")
+
+
+def _fmt(value):
+    return '-' if value is None else f'{value:.1f}' if isinstance(value, float) else str(value)
+
+
+def run(args):
+    weights = parse_mix(args.mix)
+    cameras = list(range(1, args.cameras + 1))
+    ports = [args.base_port + i for i in range(6)]
+    workdir = tempfile.mkdtemp(prefix='camproxy-bench-')
+    stop = threading.Event()
+    proxy = None
+    servers = []
+    try:
+        certfile, keyfile = make_certificate(workdir)
+        camera_server = FakeCameraServer(args.camera_port, certfile, keyfile, args.mjpeg_fps, args.mjpeg_frame_bytes)
+        event_server = FakeEventServer(args.sse_port, cameras, args.event_rate, args.event_burst, args.events)
+        servers = [camera_server, event_server]
+        for server in servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        threading.Thread(target=event_server.run_generator, daemon=True).start()
+
+        priorities_file = os.path.join(workdir, 'priorities.json')
+        write_priorities(priorities_file, cameras, ports, args.camera_port)
+        ffmpeg = os.path.join(workdir, 'ffmpeg')
+        write_ffmpeg_wrapper(ffmpeg, args.ts_kbps)
+
+        env = dict(os.environ)
+        env.update({
+            'CAMERA_USERNAME': BENCH_USERNAME,
+            'CAMERA_PASSWORD': BENCH_PASSWORD,
+            'SOVEREIGN_URL': f'http://127.0.0.1:{args.sse_port}',
+            'FFMPEG_PATH': ffmpeg,
+            'PRIORITIES_FILE': priorities_file,
+            'CLIPS_DIR': os.path.join(workdir, 'clips'),
+            # The fake cameras have no RTSP server, so probes would mark them down
+            'HEALTH_INTERVAL': '0',
+        })
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')]
+        if args.asyncio:
+            command.append('--asyncio')
+        if args.workers > 1:
+            command += ['--workers', str(args.workers)]
+        log = open(os.path.join(workdir, 'proxy.log'), 'wb')
+        proxy = subprocess.Popen(command, env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+        if not wait_for_port(ports[0], 15):
+            print(f"Proxy did not start; see {log.name}")
+            return 1
+        camera_ports = fetch_json(ports[0], '/topology.json').get('camera_ports', {})
+
+        kinds = random.Random(args.seed).choices(list(weights), list(weights.values()), k=args.viewers)
+        viewers = []
+        for i, kind in enumerate(kinds):
+            cam_id = cameras[i % len(cameras)]
+            port = camera_ports.get(str(cam_id), ports[0])
+            path = {'mpegts': f'/mpegts/{cam_id}', 'mjpeg': f'/video{cam_id}', 'sse': '/api/v1/subscribe'}[kind]
+            viewers.append(Viewer(kind, path, port if kind != 'sse' else ports[0], stop))
+
+        sampler = ProcessSampler(proxy.pid, stop, args.workers > 1)
+        print(f"{args.viewers} viewers on {len(cameras)} cameras for {args.duration:.0f}s "
+              f"({'asyncio' if args.asyncio else 'threaded'} proxy"
+              f"{f', {args.workers} workers' if args.workers > 1 else ''})")
+        started = time.monotonic()
+        sampler.start()
+        for viewer in viewers:
+            viewer.start()
+            time.sleep(args.ramp / max(len(viewers), 1))
+        stop.wait(args.duration)
+        stop.set()
+        for viewer in viewers:
+            viewer.join(5)
+        sampler.join(5)
+        elapsed = time.monotonic() - started
+
+        results = summarize(viewers, elapsed)
+        process = {
+            'cpu_percent': None if sampler.cpu_percent() is None else round(sampler.cpu_percent(), 1),
+            'rss_peak_mb': None if sampler.rss_peak is None else round(sampler.rss_peak / 1e6, 1),
+        }
+        print_report(results, process)
+        errors = sorted({viewer.error for viewer in viewers if viewer.error})
+        if errors:
+            print(f"errors: {', '.join(errors)}")
+        print(f"camera streams opened: {camera_server.stats['streams']}, events sent: {event_server.sent}")
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'args': vars(args), 'results': results, 'proxy': process}, f, indent=2)
+        return 0
+    finally:
+        stop.set()
+        if proxy is not None:
+            proxy.terminate()
+            try:
+                proxy.wait(10)
+            except subprocess.TimeoutExpired:
+                proxy.kill()
+        for server in servers:
+            server.stopping.set()
+            server.shutdown()
+        if args.keep:
+            print(f"Work files kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test for the camera proxy')
+    parser.add_argument('--viewers', type=int, default=20, help='simulated viewers')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to measure')
+    parser.add_argument('--ramp', type=float, default=2, help='seconds over which viewers connect')
+    parser.add_argument('--mix', default='mpegts=6,mjpeg=3,sse=1', help='viewer kinds and weights')
+    parser.add_argument('--cameras', type=int, default=16, help='number of fake cameras')
+    parser.add_argument('--asyncio', action='store_true', help='run the proxy in asyncio mode')
+    parser.add_argument('--workers', type=int, default=1, help='run the proxy with this many worker processes')
+    parser.add_argument('--ts-kbps', type=int, default=2000, help='bitrate of the fake FFmpeg output')
+    parser.add_argument('--mjpeg-fps', type=float, default=10)
+    parser.add_argument('--mjpeg-frame-bytes', type=int, default=40000)
+    parser.add_argument('--events', help='JSONL file of events to replay')
+    parser.add_argument('--event-rate', type=float, default=5, help='generated bursts per second')
+    parser.add_argument('--event-burst', type=int, default=4, help='max events per generated burst')
+    parser.add_argument('--base-port', type=int, default=18000, help='first of the six proxy ports')
+    parser.add_argument('--camera-port', type=int, default=18443)
+    parser.add_argument('--sse-port', type=int, default=18080)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory (proxy log, config)')
+    parser.add_argument('--fake-ffmpeg', action='store_true', help=argparse.SUPPRESS)
+    args, _ = parser.parse_known_args()
+
+    if args.fake_ffmpeg:
+        # Invoked by the proxy in place of FFmpeg; its arguments are ignored
+        run_fake_ffmpeg(args.ts_kbps)
+        return 0
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
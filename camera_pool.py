@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Keep-alive HTTPS connection pool for the cameras
+All camera requests share one SSL context. Idle keep-alive connections are
+kept per camera so the Digest challenge and the authenticated stream request
+ride the same TCP+TLS connection, and new connections resume the camera's
+previous TLS session to skip the full handshake.
+"""
+
+import ssl
+import time
+import socket
+import logging
+import threading
+import http.client
+import urllib.error
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Idle connections kept per camera, and how long they stay usable
+MAX_IDLE_PER_HOST = 2
+IDLE_TIMEOUT = 30
+
+# Network errors meaning an idle keep-alive connection went stale
+STALE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
+def create_ssl_context():
+    """Shared client context; cameras use self-signed certificates"""
+    context = ssl._create_unverified_context()
+    # Allow session tickets so reconnects can resume
+    context.options &= ~ssl.OP_NO_TICKET
+    return context
+
+
+class PooledConnection(http.client.HTTPSConnection):
+    """HTTPS connection that offers a cached TLS session when connecting"""
+
+    def __init__(self, host, pool, timeout):
+        super().__init__(host, timeout=timeout, context=pool.context)
+        self.pool = pool
+        self.pool_key = host
+        self.idle_since = None
+
+    def connect(self):
+        start = time.monotonic()
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        session = self.pool.get_session(self.pool_key)
+        try:
+            self.sock = self._context.wrap_socket(sock, server_hostname=self.host, session=session)
+        except Exception:
+            sock.close()
+            raise
+        self.pool.record_connect(self.pool_key, self.sock, time.monotonic() - start)
+
+
+class PooledResponse:
+    """Streaming response that owns its connection until closed"""
+
+    def __init__(self, pool, host, conn, response):
+        self.pool = pool
+        self.host = host
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def read1(self, amt=-1):
+        return self.response.read1(amt)
+
+    def close(self):
+        """Close the response; a fully read response returns its connection to the pool"""
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        self.pool.remember_session(self.host, conn)
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.host, conn)
+        else:
+            # Shut the socket down first so a reader blocked in another
+            # thread wakes up instead of waiting for the camera
+            if conn.sock is not None:
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.response.close()
+            conn.close()
+
+
+class CameraPool:
+    """Per-camera pool of idle keep-alive HTTPS connections"""
+
+    def __init__(self, context=None):
+        self.context = context or create_ssl_context()
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.sessions = {}
+        self.stats = {
+            'connections_created': 0,
+            'connections_reused': 0,
+            'tls_sessions_resumed': 0,
+            'stale_connections': 0,
+            'connect_seconds_total': 0.0,
+        }
+
+    def get_session(self, host):
+        with self.lock:
+            return self.sessions.get(host)
+
+    def record_connect(self, host, sock, seconds):
+        with self.lock:
+            self.stats['connections_created'] += 1
+            self.stats['connect_seconds_total'] += seconds
+            if sock.session_reused:
+                self.stats['tls_sessions_resumed'] += 1
+        metrics.camera_connect.observe(value=seconds)
+        logger.debug("%s: Connected in %.0fms (TLS resumed: %s)", host, seconds * 1000, sock.session_reused)
+
+    def remember_session(self, host, conn):
+        """Cache the connection's TLS session for resumption
+
+        Done once traffic has flowed, since TLS 1.3 session tickets arrive
+        after the handshake.
+        """
+        if conn.sock is None:
+            return
+        session = conn.sock.session
+        if session is not None and (session.has_ticket or conn.sock.version() != 'TLSv1.3'):
+            with self.lock:
+                self.sessions[host] = session
+
+    def acquire(self, host, timeout):
+        """Get an idle connection for host, or a new unconnected one
+
+        Returns (connection, reused).
+        """
+        now = time.monotonic()
+        with self.lock:
+            idle = self.idle.get(host, [])
+            while idle:
+                conn = idle.pop()
+                if now - conn.idle_since < IDLE_TIMEOUT:
+                    self.stats['connections_reused'] += 1
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+        return PooledConnection(host, self, timeout), False
+
+    def release(self, host, conn):
+        """Return a connection whose last response was fully read"""
+        conn.idle_since = time.monotonic()
+        with self.lock:
+            idle = self.idle.setdefault(host, [])
+            if len(idle) < MAX_IDLE_PER_HOST and conn.sock is not None:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, host, path, headers=None, timeout=10):
+        """Send a GET and return a PooledResponse, retrying once on a stale connection"""
+        while True:
+            conn, reused = self.acquire(host, timeout)
+            try:
+                conn.request('GET', path, headers=headers or {})
+                response = conn.getresponse()
+            except STALE_ERRORS:
+                conn.close()
+                if not reused:
+                    raise
+                with self.lock:
+                    self.stats['stale_connections'] += 1
+                continue
+            except Exception:
+                conn.close()
+                raise
+            return PooledResponse(self, host, conn, response)
+
+    def open_digest(self, host, uri, auth, timeout=10):
+        """Open uri with Digest auth, reusing the cached nonce when possible
+
+        A challenge is only fetched when none is cached or the camera
+        rejects the cached nonce; the 401 body is drained so the follow-up
+        request can reuse the same connection.
+        """
+        start = time.monotonic()
+        for attempt in range(2):
+            header = auth.authorization('GET', uri)
+            response = self.request(host, uri, {'Authorization': header} if header else {}, timeout)
+            if response.status == 200:
+                elapsed = time.monotonic() - start
+                result = 'cached_nonce' if header and attempt == 0 else 'challenge'
+                metrics.digest_auth.observe(result, value=elapsed)
+                logger.debug("%s: Digest auth took %.0fms (%s)", host, elapsed * 1000, result.replace('_', ' '))
+                return response
+            response.read()
+            response.close()
+            if response.status == 401 and attempt == 0:
+                if not auth.update_challenge(response.headers.get("WWW-Authenticate", "")):
+                    raise urllib.error.HTTPError(f"https://{host}{uri}", response.status,
+                                                 "No Digest challenge from camera", response.headers, None)
+                continue
+            raise urllib.error.HTTPError(f"https://{host}{uri}", response.status,
+                                         http.client.responses.get(response.status, ''),
+                                         response.headers, None)
+
+    def get_stats(self):
+        """Snapshot of pool counters plus idle connections per camera"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['idle_connections'] = {host: len(conns) for host, conns in self.idle.items() if conns}
+            stats['cached_tls_sessions'] = len(self.sessions)
+        return stats
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+def _collect_metrics():
+    stats = pool.get_stats()
+    counters = [
+        ('camera_pool_connections_created_total', 'connections_created', 'Camera connections opened'),
+        ('camera_pool_connections_reused_total', 'connections_reused', 'Requests served on a pooled connection'),
+        ('camera_pool_tls_sessions_resumed_total', 'tls_sessions_resumed', 'Connects that resumed a TLS session'),
+        ('camera_pool_stale_connections_total', 'stale_connections', 'Pooled connections found closed by the camera'),
+    ]
+    collected = [metrics.snapshot(metrics.Counter, name, doc, (), {(): stats[key]}) for name, key, doc in counters]
+    collected.append(metrics.snapshot(
+        metrics.Gauge, 'camera_pool_idle_connections', 'Idle pooled connections', ('host',),
+        {(host,): count for host, count in stats['idle_connections'].items()}))
+    return collected
+
+
+# Shared pool used by all camera requests
+pool = CameraPool()
+metrics.registry.add_collector(_collect_metrics)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Alarm clips cut from the live MPEG-TS ingest
+Every broadcaster keeps the last MPEGTS_HISTORY_SECONDS of its stream
+(keyframe aligned, bounded in memory; see PacketHistory in gop_cache.py).
+When an event at or above CLIP_MIN_PRIORITY (per priorities.json) arrives
+for a camera, the packets from CLIP_PRE_SECONDS before it until
+CLIP_POST_SECONDS after it are written to clips/<id>/<unix time>.ts as they
+are, without re-encoding. Further events during a clip extend it. A camera
+that was not being ingested is started for the clip, which then has no
+pre-event part. Clips are served at /clips/<id>/<ts>.ts and listed at
+/clips/ and /clips/<id>/.
+"""
+
+import os
+import time
+import logging
+import mimetypes
+import threading
+from pathlib import Path
+
+import mpegts_stream
+import quality
+import priorities
+import static_assets
+import workers
+from topology import topology
+
+logger = logging.getLogger(__name__)
+
+CLIPS_DIR = Path(os.environ.get('CLIPS_DIR', Path(__file__).parent / 'clips'))
+
+# Seconds of stream before and after the triggering event
+CLIP_PRE_SECONDS = float(os.environ.get('CLIP_PRE_SECONDS', '10'))
+CLIP_POST_SECONDS = float(os.environ.get('CLIP_POST_SECONDS', '20'))
+
+# Events keep extending a clip, but never past this length
+CLIP_MAX_SECONDS = float(os.environ.get('CLIP_MAX_SECONDS', '120'))
+
+# Only events at or above this priority trigger a clip
+CLIP_MIN_PRIORITY = os.environ.get('CLIP_MIN_PRIORITY', 'HIGH').upper()
+
+# Clips older than this are deleted
+CLIP_RETENTION_SECONDS = float(os.environ.get('CLIP_RETENTION_HOURS', '24')) * 3600
+
+# .ts is TypeScript / Qt Linguist in the default table
+mimetypes.add_type('video/mp2t', '.ts')
+
+
+class Clip:
+    """One clip being recorded"""
+
+    def __init__(self, cam_id, now):
+        self.cam_id = cam_id
+        self.timestamp = int(time.time())
+        self.started = now
+        self.end = now + CLIP_POST_SECONDS
+        self.bytes = 0
+        self.events = 1
+
+    @property
+    def path(self):
+        return CLIPS_DIR / str(self.cam_id) / f'{self.timestamp}.ts'
+
+    def extend(self, now):
+        self.end = min(now + CLIP_POST_SECONDS, self.started + CLIP_MAX_SECONDS)
+        self.events += 1
+
+
+class ClipRecorder:
+    """Records a clip per camera from the events the SSE hub delivers"""
+
+    def __init__(self, username, password, min_priority=CLIP_MIN_PRIORITY):
+        self.username = username
+        self.password = password
+        self.min_level = priorities.PRIORITY_LEVELS.get(min_priority, priorities.PRIORITY_LEVELS['HIGH'])
+        self.lock = threading.Lock()
+        # {cam_id: Clip} for clips being recorded
+        self.recording = {}
+        self.stats = {'clips_written': 0, 'clips_empty': 0, 'events': 0}
+
+    def on_events(self, events):
+        """SSE hub listener"""
+        for event in events:
+            # With --workers, the worker ingesting the camera records its clips
+            if event.camera is None or not workers.owns(event.camera):
+                continue
+            if priorities.PRIORITY_LEVELS.get(event.priority, 0) < self.min_level:
+                continue
+            self.trigger(event.camera)
+
+    def trigger(self, cam_id):
+        """Start a clip for a camera, or extend the one being recorded"""
+        now = time.monotonic()
+        with self.lock:
+            self.stats['events'] += 1
+            clip = self.recording.get(cam_id)
+            if clip is not None:
+                clip.extend(now)
+                return clip
+            clip = self.recording[cam_id] = Clip(cam_id, now)
+        thread = threading.Thread(target=self._record, args=(clip,), name=f'clip-{cam_id}', daemon=True)
+        thread.start()
+        return clip
+
+    def _record(self, clip):
+        # Take the history from whichever tier is already running
+        tier = mpegts_stream.running_tier(clip.cam_id) or quality.DEFAULT_TIER
+        broadcaster, subscriber = mpegts_stream.subscribe(
+            clip.cam_id, self.username, self.password, tier, history=CLIP_PRE_SECONDS)
+        path = clip.path
+        partial = path.with_name(path.name + '.part')
+        logger.info("Camera %s: Recording clip %s (%s stream)", clip.cam_id, path.name, tier)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(partial, 'wb') as f:
+                while True:
+                    remaining = clip.end - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    chunks = subscriber.get_chunks(timeout=min(remaining, 1.0), coalesce=False)
+                    if chunks is None:
+                        # Ingest ended; keep what was recorded
+                        break
+                    f.writelines(chunks)
+                    clip.bytes += sum(len(chunk) for chunk in chunks)
+            if clip.bytes:
+                os.replace(partial, path)
+                logger.info("Camera %s: Clip %s written (%s bytes, %s events)",
+                            clip.cam_id, path.name, clip.bytes, clip.events)
+            else:
+                partial.unlink()
+                logger.warning("Camera %s: No stream data for clip %s", clip.cam_id, path.name)
+        except OSError as e:
+            logger.error("Camera %s: Cannot write clip %s: %s", clip.cam_id, path.name, e)
+        finally:
+            broadcaster.unsubscribe(subscriber)
+            with self.lock:
+                if self.recording.get(clip.cam_id) is clip:
+                    del self.recording[clip.cam_id]
+                self.stats['clips_written' if clip.bytes else 'clips_empty'] += 1
+        expire_clips()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['recording'] = sorted(self.recording)
+            return stats
+
+
+def expire_clips(now=None):
+    """Delete clips older than CLIP_RETENTION_SECONDS"""
+    now = time.time() if now is None else now
+    for path in CLIPS_DIR.glob('*/*.ts'):
+        try:
+            if now - path.stat().st_mtime > CLIP_RETENTION_SECONDS:
+                path.unlink()
+        except OSError:
+            pass
+
+
+def list_clips(cam_id=None):
+    """{camera: [clip URL, ...]} newest first, for /clips/ and /clips/<id>/"""
+    cameras = {}
+    pattern = f'{cam_id}/*.ts' if cam_id is not None else '*/*.ts'
+    for path in CLIPS_DIR.glob(pattern):
+        cameras.setdefault(path.parent.name, []).append(path.stem)
+    return {cam: [f'/clips/{cam}/{stamp}.ts' for stamp in sorted(stamps, reverse=True)]
+            for cam, stamps in sorted(cameras.items())}
+
+
+def _camera(name):
+    """Configured camera id from a clip path segment; raises LookupError"""
+    try:
+        cam_id = int(name)
+    except ValueError:
+        cam_id = None
+    if cam_id not in topology.cameras():
+        raise LookupError(f"Unknown camera {name}")
+    return cam_id
+
+
+def resolve(url_path):
+    """Clip file for /clips/<id>/<ts>.ts, or None for a listing request
+
+    Returns (file path, None) or (None, cam_id or None). Raises LookupError
+    for an unknown camera and ValueError for any other bad path.
+    """
+    parts = [part for part in url_path.split('?', 1)[0].split('/') if part][1:]
+    if len(parts) == 2 and parts[1].endswith('.ts'):
+        cam_id = _camera(parts[0])
+        return static_assets.translate_path(f'{cam_id}/{parts[1]}', CLIPS_DIR), None
+    if len(parts) == 1:
+        return None, _camera(parts[0])
+    if not parts:
+        return None, None
+    raise ValueError(f"Unknown clip path: {url_path}")
+
+
+# Active recorder once start() has been called
+recorder = None
+
+
+def start(hub, username, password):
+    """Record clips from hub events; does nothing without a camera password"""
+    global recorder
+    if not password or CLIP_POST_SECONDS <= 0:
+        return None
+    recorder = ClipRecorder(username, password)
+    hub.add_listener(recorder.on_events)
+    hub.start()
+    logger.info("Recording %.0fs+%.0fs clips of %s events to %s",
+                CLIP_PRE_SECONDS, CLIP_POST_SECONDS, CLIP_MIN_PRIORITY, CLIPS_DIR)
+    return recorder
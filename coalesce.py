@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Event coalescing and rate limiting for the SSE hub
+Duplicate (camera, event_type) events inside a debounce window are dropped,
+bursts arriving within a short batch window are delivered together as one
+"batch" SSE message, and per-camera event rates are tracked so event storms
+are visible.
+"""
+
+import os
+import math
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Seconds during which repeats of the same (camera, event_type) are dropped (0 disables)
+DEBOUNCE_WINDOW = float(os.environ.get('SSE_DEBOUNCE_WINDOW', '1.0'))
+
+# Seconds to collect a burst before sending it as one message (0 disables)
+BATCH_WINDOW = float(os.environ.get('SSE_BATCH_WINDOW', '0.1'))
+
+# Time constant of the per-camera events/sec moving average
+RATE_TIME_CONSTANT = 10.0
+
+
+class EventRate:
+    """Exponentially decaying events/sec estimate for one camera"""
+
+    def __init__(self):
+        self.total = 0
+        self.suppressed = 0
+        self.rate = 0.0
+        self.last = None
+
+    def add(self, now):
+        if self.last is not None:
+            self.rate *= math.exp(-(now - self.last) / RATE_TIME_CONSTANT)
+        self.rate += 1.0 / RATE_TIME_CONSTANT
+        self.last = now
+        self.total += 1
+
+    def current(self, now):
+        if self.last is None:
+            return 0.0
+        return self.rate * math.exp(-(now - self.last) / RATE_TIME_CONSTANT)
+
+
+def encode_batch(events):
+    """Encode several annotated camera events as one "batch" SSE message"""
+    lines = []
+    ids = [event.id for event in events if event.id is not None]
+    if ids:
+        lines.append(f'id: {ids[-1]}')
+    lines.append('event: batch')
+    lines.append('data: [' + ','.join(event.data for event in events) + ']')
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+class EventCoalescer:
+    """Debounces and batches events before handing them to deliver(events)"""
+
+    def __init__(self, deliver, debounce_window=DEBOUNCE_WINDOW, batch_window=BATCH_WINDOW):
+        self.deliver = deliver
+        self.debounce_window = debounce_window
+        self.batch_window = batch_window
+        self.cond = threading.Condition()
+        self.last_delivered = {}
+        self.pending = []
+        self.flush_deadline = None
+        self.rates = {}
+        self.suppressed = 0
+        self.thread = None
+
+    def add(self, event):
+        now = time.monotonic()
+        with self.cond:
+            if event.camera is not None:
+                rate = self.rates.get(event.camera)
+                if rate is None:
+                    rate = self.rates[event.camera] = EventRate()
+                rate.add(now)
+
+                if self.debounce_window > 0:
+                    key = (event.camera, event.event_type)
+                    last = self.last_delivered.get(key)
+                    if last is not None and now - last < self.debounce_window:
+                        # Same event from the same camera again: drop it
+                        rate.suppressed += 1
+                        self.suppressed += 1
+                        return
+                    self.last_delivered[key] = now
+
+            if self.batch_window <= 0:
+                batch = [event]
+            else:
+                batch = None
+                self.pending.append(event)
+                if self.flush_deadline is None:
+                    self.flush_deadline = now + self.batch_window
+                    if self.thread is None:
+                        self.thread = threading.Thread(target=self._run, name='sse-coalesce', daemon=True)
+                        self.thread.start()
+                    self.cond.notify()
+        if batch:
+            self.deliver(batch)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.flush_deadline is None:
+                    self.cond.wait()
+                delay = self.flush_deadline - time.monotonic()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                batch, self.pending = self.pending, []
+                self.flush_deadline = None
+            try:
+                self.deliver(batch)
+            except Exception:
+                logger.exception("Error delivering coalesced events")
+
+    def get_stats(self):
+        """Per-camera totals, suppressed counts and current events/sec"""
+        now = time.monotonic()
+        with self.cond:
+            cameras = {
+                cam_id: {
+                    'events_total': rate.total,
+                    'events_suppressed': rate.suppressed,
+                    'events_per_second': round(rate.current(now), 3),
+                }
+                for cam_id, rate in sorted(self.rates.items())
+            }
+            return {
+                'debounce_window': self.debounce_window,
+                'batch_window': self.batch_window,
+                'events_suppressed': self.suppressed,
+                'cameras': cameras,
+            }
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+HTTP Digest authentication client for the cameras (RFC 7616)
+Hashes with hashlib's C MD5 when available (falling back to the pure-Python
+md5.hash), caches HA1 per (user, realm) and remembers each camera's nonce so
+reconnects can send credentials on the first request, incrementing nc,
+instead of paying an extra 401 round trip (see CameraPool.open_digest).
+"""
+
+import re
+import hashlib
+import logging
+import secrets
+import threading
+
+import md5
+
+logger = logging.getLogger(__name__)
+
+
+def _hashlib_md5(data):
+    try:
+        return hashlib.md5(data, usedforsecurity=False).hexdigest()
+    except TypeError:
+        # Python < 3.9 has no usedforsecurity argument
+        return hashlib.md5(data).hexdigest()
+
+
+def _select_md5():
+    """Pick the C MD5 if it works and agrees with the reference implementation"""
+    try:
+        if _hashlib_md5(b'abc') == md5.hash(b'abc'):
+            return _hashlib_md5
+        logger.warning("hashlib MD5 disagrees with md5.hash, using pure-Python MD5")
+    except ValueError:
+        # MD5 disabled by the OpenSSL policy (FIPS mode)
+        logger.warning("hashlib MD5 unavailable, using pure-Python MD5")
+    return md5.hash
+
+
+_md5 = _select_md5()
+
+
+def H(value):
+    """MD5 hex digest of a string"""
+    return _md5(value.encode('utf-8'))
+
+
+def verify(value):
+    """Check that the active MD5 matches the pure-Python reference for value"""
+    return H(value) == md5.hash(value)
+
+
+# HA1 cache: {(username, realm): (password, HA1)}
+_ha1_cache = {}
+_ha1_lock = threading.Lock()
+
+
+def get_ha1(username, realm, password):
+    """Return H(username:realm:password), computing it once per (user, realm)"""
+    key = (username, realm)
+    with _ha1_lock:
+        cached = _ha1_cache.get(key)
+        if cached is not None and cached[0] == password:
+            return cached[1]
+    ha1 = H(f"{username}:{realm}:{password}")
+    with _ha1_lock:
+        _ha1_cache[key] = (password, ha1)
+    return ha1
+
+
+def parse_challenge(header):
+    """Parse a WWW-Authenticate Digest header into a dict, or None"""
+    if not header or not header.lower().startswith('digest'):
+        return None
+    params = {}
+    for key, quoted, bare in re.findall(r'(\w+)=(?:"([^"]*)"|([^\s,]+))', header[6:]):
+        params[key.lower()] = quoted if quoted else bare
+    if 'nonce' not in params:
+        return None
+    return params
+
+
+class DigestAuth:
+    """Digest credentials and nonce state for one camera"""
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.challenge = None
+        self.nc = 0
+        self.lock = threading.Lock()
+
+    def update_challenge(self, header):
+        """Store a fresh challenge from a 401 response; False if not Digest"""
+        challenge = parse_challenge(header)
+        if challenge is None:
+            return False
+        with self.lock:
+            self.challenge = challenge
+            self.nc = 0
+        return True
+
+    def reset(self):
+        """Forget the cached nonce, e.g. after it was rejected"""
+        with self.lock:
+            self.challenge = None
+            self.nc = 0
+
+    def authorization(self, method, uri):
+        """Build an Authorization header from the cached challenge
+
+        Returns None when no challenge has been seen yet.
+        """
+        with self.lock:
+            challenge = self.challenge
+            if challenge is None:
+                return None
+            self.nc += 1
+            nc = f"{self.nc:08x}"
+
+        realm = challenge.get('realm', '')
+        nonce = challenge['nonce']
+        opaque = challenge.get('opaque')
+        algorithm = challenge.get('algorithm', 'MD5')
+        # The server may offer several qop values, e.g. "auth,auth-int"
+        qop = 'auth' if 'qop' not in challenge or 'auth' in challenge['qop'].split(',') else None
+        cnonce = secrets.token_hex(16)
+
+        HA1 = get_ha1(self.username, realm, self.password)
+        if algorithm.lower() == 'md5-sess':
+            HA1 = H(f"{HA1}:{nonce}:{cnonce}")
+        HA2 = H(f"{method}:{uri}")
+        if qop:
+            response = H(f"{HA1}:{nonce}:{nc}:{cnonce}:{qop}:{HA2}")
+        else:
+            response = H(f"{HA1}:{nonce}:{HA2}")
+
+        # Construct Authorization header
+        auth = (
+            f'Digest username="{self.username}", realm="{realm}", nonce="{nonce}", '
+            f'uri="{uri}", algorithm={algorithm}, response="{response}"'
+        )
+        if qop:
+            auth += f', qop={qop}, nc={nc}, cnonce="{cnonce}"'
+        if opaque:
+            auth += f', opaque="{opaque}"'
+        return auth
+
+
+# Per-camera auth state: {host: DigestAuth}
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_auth(host, username, password):
+    """Get the shared DigestAuth for a camera host"""
+    with _clients_lock:
+        auth = _clients.get(host)
+        if auth is None or auth.username != username or auth.password != password:
+            auth = DigestAuth(username, password)
+            _clients[host] = auth
+        return auth
+
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Egress bandwidth scheduler
+Every streaming writer (MJPEG, MPEG-TS and SSE, threaded or asyncio) asks
+for permission before it sends. With an egress budget configured
+("egress_budget_kbps" in the topology section of priorities.json, or
+EGRESS_BUDGET_KBPS) one dispatcher thread hands out the bytes at that rate
+in weighted fair queuing order (self-clocked: each send is tagged with its
+flow's virtual finish time and the smallest tag goes next), so a camera
+viewer's share of a congested uplink follows its weight:
+
+    camera in a display's active slot   16
+    camera with a recent HIGH event      8  (MEDIUM 4, LOW 2)
+    any other camera                     1
+
+Video that cannot be sent within EGRESS_MAX_DELAY is dropped rather than
+sent late: an MJPEG viewer skips to a newer frame, an MPEG-TS viewer to the
+next keyframe. SSE is small and goes out straight away, ahead of all
+video; its bytes are taken from the budget all the same. Without a budget writers go straight
+through and only the per-flow byte counts are kept. With --workers each
+worker gets an equal part of the budget.
+"""
+
+import os
+import time
+import heapq
+import asyncio
+import logging
+import threading
+import itertools
+
+import metrics
+import priorities
+import quality
+import workers
+from topology import topology
+
+logger = logging.getLogger(__name__)
+
+SSE = 'sse'
+MJPEG = 'mjpeg'
+TS = 'ts'
+
+# Camera flow weights; a camera takes the highest that applies
+WEIGHT_ACTIVE = 16
+WEIGHT_EVENT = {'HIGH': 8, 'MEDIUM': 4, 'LOW': 2}
+WEIGHT_IDLE = 1
+
+# Seconds an event keeps raising its camera's weight
+ACTIVITY_SECONDS = float(os.environ.get('EGRESS_ACTIVITY_SECONDS', '30'))
+
+# Video not sent within this many seconds of being ready is dropped
+MAX_DELAY = float(os.environ.get('EGRESS_MAX_DELAY', '1.0'))
+
+# Bytes that may go out at once after an idle spell, in seconds of budget
+BURST_SECONDS = 0.1
+
+# Seconds between re-reading the budget and re-weighting the flows
+REFRESH_INTERVAL = 1.0
+
+
+class _Request:
+    """One pending send of size bytes; resolve(granted) is called exactly once"""
+
+    def __init__(self, flow, size, droppable, resolve):
+        self.flow = flow
+        self.size = size
+        self.deadline = time.monotonic() + MAX_DELAY if droppable else None
+        self.resolve = resolve
+        self.start = 0.0
+        self.cancelled = False
+
+
+class Flow:
+    """A client connection's share of the egress budget"""
+
+    def __init__(self, scheduler, kind, cam_id=None):
+        self.scheduler = scheduler
+        self.kind = kind
+        self.cam_id = cam_id
+        self.weight = scheduler.weight_for(kind, cam_id)
+        # Virtual finish time of the flow's last queued send
+        self.finish = 0.0
+        # Virtual start time of a dropped send, kept for the next one
+        self.resume = None
+        self.sent = 0
+        self.dropped = 0
+        self.waited = 0.0
+
+    def acquire(self, size, droppable=True):
+        """Block until size bytes may be sent; False if they are to be dropped instead"""
+        if not self.scheduler.rate or self.kind == SSE:
+            self.scheduler.charge(self, size)
+            return True
+        done = threading.Event()
+        result = []
+
+        def resolve(granted):
+            result.append(granted)
+            done.set()
+
+        started = time.monotonic()
+        self.scheduler.submit(_Request(self, size, droppable, resolve))
+        done.wait()
+        self.waited += time.monotonic() - started
+        return result[0]
+
+    async def acquire_async(self, size, droppable=True):
+        """acquire() for the asyncio server"""
+        if not self.scheduler.rate or self.kind == SSE:
+            self.scheduler.charge(self, size)
+            return True
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def set_result(granted):
+            if not future.done():
+                future.set_result(granted)
+
+        request = _Request(self, size, droppable,
+                           lambda granted: loop.call_soon_threadsafe(set_result, granted))
+        started = time.monotonic()
+        self.scheduler.submit(request)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            request.cancelled = True
+            raise
+        finally:
+            self.waited += time.monotonic() - started
+
+    def close(self):
+        self.scheduler.close(self)
+
+
+class EgressScheduler:
+    """Shapes all streaming output to the egress budget by weighted fair queuing"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        # Heap of (virtual finish time, sequence, request)
+        self.queue = []
+        self.sequence = itertools.count()
+        self.virtual_time = 0.0
+        # Bytes per second, 0 for unlimited
+        self.rate = 0.0
+        self.tokens = 0.0
+        self.refilled = time.monotonic()
+        self.last_refresh = self.refilled
+        self.flows = set()
+        # {cam_id: (monotonic time of the last event, highest recent priority)}
+        self.activity = {}
+        self.thread = None
+        self.stats = {'granted_bytes': 0, 'dropped': {MJPEG: 0, TS: 0}, 'closed_flows': 0}
+
+    def start(self):
+        with self.cond:
+            if self.thread is None:
+                self._refresh()
+                self.thread = threading.Thread(target=self._run, name='egress', daemon=True)
+                self.thread.start()
+
+    def budget_kbps(self):
+        return topology.egress_budget_kbps() / workers.count
+
+    # -- flows --
+
+    def open(self, kind, cam_id=None):
+        flow = Flow(self, kind, cam_id)
+        with self.cond:
+            self.flows.add(flow)
+        return flow
+
+    def close(self, flow):
+        with self.cond:
+            if flow in self.flows:
+                self.flows.discard(flow)
+                self.stats['closed_flows'] += 1
+
+    def on_events(self, events):
+        """SSE hub listener: recent events raise their camera's weight"""
+        now = time.monotonic()
+        with self.cond:
+            for event in events:
+                if event.camera is None:
+                    continue
+                priority = event.priority if event.priority in WEIGHT_EVENT else priorities.DEFAULT_PRIORITY
+                previous = self.activity.get(event.camera)
+                if previous is not None and now - previous[0] < ACTIVITY_SECONDS and \
+                        priorities.PRIORITY_LEVELS[previous[1]] > priorities.PRIORITY_LEVELS[priority]:
+                    priority = previous[1]
+                self.activity[event.camera] = (now, priority)
+
+    def weight_for(self, kind, cam_id, active=None):
+        if kind == SSE:
+            return 0
+        if active is None:
+            active = quality.policy.active_cameras()
+        if cam_id in active:
+            return WEIGHT_ACTIVE
+        recent = self.activity.get(cam_id)
+        if recent is not None and time.monotonic() - recent[0] < ACTIVITY_SECONDS:
+            return WEIGHT_EVENT[recent[1]]
+        return WEIGHT_IDLE
+
+    # -- dispatching --
+
+    def charge(self, flow, size):
+        """Account for size bytes sent by flow without waiting"""
+        flow.sent += size
+        if self.rate and flow.kind == SSE:
+            with self.cond:
+                self.tokens -= size
+                self.stats['granted_bytes'] += size
+
+    def submit(self, request):
+        flow = request.flow
+        with self.cond:
+            if flow.resume is not None:
+                request.start = flow.resume
+                flow.resume = None
+            else:
+                request.start = max(self.virtual_time, flow.finish)
+            flow.finish = request.start + request.size / flow.weight
+            heapq.heappush(self.queue, (flow.finish, next(self.sequence), request))
+            self.cond.notify()
+
+    def _refresh(self):
+        """Re-read the budget and re-weight every flow (caller holds self.cond)"""
+        rate = self.budget_kbps() * 1000 / 8
+        if rate != self.rate:
+            logger.info("Egress budget %s", f"{rate * 8 / 1000:.0f} kbps" if rate else "unlimited")
+            self.rate = rate
+            self.tokens = min(self.tokens, rate * BURST_SECONDS)
+        now = time.monotonic()
+        self.activity = {cam_id: recent for cam_id, recent in self.activity.items()
+                         if now - recent[0] < ACTIVITY_SECONDS}
+        active = quality.policy.active_cameras()
+        for flow in self.flows:
+            flow.weight = self.weight_for(flow.kind, flow.cam_id, active)
+
+    def _expire(self, now):
+        """Take droppable requests past their deadline off the queue (caller holds self.cond)"""
+        expired = [entry for entry in self.queue
+                   if entry[2].cancelled or (entry[2].deadline is not None and entry[2].deadline <= now)]
+        if not expired:
+            return []
+        sequences = {entry[1] for entry in expired}
+        self.queue = [entry for entry in self.queue if entry[1] not in sequences]
+        heapq.heapify(self.queue)
+        dropped = []
+        for _, _, request in expired:
+            flow = request.flow
+            # The next send keeps the dropped one's place in line, so a frame
+            # larger than the flow's share per MAX_DELAY still gets its turn
+            flow.resume = request.start
+            if not request.cancelled:
+                flow.dropped += 1
+                self.stats['dropped'][flow.kind] = self.stats['dropped'].get(flow.kind, 0) + 1
+                dropped.append(request)
+        return dropped
+
+    def _next(self):
+        """Wait for the next request to resolve; returns [(request, granted)]"""
+        with self.cond:
+            now = time.monotonic()
+            if now - self.last_refresh >= REFRESH_INTERVAL:
+                self.last_refresh = now
+                self._refresh()
+            resolved = [(request, False) for request in self._expire(now)]
+            if resolved:
+                return resolved
+            if not self.queue:
+                self.cond.wait(REFRESH_INTERVAL)
+                return []
+            burst = self.rate * BURST_SECONDS
+            if self.rate:
+                self.tokens = min(self.tokens + (now - self.refilled) * self.rate, burst)
+            self.refilled = now
+            finish, _, request = self.queue[0]
+            # Sends larger than the burst go out once the bucket is full
+            needed = min(request.size, burst)
+            if self.rate and self.tokens < needed:
+                wait = (needed - self.tokens) / self.rate
+                deadlines = [entry[2].deadline for entry in self.queue if entry[2].deadline is not None]
+                if deadlines:
+                    wait = min(wait, max(min(deadlines) - now, 0))
+                # A send with a smaller tag arriving meanwhile goes first
+                self.cond.wait(min(wait, REFRESH_INTERVAL))
+                return []
+            heapq.heappop(self.queue)
+            self.tokens -= request.size
+            self.virtual_time = finish
+            request.flow.sent += request.size
+            self.stats['granted_bytes'] += request.size
+            return [(request, True)]
+
+    def _run(self):
+        while True:
+            try:
+                resolved = self._next()
+            except Exception:
+                logger.exception("Egress scheduling failed")
+                with self.cond:
+                    # Never leave a writer waiting
+                    resolved = [(request, True) for _, _, request in self.queue]
+                    self.queue = []
+                time.sleep(REFRESH_INTERVAL)
+            for request, granted in resolved:
+                request.resolve(granted)
+
+    def get_stats(self):
+        with self.cond:
+            flows = sorted(self.flows, key=lambda flow: (flow.kind, flow.cam_id or 0))
+            return {
+                'budget_kbps': round(self.rate * 8 / 1000),
+                'queued': len(self.queue),
+                'granted_bytes': self.stats['granted_bytes'],
+                'dropped': dict(self.stats['dropped']),
+                'closed_flows': self.stats['closed_flows'],
+                'active_events': {str(cam_id): priority for cam_id, (_, priority) in sorted(self.activity.items())},
+                'flows': [{
+                    'kind': flow.kind,
+                    'camera': flow.cam_id,
+                    'weight': flow.weight,
+                    'sent': flow.sent,
+                    'dropped': flow.dropped,
+                    'waited_seconds': round(flow.waited, 3),
+                } for flow in flows],
+            }
+
+
+def _collect_metrics():
+    with scheduler.cond:
+        dropped = dict(scheduler.stats['dropped'])
+        queued = len(scheduler.queue)
+        rate = scheduler.rate
+    return [
+        metrics.snapshot(metrics.Counter, 'egress_dropped_total',
+                         'Video sends dropped for missing their egress deadline', ('format',),
+                         {(kind,): count for kind, count in dropped.items()}),
+        metrics.snapshot(metrics.Gauge, 'egress_queued_sends', 'Sends waiting for egress budget', (),
+                         {(): queued}),
+        metrics.snapshot(metrics.Gauge, 'egress_budget_bytes_per_second', 'Egress budget (0 is unlimited)', (),
+                         {(): rate}),
+    ]
+
+
+# Shared scheduler for every port
+scheduler = EgressScheduler()
+metrics.registry.add_collector(_collect_metrics)
+
+
+def start(hub):
+    """Start the dispatcher and follow event activity from hub"""
+    scheduler.start()
+    hub.add_listener(scheduler.on_events)
+    hub.start()
+    return scheduler
@@ -2,30 +2,55 @@ let priorityMap=new Map();
 let eventSource=null;
 
 function getRandomCamera(){
-    const available=Array.from({length:26},(_,i)=>i+1).filter(c=>!active.includes(c));
-    return available.length?available[Math.floor(Math.random()*available.length)]:Math.floor(Math.random()*26)+1;
+    const available=workingCameras.filter(c=>!active.includes(c));
+    const pool=available.length?available:workingCameras;
+    return pool[Math.floor(Math.random()*pool.length)];
+}
+
+function handleEventData(data){
+    const camNum=data.camera?parseInt(data.camera):getRandomCamera();
+    const eventType=data.event_type||'unknown';
+    if(!camNum||isNaN(camNum))return;
+    // Prefer the priority resolved by the proxy from priorities.json
+    if(data.priority)priorityMap.set(`${camNum}-${eventType}`,data.priority.toLowerCase());
+    
+    // Log IP address if available in event data
+    const ip = data.ip || data.source_ip || data.camera_ip || data.sender_ip || data.client_ip || 
+               data.remote_addr || data.remote_address || data.remote_ip || data.request_ip ||
+               'unknown';
+    console.log(`Event received - Camera: ${camNum}, Event Type: ${eventType}, IP: ${ip}`);
+    
+    // With a server-side layout the proxy decides what is shown
+    if(!serverLayout)onCameraActivate(camNum,eventType);
 }
 
 function initEventSource(){
-    eventSource=new EventSource('/api/v1/subscribe');
+    eventSource=new EventSource('/api/v1/subscribe?layout=1');
     eventSource.onmessage=(event)=>{
         try{
-            const data=JSON.parse(event.data);
-            const camNum=data.camera?parseInt(data.camera):getRandomCamera();
-            const eventType=data.event_type||'unknown';
-            if(!camNum||isNaN(camNum))return;
-            
-            // Log IP address if available in event data
-            const ip = data.ip || data.source_ip || data.camera_ip || data.sender_ip || data.client_ip || 
-                       data.remote_addr || data.remote_address || data.remote_ip || data.request_ip ||
-                       'unknown';
-            console.log(`Event received - Camera: ${camNum}, Event Type: ${eventType}, IP: ${ip}`);
-            
-            onCameraActivate(camNum,eventType);
+            handleEventData(JSON.parse(event.data));
         }catch(e){
             // Silently ignore parsing errors
         }
     };
+    // Bursts coalesced by the proxy arrive as one message holding an array
+    eventSource.addEventListener('batch',(event)=>{
+        try{
+            for(const data of JSON.parse(event.data)){
+                handleEventData(data);
+            }
+        }catch(e){
+            // Silently ignore parsing errors
+        }
+    });
+    // Tile changes from the server-side layout
+    eventSource.addEventListener('layout',(event)=>{
+        try{
+            applyLayout(JSON.parse(event.data));
+        }catch(e){
+            // Silently ignore parsing errors
+        }
+    });
     eventSource.onerror=(err)=>{
         // Silently handle errors
     };
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+FFmpeg process supervisor
+Owns every FFmpeg child the proxy starts: drains each one's stderr on a
+helper thread into a bounded per-camera log ring (so a chatty stream can
+never fill the pipe and stall FFmpeg), runs a byte-rate watchdog that kills
+processes that stop producing output, computes restart backoff, remembers
+which RTSP path last worked for each camera, and kills whatever is still
+running when the proxy exits.
+"""
+
+import os
+import time
+import atexit
+import signal
+import logging
+import threading
+import subprocess
+import collections
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# stderr lines kept per camera
+STDERR_LINES = int(os.environ.get('FFMPEG_STDERR_LINES', '50'))
+STDERR_LINE_MAX = 1024
+
+# A process that produced no output for this many seconds is considered
+# stalled and killed; the first output may take STARTUP_TIMEOUT (RTSP setup)
+STALL_TIMEOUT = float(os.environ.get('FFMPEG_STALL_TIMEOUT', '10'))
+STARTUP_TIMEOUT = float(os.environ.get('FFMPEG_STARTUP_TIMEOUT', '20'))
+
+# Restart backoff bounds in seconds; a process that ran this long resets it
+RESTART_MIN_DELAY = 1
+RESTART_MAX_DELAY = 30
+HEALTHY_RUN_SECONDS = 60
+
+# Consecutive failed starts (no output at all) before a camera is given up on
+MAX_FAILED_STARTS = int(os.environ.get('FFMPEG_MAX_FAILED_STARTS', '5'))
+
+# Seconds between watchdog checks
+WATCHDOG_INTERVAL = 1.0
+
+
+class FFmpegProcess:
+    """One supervised FFmpeg child and its health counters"""
+
+    def __init__(self, cam_id, popen, camera_ring):
+        self.cam_id = cam_id
+        self.popen = popen
+        self.pid = popen.pid
+        self.stdout = popen.stdout
+        # This process's stderr, and the camera's ring shared across restarts
+        self.stderr_lines = collections.deque(maxlen=STDERR_LINES)
+        self.camera_ring = camera_ring
+        self.stderr_thread = None
+        self.started = time.monotonic()
+        self.last_output = None
+        self.bytes_read = 0
+        self.stalled = False
+
+    def record_output(self, nbytes):
+        """Called by the reader for every chunk taken from stdout"""
+        self.bytes_read += nbytes
+        self.last_output = time.monotonic()
+
+    def idle_seconds(self, now):
+        if self.last_output is None:
+            return now - self.started
+        return now - self.last_output
+
+    @property
+    def returncode(self):
+        return self.popen.returncode
+
+    def stderr_tail(self, timeout=1.0):
+        """stderr of this process, waiting briefly for the drain to finish"""
+        if self.stderr_thread is not None:
+            self.stderr_thread.join(timeout)
+        return '\n'.join(self.stderr_lines)
+
+
+def _drain_stderr(process):
+    """Read FFmpeg's stderr line by line into its ring until EOF"""
+    try:
+        # Bounded readline so one endless line cannot grow without limit
+        for line in iter(lambda: process.popen.stderr.readline(STDERR_LINE_MAX), b''):
+            line = line.decode('utf-8', errors='replace').rstrip()
+            if line:
+                process.stderr_lines.append(line)
+                process.camera_ring.append(line)
+                logger.debug("Camera %s: ffmpeg: %s", process.cam_id, line)
+    except (OSError, ValueError):
+        pass
+    finally:
+        try:
+            process.popen.stderr.close()
+        except OSError:
+            pass
+
+
+class Supervisor:
+    """Registry of running FFmpeg processes with watchdog and restart policy"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = {}
+        self.stderr_rings = {}
+        self.preferred_paths = {}
+        self.watchdog = None
+        self.stats = {
+            'processes_started': 0,
+            'processes_exited': 0,
+            'stalls_detected': 0,
+            'start_failures': 0,
+        }
+
+    def spawn(self, cam_id, cmd):
+        """Start FFmpeg for a camera; returns an FFmpegProcess
+
+        The child gets its own session so terminate() can signal its whole
+        process group, and its stderr is drained in the background.
+        """
+        try:
+            popen = subprocess.Popen(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                bufsize=0,  # Unbuffered for minimal latency
+                start_new_session=True,
+            )
+        except Exception:
+            with self.lock:
+                self.stats['start_failures'] += 1
+            raise
+
+        with self.lock:
+            ring = self.stderr_rings.get(cam_id)
+            if ring is None:
+                ring = self.stderr_rings[cam_id] = collections.deque(maxlen=STDERR_LINES)
+            process = FFmpegProcess(cam_id, popen, ring)
+            self.processes[popen.pid] = process
+            self.stats['processes_started'] += 1
+            if self.watchdog is None:
+                self.watchdog = threading.Thread(target=self._run_watchdog, name='ffmpeg-watchdog', daemon=True)
+                self.watchdog.start()
+        metrics.ffmpeg_starts.inc(cam_id)
+
+        process.stderr_thread = threading.Thread(
+            target=_drain_stderr, args=(process,), name=f'ffmpeg-stderr-{cam_id}', daemon=True
+        )
+        process.stderr_thread.start()
+        return process
+
+    def terminate(self, process):
+        """Stop a process (SIGTERM, then SIGKILL) and forget it"""
+        _terminate(process.popen)
+        with self.lock:
+            if self.processes.pop(process.pid, None) is not None:
+                self.stats['processes_exited'] += 1
+
+    def shutdown(self):
+        """Kill every FFmpeg still running; registered with atexit"""
+        with self.lock:
+            processes = list(self.processes.values())
+        if processes:
+            logger.info("Stopping %s FFmpeg processes", len(processes))
+        for process in processes:
+            self.terminate(process)
+
+    def _run_watchdog(self):
+        """Kill processes whose output stopped; their reader then sees EOF"""
+        while True:
+            time.sleep(WATCHDOG_INTERVAL)
+            now = time.monotonic()
+            with self.lock:
+                processes = list(self.processes.values())
+            for process in processes:
+                if process.stalled or process.popen.poll() is not None:
+                    continue
+                limit = STARTUP_TIMEOUT if process.last_output is None else STALL_TIMEOUT
+                idle = process.idle_seconds(now)
+                if idle < limit:
+                    continue
+                process.stalled = True
+                with self.lock:
+                    self.stats['stalls_detected'] += 1
+                metrics.ffmpeg_stalls.inc(process.cam_id)
+                logger.warning("Camera %s: FFmpeg (PID %s) produced no output for %.0fs, killing it",
+                               process.cam_id, process.pid, idle)
+                _kill_group(process.popen)
+
+    def ordered_paths(self, stream, paths):
+        """RTSP paths to try, the one that last worked for this stream first
+
+        stream names one camera stream, e.g. "3/sub" for camera 3's sub tier.
+        """
+        with self.lock:
+            preferred = self.preferred_paths.get(stream)
+        if preferred in paths:
+            return [preferred] + [path for path in paths if path != preferred]
+        return list(paths)
+
+    def path_worked(self, stream, path):
+        with self.lock:
+            self.preferred_paths[stream] = path
+
+    def stderr_tail(self, cam_id):
+        with self.lock:
+            ring = self.stderr_rings.get(cam_id)
+            return '\n'.join(ring) if ring else ''
+
+    def get_stats(self):
+        """Process counters plus each running FFmpeg's pid, age and output"""
+        now = time.monotonic()
+        with self.lock:
+            processes = {
+                str(process.pid): {
+                    'camera': process.cam_id,
+                    'uptime_seconds': round(now - process.started, 1),
+                    'bytes_read': process.bytes_read,
+                    'idle_seconds': round(process.idle_seconds(now), 1),
+                }
+                for process in self.processes.values()
+            }
+            stats = dict(self.stats)
+            stats['running'] = len(self.processes)
+            stats['preferred_paths'] = {str(stream): path for stream, path in sorted(self.preferred_paths.items())}
+            stats['processes'] = processes
+            return stats
+
+
+class Backoff:
+    """Exponential restart delay for one camera's ingest loop"""
+
+    def __init__(self, min_delay=RESTART_MIN_DELAY, max_delay=RESTART_MAX_DELAY):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = min_delay
+        self.failed_starts = 0
+
+    def record(self, ran_seconds, produced_output):
+        """Update after a process exits; returns the delay before the next start"""
+        if produced_output:
+            self.failed_starts = 0
+        else:
+            self.failed_starts += 1
+        if ran_seconds >= HEALTHY_RUN_SECONDS:
+            self.delay = self.min_delay
+        delay = self.delay
+        self.delay = min(self.delay * 2, self.max_delay)
+        return delay
+
+    @property
+    def exhausted(self):
+        return self.failed_starts >= MAX_FAILED_STARTS
+
+
+def _kill_group(popen, sig=signal.SIGKILL):
+    try:
+        os.killpg(popen.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+    except OSError:
+        try:
+            popen.send_signal(sig)
+        except OSError:
+            pass
+
+
+def _terminate(popen):
+    """Stop an FFmpeg process group, escalating to kill if it does not exit"""
+    if popen.poll() is None:
+        _kill_group(popen, signal.SIGTERM)
+        try:
+            popen.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            _kill_group(popen)
+            try:
+                popen.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                logger.error("FFmpeg PID %s did not exit after SIGKILL", popen.pid)
+
+
+def _collect_metrics():
+    with supervisor.lock:
+        running = len(supervisor.processes)
+    return [metrics.snapshot(metrics.Gauge, 'ffmpeg_running', 'FFmpeg processes running', (), {(): running})]
+
+
+# Shared supervisor for all cameras
+supervisor = Supervisor()
+atexit.register(supervisor.shutdown)
+metrics.registry.add_collector(_collect_metrics)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Keyframe-aligned GOP cache for MPEG-TS streams
+Parses just enough of the TS stream (PAT/PMT, PES headers, H.264/HEVC NAL
+types) to keep the program tables and the most recent GOP starting at the
+last keyframe, so a newly joined viewer can decode its first frame at once
+instead of waiting for the next IDR from the camera. PacketHistory keeps a
+longer, keyframe-indexed window of the stream for pre-event clips.
+"""
+
+import os
+import logging
+import collections
+
+logger = logging.getLogger(__name__)
+
+TS_PACKET_SIZE = 188
+PAT_PID = 0x0000
+
+# PMT stream types we know how to find keyframes in
+STREAM_TYPE_H264 = 0x1B
+STREAM_TYPE_HEVC = 0x24
+
+# Upper bound on cached GOP size; a GOP larger than this (camera configured
+# with a very long keyframe interval) is not cached at all
+GOP_CACHE_MAX_BYTES = int(os.environ.get('MPEGTS_GOP_CACHE_MAX_BYTES', str(4 * 1024 * 1024)))
+
+
+def _find_nal_types(payload, stream_type):
+    """Yield NAL unit types for every Annex B start code in payload"""
+    i = payload.find(b'\x00\x00\x01')
+    while i != -1 and i + 3 < len(payload):
+        header = payload[i + 3]
+        if stream_type == STREAM_TYPE_HEVC:
+            yield (header >> 1) & 0x3F
+        else:
+            yield header & 0x1F
+        i = payload.find(b'\x00\x00\x01', i + 3)
+
+
+def is_keyframe_payload(payload, stream_type):
+    """Check whether a PES payload starts a keyframe (IDR or parameter sets)"""
+    for nal_type in _find_nal_types(payload, stream_type):
+        if stream_type == STREAM_TYPE_HEVC:
+            # VPS/SPS/PPS or any IRAP picture (BLA/IDR/CRA)
+            if nal_type in (32, 33, 34) or 16 <= nal_type <= 21:
+                return True
+        else:
+            # SPS/PPS or IDR slice
+            if nal_type in (5, 7, 8):
+                return True
+    return False
+
+
+def _section_payload(packet, offset):
+    """Return the PSI section in a packet that starts one, or None"""
+    pointer = packet[offset]
+    start = offset + 1 + pointer
+    if start >= TS_PACKET_SIZE:
+        return None
+    return packet[start:]
+
+
+class GopCache:
+    """Tracks PAT/PMT and the packets of the current GOP for one TS stream"""
+
+    def __init__(self, max_bytes=GOP_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.pat = None
+        self.pmt = None
+        self.pmt_pid = None
+        self.video_pid = None
+        self.stream_type = None
+        self.gop = []
+        self.gop_bytes = 0
+        self.has_keyframe = False
+        # Video PES packets (frames) and GOPs seen
+        self.frames = 0
+        self.keyframes = 0
+
+    def reset(self):
+        """Forget everything, e.g. after FFmpeg restarts"""
+        self.__init__(self.max_bytes)
+
+    def feed(self, chunk):
+        """Consume a packet-aligned chunk
+
+        Returns the byte offset of the first keyframe packet inside the chunk,
+        or -1 if the chunk contains no keyframe start.
+        """
+        keyframe_offset = -1
+        gop_start = None
+        view = memoryview(chunk)
+
+        for offset in range(0, len(chunk), TS_PACKET_SIZE):
+            packet = view[offset:offset + TS_PACKET_SIZE]
+            if self._parse_packet(packet):
+                if keyframe_offset == -1:
+                    keyframe_offset = offset
+                gop_start = offset
+
+        if gop_start is not None:
+            # A new GOP begins: drop the previous one
+            self.gop = [chunk[gop_start:]]
+            self.gop_bytes = len(chunk) - gop_start
+            self.has_keyframe = True
+            self.keyframes += 1
+        elif self.has_keyframe:
+            self.gop.append(chunk)
+            self.gop_bytes += len(chunk)
+            if self.gop_bytes > self.max_bytes:
+                logger.debug("GOP exceeded %s bytes, not caching it", self.max_bytes)
+                self.gop = []
+                self.gop_bytes = 0
+                self.has_keyframe = False
+
+        return keyframe_offset
+
+    def tables(self):
+        """Return the PAT and PMT packets needed before any media"""
+        if self.pat is None or self.pmt is None:
+            return b''
+        return self.pat + self.pmt
+
+    def snapshot(self):
+        """Return a decodable prefix (PAT + PMT + current GOP) for a new viewer"""
+        if not self.has_keyframe or self.pat is None or self.pmt is None:
+            return b''
+        return self.tables() + b''.join(self.gop)
+
+    def _parse_packet(self, packet):
+        """Update table state from one packet; True if it starts a keyframe"""
+        if len(packet) != TS_PACKET_SIZE or packet[0] != 0x47:
+            return False
+
+        pusi = packet[1] & 0x40
+        pid = ((packet[1] & 0x1F) << 8) | packet[2]
+        adaptation = (packet[3] >> 4) & 0x3
+
+        offset = 4
+        random_access = False
+        if adaptation & 0x2:
+            length = packet[4]
+            if length and length < 183:
+                random_access = bool(packet[5] & 0x40)
+            offset += 1 + length
+        if not adaptation & 0x1 or offset >= TS_PACKET_SIZE:
+            return False
+
+        if pid == PAT_PID and pusi:
+            self._parse_pat(packet, offset)
+            return False
+        if pid == self.pmt_pid and pusi:
+            self._parse_pmt(packet, offset)
+            return False
+        if pid != self.video_pid or not pusi:
+            return False
+
+        # PES header: start code prefix, stream id, length, flags, header length
+        pes = packet[offset:]
+        if len(pes) < 9 or pes[:3] != b'\x00\x00\x01':
+            return False
+        self.frames += 1
+        payload = bytes(pes[9 + pes[8]:])
+        return random_access or is_keyframe_payload(payload, self.stream_type)
+
+    def _parse_pat(self, packet, offset):
+        section = _section_payload(packet, offset)
+        if section is None or len(section) < 12 or section[0] != 0x00:
+            return
+        section_length = ((section[1] & 0x0F) << 8) | section[2]
+        end = min(3 + section_length - 4, len(section))  # exclude CRC
+        for i in range(8, end - 3, 4):
+            program = (section[i] << 8) | section[i + 1]
+            if program != 0:
+                self.pmt_pid = ((section[i + 2] & 0x1F) << 8) | section[i + 3]
+                self.pat = bytes(packet)
+                return
+
+    def _parse_pmt(self, packet, offset):
+        section = _section_payload(packet, offset)
+        if section is None or len(section) < 16 or section[0] != 0x02:
+            return
+        section_length = ((section[1] & 0x0F) << 8) | section[2]
+        end = min(3 + section_length - 4, len(section))
+        program_info_length = ((section[10] & 0x0F) << 8) | section[11]
+        i = 12 + program_info_length
+        while i + 5 <= end:
+            stream_type = section[i]
+            elementary_pid = ((section[i + 1] & 0x1F) << 8) | section[i + 2]
+            es_info_length = ((section[i + 3] & 0x0F) << 8) | section[i + 4]
+            if stream_type in (STREAM_TYPE_H264, STREAM_TYPE_HEVC):
+                if elementary_pid != self.video_pid:
+                    logger.debug("Video PID 0x%04x (stream type 0x%02x)", elementary_pid, stream_type)
+                self.video_pid = elementary_pid
+                self.stream_type = stream_type
+                self.pmt = bytes(packet)
+                return
+            i += 5 + es_info_length
+
+
+class PacketHistory:
+    """The last few seconds of a TS stream as keyframe-aligned segments
+
+    Each segment starts at a keyframe and holds the chunks up to the next
+    one, so any suffix of the history is decodable once the tables are put
+    in front. Segments older than the retention are dropped, and so are the
+    oldest ones when the byte bound is exceeded.
+    """
+
+    def __init__(self, seconds, max_bytes):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        # [start time, [chunks], bytes] per GOP, oldest first
+        self.segments = collections.deque()
+        self.bytes = 0
+
+    def reset(self):
+        self.segments.clear()
+        self.bytes = 0
+
+    def feed(self, chunk, keyframe_offset, now):
+        """Add a packet-aligned chunk (keyframe_offset as returned by GopCache.feed)"""
+        if keyframe_offset != -1:
+            if keyframe_offset and self.segments:
+                self._append(chunk[:keyframe_offset])
+            self.segments.append([now, [], 0])
+            self._append(chunk[keyframe_offset:])
+        elif self.segments:
+            self._append(chunk)
+        else:
+            return
+
+        while len(self.segments) > 1 and self.segments[1][0] <= now - self.seconds:
+            self._drop_oldest()
+        while self.bytes > self.max_bytes and self.segments:
+            self._drop_oldest()
+
+    def _append(self, data):
+        segment = self.segments[-1]
+        segment[1].append(data)
+        segment[2] += len(data)
+        self.bytes += len(data)
+
+    def _drop_oldest(self):
+        segment = self.segments.popleft()
+        self.bytes -= segment[2]
+
+    def snapshot(self, seconds, now):
+        """Return the history from the last keyframe at least seconds ago (or the oldest)"""
+        segments = list(self.segments)
+        start = 0
+        for i, segment in enumerate(segments):
+            if segment[0] <= now - seconds:
+                start = i
+        return b''.join(b''.join(segment[1]) for segment in segments[start:])
+
+    def duration(self, now):
+        return now - self.segments[0][0] if self.segments else 0
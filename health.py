@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Background camera health prober
+Every HEALTH_INTERVAL seconds all cameras are checked concurrently: TCP
+reachability of the HTTPS and RTSP ports, a Digest-authenticated request
+for the MJPEG stream and an RTSP OPTIONS. Results are cached and served at
+/status. A camera failing HEALTH_DEAD_AFTER probes in a row is known dead
+for that protocol, and stream requests for it get an immediate 503 with
+Retry-After instead of each viewer opening (and timing out) its own camera
+session: a dead camera costs one probe per interval. Results older than
+HEALTH_TTL are not trusted for fast-failing.
+"""
+
+import os
+import time
+import socket
+import logging
+import threading
+import concurrent.futures
+
+import camera_pool
+import digest_auth
+import metrics
+import mjpeg_stream
+import mpegts_stream
+import quality
+import workers
+from topology import topology
+
+logger = logging.getLogger(__name__)
+
+# Seconds between probe rounds (0 disables the prober)
+HEALTH_INTERVAL = float(os.environ.get('HEALTH_INTERVAL', '30'))
+
+# Connect/read timeout of each probe
+HEALTH_TIMEOUT = float(os.environ.get('HEALTH_TIMEOUT', '3'))
+
+# Cameras probed at once
+HEALTH_WORKERS = int(os.environ.get('HEALTH_WORKERS', '16'))
+
+# Consecutive failures before a camera is fast-failed
+HEALTH_DEAD_AFTER = int(os.environ.get('HEALTH_DEAD_AFTER', '2'))
+
+# Probe results older than this are not used to reject viewers
+HEALTH_TTL = HEALTH_INTERVAL * 2.5
+
+HTTPS_PORT = 443
+RTSP_PORT = 554
+
+# Protocols a viewer can be turned away from
+MJPEG = 'mjpeg'
+MPEGTS = 'mpegts'
+
+UP = 'up'
+DEGRADED = 'degraded'
+DOWN = 'down'
+UNKNOWN = 'unknown'
+
+
+def split_host(address, default_port):
+    """("host", port) from a camera "ip" that may carry a port"""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return host, int(port)
+    return address, default_port
+
+
+def check_tcp(host, port, timeout=HEALTH_TIMEOUT):
+    """None if a TCP connection succeeds, else the error text"""
+    try:
+        socket.create_connection((host, port), timeout).close()
+        return None
+    except OSError as e:
+        return str(e) or type(e).__name__
+
+
+def check_digest(address, username, password, timeout=HEALTH_TIMEOUT):
+    """None if the camera accepts our Digest credentials for the MJPEG stream"""
+    auth = digest_auth.get_auth(address, username, password)
+    try:
+        response = camera_pool.pool.open_digest(address, mjpeg_stream.MJPEG_URI, auth, timeout)
+    except Exception as e:
+        return str(e) or type(e).__name__
+    # Only the status matters; closing drops the stream connection
+    response.close()
+    return None
+
+
+def check_rtsp(host, timeout=HEALTH_TIMEOUT):
+    """None if the RTSP server answers OPTIONS (401 counts as alive)"""
+    url = f'rtsp://{host}:{RTSP_PORT}{quality.RTSP_PATHS[quality.DEFAULT_TIER][0]}'
+    request = f'OPTIONS {url} RTSP/1.0\r\nCSeq: 1\r\nUser-Agent: camera-proxy-health\r\n\r\n'
+    try:
+        with socket.create_connection((host, RTSP_PORT), timeout) as sock:
+            sock.settimeout(timeout)
+            sock.sendall(request.encode('ascii'))
+            status_line = sock.recv(256).split(b'\r\n', 1)[0].decode('latin-1')
+    except OSError as e:
+        return str(e) or type(e).__name__
+    parts = status_line.split()
+    if len(parts) < 2 or not parts[0].startswith('RTSP/'):
+        return f"Not an RTSP response: {status_line!r}"
+    if parts[1] not in ('200', '401'):
+        return f"RTSP {parts[1]}"
+    return None
+
+
+class CameraHealth:
+    """Latest probe results for one camera"""
+
+    def __init__(self, cam_id):
+        self.cam_id = cam_id
+        self.checked = None
+        self.duration = None
+        # {protocol: error text or None}
+        self.errors = {}
+        # {protocol: consecutive failures}
+        self.failures = {MJPEG: 0, MPEGTS: 0}
+        self.state = UNKNOWN
+        self.since = time.time()
+
+    def record(self, errors, duration, now):
+        self.errors = errors
+        self.duration = duration
+        self.checked = now
+        for protocol in (MJPEG, MPEGTS):
+            failed = errors.get(protocol) is not None
+            self.failures[protocol] = self.failures[protocol] + 1 if failed else 0
+        down = [protocol for protocol in (MJPEG, MPEGTS) if errors.get(protocol) is not None]
+        state = DOWN if len(down) == 2 else DEGRADED if down else UP
+        changed = state != self.state
+        if changed:
+            self.state = state
+            self.since = time.time()
+        return changed
+
+    def dead(self, protocol, now):
+        """True while recent probes agree the protocol is unusable"""
+        if self.checked is None or now - self.checked > HEALTH_TTL:
+            return False
+        return self.failures[protocol] >= HEALTH_DEAD_AFTER
+
+    def to_json(self, now):
+        return {
+            'state': self.state,
+            'since': round(self.since),
+            'checked_seconds_ago': None if self.checked is None else round(now - self.checked, 1),
+            'probe_ms': None if self.duration is None else round(self.duration * 1000),
+            'mjpeg': UNKNOWN if self.checked is None else (self.errors.get(MJPEG) or 'ok'),
+            'mpegts': UNKNOWN if self.checked is None else (self.errors.get(MPEGTS) or 'ok'),
+        }
+
+
+class HealthProber:
+    """Probes every camera on a schedule and answers "is it known dead?" """
+
+    def __init__(self, interval=HEALTH_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.cameras = {}
+        self.username = None
+        self.password = None
+        self.thread = None
+        self.rounds = 0
+        self.rejected = 0
+
+    def start(self, username, password):
+        with self.lock:
+            self.username = username
+            self.password = password
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='health-prober', daemon=True)
+                self.thread.start()
+
+    def probe(self, cam_id):
+        """Check one camera; returns {protocol: error or None}"""
+        address = topology.camera_ip(cam_id)
+        host, https_port = split_host(address, HTTPS_PORT)
+        errors = {}
+        # Reachability first: an unreachable port needs no protocol check
+        error = check_tcp(host, https_port)
+        if error is None:
+            error = check_digest(address, self.username, self.password)
+        errors[MJPEG] = error
+        # The OPTIONS connection doubles as the RTSP reachability check
+        errors[MPEGTS] = check_rtsp(host)
+        return errors
+
+    def _probe_and_record(self, cam_id):
+        start = time.monotonic()
+        try:
+            errors = self.probe(cam_id)
+        except Exception as e:
+            logger.exception("Camera %s: Health probe failed", cam_id)
+            errors = {MJPEG: str(e), MPEGTS: str(e)}
+        now = time.monotonic()
+        with self.lock:
+            health = self.cameras.get(cam_id)
+            if health is None:
+                health = self.cameras[cam_id] = CameraHealth(cam_id)
+            changed = health.record(errors, now - start, now)
+            state = health.state
+        if changed:
+            details = ', '.join(f'{protocol}: {error}' for protocol, error in errors.items() if error)
+            log = logger.info if state == UP else logger.warning
+            log(f"Camera {cam_id}: Health {state}" + (f" ({details})" if details else ''))
+
+    def run_round(self, executor):
+        # With --workers each worker probes the cameras it ingests
+        cam_ids = [cam_id for cam_id in topology.cameras() if workers.owns(cam_id)]
+        list(executor.map(self._probe_and_record, cam_ids))
+        now = time.monotonic()
+        with self.lock:
+            for cam_id in set(self.cameras) - set(cam_ids):
+                del self.cameras[cam_id]
+            self.rounds += 1
+            cameras = {str(cam_id): health.to_json(now) for cam_id, health in self.cameras.items()}
+        workers.publish_state('health', {'published': time.time(), 'cameras': cameras})
+
+    def _run(self):
+        with concurrent.futures.ThreadPoolExecutor(HEALTH_WORKERS, thread_name_prefix='health') as executor:
+            while True:
+                start = time.monotonic()
+                try:
+                    self.run_round(executor)
+                except Exception:
+                    logger.exception("Health probe round failed")
+                time.sleep(max(self.interval - (time.monotonic() - start), 1))
+
+    def unavailable(self, cam_id, protocol):
+        """Reason to turn a viewer away now, or None to go ahead"""
+        with self.lock:
+            health = self.cameras.get(cam_id)
+            if health is None or not health.dead(protocol, time.monotonic()):
+                return None
+            self.rejected += 1
+            return f"Camera {cam_id} unavailable: {health.errors.get(protocol)}"
+
+    def retry_after(self):
+        """Seconds until the next probe round, for Retry-After"""
+        return max(int(self.interval), 1)
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self.lock:
+            cameras = {str(cam_id): health.to_json(now) for cam_id, health in self.cameras.items()}
+            stats = {
+                'interval': self.interval,
+                'rounds': self.rounds,
+                'rejected_requests': self.rejected,
+                'ffmpeg': mpegts_stream.get_ffmpeg_path(),
+            }
+        # Other workers' cameras, aged by the time since they were published
+        for snapshot in workers.collect_state('health'):
+            age = time.time() - snapshot.get('published', time.time())
+            for cam_id, camera in snapshot.get('cameras', {}).items():
+                if camera.get('checked_seconds_ago') is not None:
+                    camera['checked_seconds_ago'] = round(camera['checked_seconds_ago'] + age, 1)
+                cameras.setdefault(cam_id, camera)
+        summary = {state: 0 for state in (UP, DEGRADED, DOWN, UNKNOWN)}
+        for camera in cameras.values():
+            summary[camera['state']] += 1
+        stats['summary'] = summary
+        stats['cameras'] = dict(sorted(cameras.items(), key=lambda item: int(item[0])))
+        return stats
+
+
+def _collect_metrics():
+    with prober.lock:
+        values = {(str(cam_id), protocol): int(health.errors.get(protocol) is None)
+                  for cam_id, health in prober.cameras.items() if health.checked is not None
+                  for protocol in (MJPEG, MPEGTS)}
+        rejected = prober.rejected
+    return [
+        metrics.snapshot(metrics.Gauge, 'camera_up', 'Whether the last health probe succeeded',
+                         ('camera', 'protocol'), values),
+        metrics.snapshot(metrics.Counter, 'camera_rejected_requests_total',
+                         'Stream requests refused for cameras known to be down', (), {(): rejected}),
+    ]
+
+
+# Shared prober for every port
+prober = HealthProber()
+metrics.registry.add_collector(_collect_metrics)
+
+
+def start(username, password):
+    """Start probing; does nothing without a camera password or with HEALTH_INTERVAL=0"""
+    if not password or HEALTH_INTERVAL <= 0:
+        return None
+    prober.start(username, password)
+    logger.info("Probing %d cameras every %.0fs", len(topology.cameras()), HEALTH_INTERVAL)
+    return prober
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+HTTP/2 listener for the camera proxy
+Carries every camera stream (MJPEG and MPEG-TS), the SSE feed and static
+files as multiplexed streams over one connection, so a wall display is no
+longer limited to six HTTP/1.1 connections per port. Requests are routed by
+the same handlers as the asyncio server; each HTTP/2 stream gets a writer
+object that respects the peer's flow-control windows.
+
+With a certificate the listener speaks TLS and negotiates h2 or http/1.1
+via ALPN (browsers only use HTTP/2 over TLS); without one it speaks h2c
+with prior knowledge. Requires the optional "h2" package.
+"""
+
+import ssl
+import asyncio
+import logging
+import threading
+import collections
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    h2 = None
+
+import async_server
+
+logger = logging.getLogger(__name__)
+
+# Connection-specific headers that must not appear in HTTP/2 responses
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade'}
+
+# Receive window advertised per stream and for the connection
+INITIAL_WINDOW_SIZE = 1024 * 1024
+MAX_CONCURRENT_STREAMS = 128
+
+READ_SIZE = 64 * 1024
+
+
+def available():
+    return h2 is not None
+
+
+def create_ssl_context(certfile, keyfile):
+    """Server TLS context offering h2 and http/1.1 via ALPN"""
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile, keyfile)
+    context.set_alpn_protocols(['h2', 'http/1.1'])
+    return context
+
+
+class H2StreamWriter:
+    """StreamWriter look-alike for one HTTP/2 stream
+
+    write()/writelines() queue data; drain() sends it as DATA frames as the
+    stream and connection windows allow, waiting for WINDOW_UPDATEs. A reset
+    stream raises ConnectionResetError like a dropped HTTP/1.1 socket.
+    """
+
+    def __init__(self, connection, stream_id):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.pending = collections.deque()
+        self.window_open = asyncio.Event()
+        self.closed = False
+        self.ended = False
+
+    def send_head(self, status, headers):
+        """Send the response HEADERS frame (called from async_server.write_head)"""
+        if self.closed:
+            raise ConnectionResetError(f"HTTP/2 stream {self.stream_id} closed")
+        response_headers = [(':status', str(status))]
+        for key, value in headers:
+            key = key.lower()
+            if key not in HOP_BY_HOP_HEADERS:
+                response_headers.append((key, str(value)))
+        self.connection.conn.send_headers(self.stream_id, response_headers)
+        self.connection.flush()
+
+    def write(self, data):
+        if self.closed:
+            raise ConnectionResetError(f"HTTP/2 stream {self.stream_id} closed")
+        if data:
+            self.pending.append(memoryview(data))
+
+    def writelines(self, chunks):
+        for chunk in chunks:
+            self.write(chunk)
+
+    async def drain(self):
+        conn = self.connection.conn
+        while self.pending:
+            if self.closed:
+                raise ConnectionResetError(f"HTTP/2 stream {self.stream_id} closed")
+            try:
+                window = min(conn.local_flow_control_window(self.stream_id), conn.max_outbound_frame_size)
+            except h2.exceptions.StreamClosedError:
+                self.closed = True
+                raise ConnectionResetError(f"HTTP/2 stream {self.stream_id} closed")
+            if window <= 0:
+                self.window_open.clear()
+                await self.window_open.wait()
+                continue
+            chunk = self.pending[0]
+            if len(chunk) > window:
+                self.pending[0] = chunk[window:]
+                chunk = chunk[:window]
+            else:
+                self.pending.popleft()
+            conn.send_data(self.stream_id, bytes(chunk))
+            self.connection.flush()
+        await self.connection.writer.drain()
+
+    async def end(self):
+        """Flush anything left and close our side of the stream"""
+        if self.ended:
+            return
+        self.ended = True
+        try:
+            await self.drain()
+            if not self.closed:
+                self.connection.conn.end_stream(self.stream_id)
+                self.connection.flush()
+        except (ConnectionResetError, h2.exceptions.ProtocolError):
+            pass
+
+    def reset(self):
+        self.closed = True
+        self.window_open.set()
+
+    def close(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return self.connection.writer.get_extra_info(name, default)
+
+
+class H2Connection:
+    """One client connection: frame I/O plus a task per request stream"""
+
+    def __init__(self, proxy, reader, writer):
+        self.proxy = proxy
+        self.reader = reader
+        self.writer = writer
+        config = h2.config.H2Configuration(client_side=False, header_encoding='utf-8')
+        self.conn = h2.connection.H2Connection(config=config)
+        self.streams = {}
+        self.tasks = set()
+
+    def flush(self):
+        data = self.conn.data_to_send()
+        if data:
+            self.writer.write(data)
+
+    async def run(self):
+        self.conn.initiate_connection()
+        self.conn.update_settings({
+            h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: INITIAL_WINDOW_SIZE,
+            h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: MAX_CONCURRENT_STREAMS,
+        })
+        self.flush()
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                try:
+                    events = self.conn.receive_data(data)
+                except h2.exceptions.ProtocolError as e:
+                    logger.debug("HTTP/2 protocol error: %s", e)
+                    self.flush()
+                    break
+                for event in events:
+                    if not self.handle_event(event):
+                        return
+                self.flush()
+                await self.writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            for stream in self.streams.values():
+                stream.reset()
+            for task in list(self.tasks):
+                task.cancel()
+            self.writer.close()
+
+    def handle_event(self, event):
+        """Process one h2 event; returns False once the connection is over"""
+        if isinstance(event, h2.events.RequestReceived):
+            self.start_request(event.stream_id, event.headers)
+        elif isinstance(event, h2.events.DataReceived):
+            # Request bodies are not used; give the window straight back
+            self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.WindowUpdated):
+            if event.stream_id == 0:
+                for stream in self.streams.values():
+                    stream.window_open.set()
+            elif event.stream_id in self.streams:
+                self.streams[event.stream_id].window_open.set()
+        elif isinstance(event, h2.events.RemoteSettingsChanged):
+            # A larger initial window can unblock every stream
+            for stream in self.streams.values():
+                stream.window_open.set()
+        elif isinstance(event, h2.events.StreamReset):
+            stream = self.streams.pop(event.stream_id, None)
+            if stream is not None:
+                stream.reset()
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            return False
+        return True
+
+    def start_request(self, stream_id, headers):
+        pseudo = {}
+        request_headers = {}
+        for key, value in headers:
+            if key.startswith(':'):
+                pseudo[key] = value
+            else:
+                request_headers[key.lower()] = value
+        request = async_server.Request(
+            pseudo.get(':method', 'GET'), pseudo.get(':path', '/'), 'HTTP/2', request_headers)
+        stream = H2StreamWriter(self, stream_id)
+        self.streams[stream_id] = stream
+        task = asyncio.ensure_future(self.serve_stream(request, stream))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def serve_stream(self, request, stream):
+        try:
+            await self.proxy.dispatch(request, stream)
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        except Exception:
+            logger.exception("Error serving HTTP/2 stream %s", stream.stream_id)
+            if not stream.closed:
+                try:
+                    self.conn.reset_stream(stream.stream_id)
+                    self.flush()
+                except h2.exceptions.ProtocolError:
+                    pass
+                stream.reset()
+        finally:
+            await stream.end()
+            self.streams.pop(stream.stream_id, None)
+
+
+class Http2Listener:
+    """Accepts connections for HTTP/2 (h2c, or TLS with ALPN fallback to HTTP/1.1)"""
+
+    def __init__(self, proxy, ssl_context=None):
+        self.proxy = proxy
+        self.ssl_context = ssl_context
+
+    async def handle_client(self, reader, writer):
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None and ssl_object.selected_alpn_protocol() != 'h2':
+            # TLS client that did not negotiate h2: serve it as HTTP/1.1
+            await self.proxy.handle_client(reader, writer)
+            return
+        await H2Connection(self.proxy, reader, writer).run()
+
+    async def serve(self, port):
+        server = await asyncio.start_server(
+            self.handle_client, '', port, ssl=self.ssl_context, reuse_address=True)
+        mode = 'TLS' if self.ssl_context else 'h2c prior knowledge'
+        logger.info("HTTP/2 listener on port %s (%s)", port, mode)
+        await server.serve_forever()
+
+
+def run(port, username, password, ssl_context=None):
+    """Run the HTTP/2 listener on its own event loop (threaded server mode)"""
+    proxy = async_server.ProxyServer(username, password)
+    asyncio.run(Http2Listener(proxy, ssl_context).serve(port))
+
+
+def start(port, username, password, ssl_context=None):
+    """Start the HTTP/2 listener in a daemon thread; returns False without h2"""
+    if not available():
+        logger.error("HTTP/2 listener needs the 'h2' package (pip install h2)")
+        return False
+    thread = threading.Thread(
+        target=run, args=(port, username, password, ssl_context), name='http2', daemon=True)
+    thread.start()
+    return True
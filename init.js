@@ -61,16 +61,23 @@ function createBackgroundGrid(){
     }
 }
 
-function initialize(){
+async function initialize(){
+    await loadTopology();
     createBackgroundGrid();
     setLiveFeedSources();
-    recent.push(...Array.from({length:26},(_,i)=>i+1));
+    pollCameraStatus();
+    recent.push(...workingCameras);
     previousReplacement=null;
-    for(let cam=1;cam<=26;cam++){
+    for(const cam of workingCameras){
         preloadImage(cam).catch(()=>{});
     }
     updateDisplay();
     loadPriorities();
+    // Keep this display's layout report from expiring on the server
+    setInterval(()=>{
+        const activeSet=new Set(getActiveShown());
+        reportLayout([...activeSet], getRecentShown().filter(cam=>!activeSet.has(cam)));
+    }, LAYOUT_REPORT_INTERVAL);
 }
 
 initialize();
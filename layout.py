@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+Server-side display layout
+The active/recent state machine that algorithm.js used to run in every
+browser, run once here from the events the SSE hub delivers. A camera with
+an event takes an active slot for LAYOUT_ACTIVE_SECONDS (further events
+extend it); the rest of the 4x4 grid shows the most recent cameras, with a
+camera leaving an active slot taking the tile after the previous one to
+leave. Displays subscribing with /api/v1/subscribe?layout=1 get the full
+layout on connect and then a "layout" message with only the tiles that
+changed:
+
+    event: layout
+    data: {"v":12,"tiles":{"a0":[3,"intrusion","high"],"r8":7,"r9":null}}
+
+a0-a3 are the active slots ([camera, event type, priority]), r0-r15 the
+recent tiles in grid order. The message on connect carries "full": true; a
+display that sees a gap in "v" re-reads the full layout from /layout.json. While any display is subscribed, the layout
+is reported to the quality policy and the MPEG-TS ingest of exactly the
+cameras on screen is held open (LAYOUT_INGEST=0 disables the latter). With
+--workers the displays are on worker 0, which shares their count so the
+other workers hold their own cameras only while displays are connected.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import urllib.parse
+
+import mpegts_stream
+import quality
+import workers
+from topology import topology
+
+logger = logging.getLogger(__name__)
+
+# Seconds a camera stays in an active slot after its last event
+ACTIVE_SECONDS = float(os.environ.get('LAYOUT_ACTIVE_SECONDS', '10'))
+
+# Hold the ingest of on-screen cameras while displays are subscribed
+HOLD_INGEST = os.environ.get('LAYOUT_INGEST', '1') != '0'
+
+ACTIVE_SLOTS = 4
+GRID_TILES = 16
+
+# Recent tiles left by the number of active cameras (each active takes 2x2)
+RECENT_TILES = {0: 16, 1: 12, 2: 8, 3: 4}
+
+# Name under which the layout is reported to the quality policy
+QUALITY_CLIENT = 'server-layout'
+
+# Seconds between quality reports, well inside the policy's expiry
+QUALITY_REFRESH = quality.REPORT_TTL / 2
+
+# With --workers, worker 0's display count is trusted for this long; it
+# republishes at least every QUALITY_REFRESH
+REMOTE_DISPLAYS_TTL = QUALITY_REFRESH * 3
+
+# Seconds between the other workers' checks of worker 0's display count
+REMOTE_DISPLAYS_POLL = 2.0
+
+
+def wants_layout(query):
+    """True for /api/v1/subscribe?layout=1"""
+    return urllib.parse.parse_qs(query or '').get('layout', ['0'])[0] == '1'
+
+
+class LayoutEngine:
+    """Active and recent cameras for all displays, pushed as tile diffs"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        # {cam_id: (event_type, priority)} in activation order
+        self.active = {}
+        self.deadlines = {}
+        # Least recently active last; never holds active cameras
+        self.recent = []
+        self.recent_set = set()
+        self.previous_replacement = None
+        self.last_shown = []
+        self.last_count = None
+        self.version = 0
+        self.tiles = {}
+        self.clients = set()
+        # {(cam_id, tier): broadcaster} held for on-screen cameras
+        self.holds = {}
+        self.username = None
+        self.password = None
+        self.thread = None
+        # Set when the quality policy and held ingests need updating
+        self.sync_pending = False
+        self.stats = {'activations': 0, 'deactivations': 0, 'messages': 0}
+
+    def start(self, username, password):
+        with self.cond:
+            self.username = username
+            self.password = password
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='layout', daemon=True)
+                self.thread.start()
+
+    # -- state machine (caller holds self.cond) --
+
+    def _cameras(self):
+        return topology.cameras()
+
+    def _fill_recent(self):
+        # Cameras never seen yet are the least recent
+        for cam_id in self._cameras():
+            if cam_id not in self.active and cam_id not in self.recent_set:
+                self.recent.append(cam_id)
+                self.recent_set.add(cam_id)
+
+    def _remove_recent(self, cam_id):
+        if cam_id in self.recent_set:
+            self.recent.remove(cam_id)
+            self.recent_set.discard(cam_id)
+
+    def _replace_recent(self, index, cam_id):
+        self.recent_set.discard(self.recent[index])
+        self.recent[index] = cam_id
+        self.recent_set.add(cam_id)
+
+    def _insert_recent(self, cam_id):
+        self.recent.insert(0, cam_id)
+        self.recent_set.add(cam_id)
+
+    def _recent_shown(self):
+        count = RECENT_TILES.get(len(self.active), 0)
+        # When the grid shrinks, keep the previous replacement visible by
+        # starting from it in what was shown rather than dropping it
+        if self.last_count is not None and self.last_count > count and self.last_shown:
+            last = [cam_id for cam_id in self.last_shown if cam_id not in self.active]
+            if last:
+                if self.previous_replacement in last:
+                    start = last.index(self.previous_replacement)
+                    last = last[start:] + last[:start]
+                shown = last[:count]
+                self.last_count = count
+                self.last_shown = shown
+                return shown
+        shown = [cam_id for cam_id in self.recent if cam_id not in self.active]
+        if len(shown) < count:
+            shown.extend(cam_id for cam_id in self._cameras()
+                         if cam_id not in self.active and cam_id not in self.recent_set)
+        shown = shown[:count]
+        self.last_count = count
+        self.last_shown = shown
+        return shown
+
+    def _reorder_recent(self):
+        # Shown cameras first in their tile order, then the rest as they were
+        shown = [cam_id for cam_id in self._recent_shown() if cam_id in self.recent_set]
+        shown_set = set(shown)
+        self.recent = shown + [cam_id for cam_id in self.recent if cam_id not in shown_set]
+
+    def _activate(self, cam_id, event_type, priority, now):
+        self._remove_recent(cam_id)
+        if cam_id not in self.active:
+            self.stats['activations'] += 1
+        # An active camera keeps its slot; only its label changes
+        self.active[cam_id] = (event_type, priority)
+        self.deadlines[cam_id] = now + ACTIVE_SECONDS
+        self._fill_recent()
+        self._reorder_recent()
+
+    def _deactivate(self, cam_id):
+        self.active.pop(cam_id, None)
+        self.deadlines.pop(cam_id, None)
+        self._remove_recent(cam_id)
+        self.stats['deactivations'] += 1
+
+        # Take the tile after the previous replacement, wrapping to the first
+        shown = self._recent_shown()
+        previous = self.previous_replacement
+        position = shown.index(previous) if previous in shown else -1
+        if previous is None:
+            self._insert_recent(cam_id)
+        elif position == -1 or position + 1 >= len(shown):
+            if shown and shown[0] in self.recent_set:
+                self._replace_recent(self.recent.index(shown[0]), cam_id)
+            else:
+                self._insert_recent(cam_id)
+        elif shown[position + 1] in self.recent_set:
+            self._replace_recent(self.recent.index(shown[position + 1]), cam_id)
+        elif previous in self.recent_set and self.recent.index(previous) + 1 < len(self.recent):
+            self._replace_recent(self.recent.index(previous) + 1, cam_id)
+        else:
+            self._insert_recent(cam_id)
+
+        self._fill_recent()
+        self.previous_replacement = cam_id
+        self._reorder_recent()
+
+    def _current_tiles(self):
+        tiles = {}
+        active = list(self.active.items())[:ACTIVE_SLOTS]
+        for slot in range(ACTIVE_SLOTS):
+            if slot < len(active):
+                cam_id, (event_type, priority) = active[slot]
+                tiles[f'a{slot}'] = [cam_id, event_type, priority]
+            else:
+                tiles[f'a{slot}'] = None
+        shown = self._recent_shown()
+        for tile in range(GRID_TILES):
+            tiles[f'r{tile}'] = shown[tile] if tile < len(shown) else None
+        return tiles
+
+    def _encode(self, tiles, full=False):
+        message = {'v': self.version, 'tiles': tiles}
+        if full:
+            message['full'] = True
+        data = json.dumps(message, separators=(',', ':'))
+        return f'event: layout\ndata: {data}\n\n'.encode('utf-8')
+
+    def _update(self):
+        """Push the tiles that changed; returns the message or None"""
+        tiles = self._current_tiles()
+        changed = {tile: cam for tile, cam in tiles.items() if self.tiles.get(tile, False) != cam}
+        if not changed:
+            return None
+        self.version += 1
+        self.tiles = tiles
+        self.stats['messages'] += 1
+        return self._encode(changed)
+
+    # -- inputs --
+
+    def on_events(self, events):
+        """SSE hub listener"""
+        now = time.monotonic()
+        with self.cond:
+            for event in events:
+                if event.camera is None:
+                    continue
+                priority = (event.priority or 'LOW').lower()
+                self._activate(event.camera, event.event_type or 'unknown', priority, now)
+            message = self._update()
+        if message is not None:
+            self._push(message)
+
+    def attach(self, client):
+        """Send client (an sse_hub.SSEClient) the full layout and then every change"""
+        with self.cond:
+            if not self.tiles:
+                self._fill_recent()
+                self._update()
+            self.clients.add(client)
+            client.push(self._encode(self.tiles, full=True))
+            self.sync_pending = True
+            self.cond.notify()
+
+    def detach(self, client):
+        with self.cond:
+            self.clients.discard(client)
+            self.sync_pending = True
+            self.cond.notify()
+
+    def snapshot(self):
+        """Full layout for /layout.json"""
+        with self.cond:
+            if not self.tiles:
+                self._fill_recent()
+                self._update()
+            return {'v': self.version, 'tiles': self.tiles}
+
+    # -- outputs --
+
+    def _push(self, message):
+        # Runs on the hub's delivery thread: queue only, the rest is for _run
+        with self.cond:
+            self.clients = {client for client in self.clients if not client.closed}
+            clients = list(self.clients)
+            self.sync_pending = True
+            self.cond.notify()
+        for client in clients:
+            client.push(message)
+
+    def _sync(self):
+        """Report the layout to the quality policy and hold on-screen ingests"""
+        with self.cond:
+            displays = len(self.clients)
+        # Displays only connect to worker 0; the other workers' engines run
+        # on the same events and steer their own cameras' ingests while
+        # worker 0 reports displays
+        if workers.index == 0:
+            workers.publish_state('layout', {'published': time.time(), 'displays': displays})
+        else:
+            displays = self._remote_displays()
+        with self.cond:
+            displayed = displays > 0
+            if displayed and not self.tiles:
+                # Other workers never see a display attach before any event
+                self._fill_recent()
+                self._update()
+            active = [self.tiles[f'a{slot}'][0] for slot in range(ACTIVE_SLOTS) if self.tiles.get(f'a{slot}')]
+            recent = [self.tiles[f'r{tile}'] for tile in range(GRID_TILES) if self.tiles.get(f'r{tile}')]
+            hold = HOLD_INGEST and displayed and bool(self.password)
+        if displayed:
+            quality.policy.report(QUALITY_CLIENT, active, recent)
+        wanted = {(cam_id, quality.policy.tier_for(cam_id)) for cam_id in active + recent
+                  if workers.owns(cam_id)} if hold else set()
+
+        with self.cond:
+            # A held ingest that died is started again
+            released = [self.holds.pop(key) for key, broadcaster in list(self.holds.items())
+                        if key not in wanted or broadcaster.stopping]
+            for cam_id, tier in wanted:
+                if (cam_id, tier) not in self.holds:
+                    self.holds[(cam_id, tier)] = mpegts_stream.prewarm(cam_id, self.username, self.password, tier)
+        for broadcaster in released:
+            broadcaster.release()
+
+    def _remote_displays(self):
+        """Displays subscribed to worker 0, from its last recent snapshot"""
+        for snapshot in workers.collect_state('layout'):
+            if time.time() - snapshot.get('published', 0) < REMOTE_DISPLAYS_TTL:
+                return snapshot.get('displays', 0)
+        return 0
+
+    def _run(self):
+        last_sync = time.monotonic()
+        remote = workers.enabled() and workers.index != 0
+        remote_displayed = False
+        while True:
+            if remote:
+                # Follow displays coming and going on worker 0
+                displayed = self._remote_displays() > 0
+                if displayed != remote_displayed:
+                    remote_displayed = displayed
+                    with self.cond:
+                        self.sync_pending = True
+            with self.cond:
+                now = time.monotonic()
+                wait = QUALITY_REFRESH - (now - last_sync)
+                if remote:
+                    wait = min(wait, REMOTE_DISPLAYS_POLL)
+                if self.deadlines:
+                    wait = min(wait, min(self.deadlines.values()) - now)
+                if wait > 0 and not self.sync_pending:
+                    self.cond.wait(wait)
+                now = time.monotonic()
+                expired = sorted((deadline, cam_id) for cam_id, deadline in self.deadlines.items()
+                                 if deadline <= now)
+                for _, cam_id in expired:
+                    self._deactivate(cam_id)
+                message = self._update() if expired else None
+                sync = self.sync_pending or message is not None or now - last_sync >= QUALITY_REFRESH
+                self.sync_pending = False
+            try:
+                if message is not None:
+                    self._push(message)
+                    with self.cond:
+                        self.sync_pending = False
+                if sync:
+                    self._sync()
+                    last_sync = now
+            except Exception:
+                logger.exception("Layout update failed")
+
+    def get_stats(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats.update({
+                'version': self.version,
+                'active': list(self.active),
+                'recent_shown': list(self.last_shown),
+                'displays': len(self.clients),
+                'held_ingests': [f'{cam_id}/{tier}' for cam_id, tier in sorted(self.holds)],
+            })
+            return stats
+
+
+# Shared layout for every display
+engine = LayoutEngine()
+
+
+def start(hub, username, password):
+    """Drive the layout from hub events"""
+    engine.start(username, password)
+    hub.add_listener(engine.on_events)
+    hub.start()
+    logger.info("Server-side layout running (%.0fs active slots)", ACTIVE_SECONDS)
+    return engine
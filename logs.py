@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Non-blocking, sampled logging
+Records go from the calling thread into a bounded queue and are formatted
+and written to stdout by a background thread, so a slow terminal or
+journald never stalls a stream: when the queue is full the record is
+dropped and counted instead of waiting. Formatting is left to the writer
+thread, so hot paths should log with %-style arguments rather than
+f-strings (a disabled level then costs one isEnabledFor check), and
+the arguments must not change after the call.
+
+Repeated messages are sampled per call site and camera: each gets
+LOG_BURST records per LOG_WINDOW seconds, then one in LOG_SAMPLE, and the
+next record written says how many were suppressed. A message is about a
+camera when it starts with "Camera %s" and the camera id is its first
+argument, or when it carries extra={'camera': cam_id}.
+
+Levels can be read and changed at runtime through /log_level (see
+parse_level_request); with --workers the change reaches every worker.
+"""
+
+import os
+import sys
+import time
+import queue
+import atexit
+import logging
+import threading
+import urllib.parse
+
+import metrics
+import workers
+
+# Level of the root logger at startup
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG').upper()
+
+# Records waiting for the writer; more are dropped
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+
+# Records per call site and camera let through in each window before sampling
+LOG_BURST = int(os.environ.get('LOG_BURST', '10'))
+LOG_WINDOW = float(os.environ.get('LOG_WINDOW', '10'))
+
+# Beyond the burst, one record in LOG_SAMPLE is written (0 writes none)
+LOG_SAMPLE = int(os.environ.get('LOG_SAMPLE', '100'))
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Seconds between checks for level changes made in other workers
+LEVEL_SYNC_SECONDS = 1.0
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+
+def _camera_of(record):
+    camera = getattr(record, 'camera', None)
+    if camera is None and isinstance(record.msg, str) and record.msg.startswith('Camera %') \
+            and isinstance(record.args, tuple) and record.args:
+        camera = record.args[0]
+    return camera
+
+
+class SamplingFilter(logging.Filter):
+    """Rate limits each (logger, call site, camera) to a burst per window, then samples"""
+
+    def __init__(self, burst=LOG_BURST, window=LOG_WINDOW, sample=LOG_SAMPLE):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.sample = sample
+        self.lock = threading.Lock()
+        # {key: [window start, records in window, suppressed since last written]}
+        self.sites = {}
+        self.suppressed = 0
+
+    def filter(self, record):
+        key = (record.name, record.lineno, _camera_of(record))
+        now = time.monotonic()
+        with self.lock:
+            site = self.sites.get(key)
+            if site is None or now - site[0] >= self.window:
+                if site is None and len(self.sites) > 10000:
+                    # Forget call sites whose window has passed
+                    self.sites = {k: s for k, s in self.sites.items() if now - s[0] < self.window}
+                pending = site[2] if site else 0
+                site = self.sites[key] = [now, 0, pending]
+            site[1] += 1
+            seen = site[1]
+            if seen > self.burst and (self.sample <= 0 or (seen - self.burst) % self.sample):
+                site[2] += 1
+                self.suppressed += 1
+                return False
+            pending = site[2]
+            site[2] = 0
+        if pending:
+            record.suppressed = pending
+        return True
+
+
+class DroppingQueueHandler(logging.Handler):
+    """Queues records for the writer thread without ever blocking the caller"""
+
+    def __init__(self, records):
+        super().__init__()
+        self.records = records
+        self.dropped = 0
+
+    def emit(self, record):
+        # Formatting waits for the writer; only tracebacks are rendered
+        # here, while the frames they refer to still exist
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SampledFormatter(logging.Formatter):
+    """Formatter noting how many similar records were suppressed before this one"""
+
+    def formatMessage(self, record):
+        message = super().formatMessage(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            message += f' ({suppressed} similar messages suppressed)'
+        return message
+
+
+class LogWriter:
+    """Background thread writing queued records to a stream"""
+
+    def __init__(self, stream=None, queue_size=LOG_QUEUE_SIZE):
+        self.records = queue.Queue(queue_size)
+        self.handler = DroppingQueueHandler(self.records)
+        self.filter = SamplingFilter()
+        self.handler.addFilter(self.filter)
+        self.output = logging.StreamHandler(stream or sys.stdout)
+        self.output.setFormatter(SampledFormatter(FORMAT, DATE_FORMAT))
+        self.thread = None
+        self.written = 0
+        # time.time() of the level change last applied, for --workers
+        self.levels_changed = 0.0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        next_sync = time.monotonic() + LEVEL_SYNC_SECONDS
+        while True:
+            try:
+                record = self.records.get(timeout=LEVEL_SYNC_SECONDS)
+            except queue.Empty:
+                record = None
+            if record is not None:
+                self.output.handle(record)
+                self.written += 1
+            if time.monotonic() >= next_sync:
+                next_sync = time.monotonic() + LEVEL_SYNC_SECONDS
+                self._sync_levels()
+
+    def flush(self, timeout=2.0):
+        """Write out what is queued, for shutdown"""
+        deadline = time.monotonic() + timeout
+        while not self.records.empty() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.output.flush()
+
+    def _sync_levels(self):
+        if not workers.enabled():
+            return
+        for snapshot in workers.collect_state('log_levels'):
+            changed = snapshot.get('changed', 0)
+            if changed > self.levels_changed:
+                self.levels_changed = changed
+                for name, level in snapshot.get('levels', {}).items():
+                    logging.getLogger(name or None).setLevel(level)
+
+    def get_stats(self):
+        return {
+            'queued': self.records.qsize(),
+            'queue_size': self.records.maxsize,
+            'written': self.written,
+            'dropped': self.handler.dropped,
+            'suppressed': self.filter.suppressed,
+            'burst': self.filter.burst,
+            'window': self.filter.window,
+            'sample': self.filter.sample,
+        }
+
+
+# Shared writer behind the root logger
+writer = LogWriter()
+
+
+def configure(level=LOG_LEVEL):
+    """Send all logging through the writer thread"""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(writer.handler)
+    root.setLevel(level)
+    writer.start()
+    atexit.register(writer.flush)
+
+
+def levels():
+    """{logger name: level name} for the root ('') and every logger with a level set"""
+    result = {'': logging.getLevelName(logging.getLogger().level)}
+    for name, logger in sorted(logging.root.manager.loggerDict.items()):
+        if isinstance(logger, logging.Logger) and logger.level != logging.NOTSET:
+            result[name] = logging.getLevelName(logger.level)
+    return result
+
+
+def parse_level_request(query):
+    """(logger name, level) from /log_level?level=..[&logger=..], None without level; raises ValueError"""
+    params = urllib.parse.parse_qs(query or '')
+    level = params.get('level', [''])[0].upper()
+    if not level:
+        return None
+    if level not in LEVELS:
+        raise ValueError(f"level must be one of {', '.join(LEVELS)}")
+    return params.get('logger', [''])[0], level
+
+
+def set_level(name, level):
+    """Set the level of logger name ('' is the root) here and in the other workers"""
+    logging.getLogger(name or None).setLevel(level)
+    if workers.enabled():
+        writer.levels_changed = time.time()
+        workers.publish_state('log_levels', {'changed': writer.levels_changed, 'levels': levels()})
+    logging.getLogger(__name__).warning("Log level of %s set to %s", name or 'root', level)
+
+
+def get_stats():
+    return dict(writer.get_stats(), levels=levels())
+
+
+def _collect_metrics():
+    return [
+        metrics.snapshot(metrics.Counter, 'log_records_dropped_total',
+                         'Log records dropped because the writer queue was full', (),
+                         {(): writer.handler.dropped}),
+        metrics.snapshot(metrics.Counter, 'log_records_suppressed_total',
+                         'Log records suppressed by per-site sampling', (),
+                         {(): writer.filter.suppressed}),
+    ]
+
+
+metrics.registry.add_collector(_collect_metrics)
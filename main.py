@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import http.server
+import socket
 import socketserver
 import urllib.request
 import urllib.error
@@ -8,33 +9,41 @@ import urllib.parse
 import sys
 import os
 import time
-import re
-import secrets
-import ssl
 import getpass
 import logging
 import threading
 import subprocess
 import platform
 import queue
+import json
+import signal
+import argparse
 from pathlib import Path
 
-from md5 import hash
 import mpegts_stream
+import mjpeg_stream
+import camera_pool
+import clips
+import egress
+import ffmpeg_supervisor
+import health
+import layout
+import logs
+import metrics
+import topology
+import preview
+import quality
+import sse_hub
+import priorities
+import static_assets
+import stream_lifecycle
+import workers
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,  # Enable debug logs for H.264 troubleshooting
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    stream=sys.stdout,
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+# Log through a background writer (LOG_LEVEL, DEBUG by default for H.264
+# troubleshooting; adjustable at runtime through /log_level)
+logs.configure()
 logger = logging.getLogger(__name__)
 
-SOVEREIGN_URL = os.environ.get('SOVEREIGN_URL', 'http://127.0.0.1:8080')
-# Store parent directory path for serving Images
-PARENT_DIR = Path(__file__).parent.parent
-
 CAMERA_USERNAME = os.environ.get('CAMERA_USERNAME', 'root')
 CAMERA_PASSWORD = None
 
@@ -55,15 +64,69 @@ class CORSProxyHandler(http.server.SimpleHTTPRequestHandler):
         self.send_response(200)
         self.end_headers()
     
+    def send_unavailable(self, reason):
+        """503 for a camera the health prober knows is down"""
+        body = reason.encode()
+        self.send_response(503)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Retry-After', str(health.prober.retry_after()))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def hand_off(self):
+        """Pass the request to the worker owning its camera; True if it was"""
+        if getattr(self.connection, 'adopted', False):
+            # Handed to us by another worker: answer it whatever route() says
+            self.connection.adopted = False
+            return False
+        worker = workers.route(self.path)
+        if worker is None or worker == workers.index:
+            return False
+        head = self.raw_requestline + b''.join(
+            f'{key}: {value}\r\n'.encode('latin-1') for key, value in self.headers.items()) + b'\r\n'
+        # Whatever the client sent after the head (a pipelined request) goes along
+        head += self.read_buffered()
+        try:
+            workers.hand_off(self.connection, worker, self.server.server_address[1], head)
+        except OSError as e:
+            logger.warning("Cannot hand %s to worker %s, serving it here: %s", self.path, worker, e)
+            return False
+        self.server.handed_off.add(self.connection)
+        self.close_connection = True
+        return True
+    
+    def read_buffered(self):
+        """Bytes already read from the client past the current request, without blocking"""
+        self.connection.settimeout(0)
+        try:
+            buffered = self.rfile.peek()
+        except BlockingIOError:
+            buffered = b''
+        finally:
+            # The socket must be blocking again before another process gets it
+            self.connection.settimeout(self.timeout)
+        # An adopted connection may still hold part of what it was handed
+        return buffered + getattr(self.rfile.raw, 'prefix', b'')
+    
     def do_GET(self):
+        if self.hand_off():
+            return
+        
         # Handle MPEG-TS live stream (ultra-low latency)
         if self.path.startswith('/mpegts/'):
-            cam_id_str = self.path.split('/')[-1]
+            url = urllib.parse.urlsplit(self.path)
+            cam_id_str = url.path.split('/')[-1]
             try:
                 cam_id = int(cam_id_str)
             except ValueError:
                 self.send_error(400, "Invalid camera ID")
                 return
+            try:
+                tier = quality.parse_tier(url.query)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
             
             username = CAMERA_USERNAME
             password = CAMERA_PASSWORD
@@ -72,6 +135,11 @@ class CORSProxyHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_error(500, "Camera password not configured")
                 return
             
+            reason = health.prober.unavailable(cam_id, health.MPEGTS)
+            if reason:
+                self.send_unavailable(reason)
+                return
+            
             # Start streaming MPEG-TS
             self.send_response(200)
             self.send_header('Content-Type', 'video/mp2t')
@@ -82,7 +150,7 @@ class CORSProxyHandler(http.server.SimpleHTTPRequestHandler):
             self.end_headers()
             
             # Stream MPEG-TS data (blocks until client disconnects)
-            mpegts_stream.stream_mpegts(cam_id, username, password, self.wfile)
+            mpegts_stream.stream_mpegts(cam_id, username, password, self.wfile, self.connection, tier)
             return
         
         # Handle cleanup endpoint
@@ -94,47 +162,146 @@ class CORSProxyHandler(http.server.SimpleHTTPRequestHandler):
             self.wfile.write(b'MPEG-TS streams cleaned up')
             return
         
+        # Prometheus metrics
+        if self.path == '/metrics':
+            body = metrics.registry.render()
+            self.send_response(200)
+            self.send_header('Content-Type', metrics.CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        
+        # Camera connection pool, SSE event rate, FFmpeg and egress statistics,
+        # camera health, the camera topology used by the browser, the server-side layout, and
+        # display layout reports for the quality policy
+        # (/quality?client=..&active=..&recent=..), and log levels
+        # (/log_level?level=..&logger=.. changes one)
+        if self.path in ('/pool_stats', '/event_stats', '/ffmpeg_stats', '/topology.json',
+                         '/layout.json', '/layout_stats', '/status',
+                         '/worker_stats', '/egress_stats') or \
+                self.path.split('?')[0] in ('/quality', '/log_level'):
+            if self.path.split('?')[0] == '/log_level':
+                try:
+                    change = logs.parse_level_request(urllib.parse.urlsplit(self.path).query)
+                except ValueError as e:
+                    self.send_error(400, str(e))
+                    return
+                if change:
+                    logs.set_level(*change)
+                stats = logs.get_stats()
+            elif self.path.startswith('/quality?'):
+                try:
+                    client, active, recent = quality.parse_report(urllib.parse.urlsplit(self.path).query)
+                except ValueError as e:
+                    self.send_error(400, str(e))
+                    return
+                quality.policy.report(client, active, recent)
+                stats = quality.policy.get_stats()
+            elif self.path == '/quality':
+                stats = quality.policy.get_stats()
+            elif self.path == '/topology.json':
+                stats = topology.topology.to_json()
+            elif self.path == '/status':
+                stats = health.prober.get_stats()
+            elif self.path == '/worker_stats':
+                stats = workers.get_stats()
+            elif self.path == '/egress_stats':
+                stats = egress.scheduler.get_stats()
+            elif self.path == '/layout.json':
+                stats = layout.engine.snapshot()
+            elif self.path == '/layout_stats':
+                stats = layout.engine.get_stats()
+            elif self.path == '/pool_stats':
+                stats = camera_pool.pool.get_stats()
+            elif self.path == '/event_stats':
+                stats = sse_hub.hub.coalescer.get_stats()
+            else:
+                stats = ffmpeg_supervisor.supervisor.get_stats()
+            body = json.dumps(stats, indent=2).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        
+        # Handle low-rate previews for /preview/<id> and /preview/mosaic
+        if self.path.startswith('/preview/'):
+            self.serve_preview()
         # Handle camera video proxy for /video*
-        if self.path.startswith('/video'):
+        elif self.path.startswith('/video'):
             self.proxy_camera_stream()
         # Handle SSE proxy for /api/v1/subscribe
         elif self.path == '/api/v1/subscribe' or self.path.startswith('/api/v1/subscribe'):
             self.proxy_sse()
-        elif self.path.startswith('/Images/'):
-            # Serve Images from parent directory
-            image_path = PARENT_DIR / self.path.lstrip('/')
-            if image_path.exists() and image_path.is_file():
-                try:
-                    with open(image_path, 'rb') as f:
-                        content = f.read()
-                    self.send_response(200)
-                    # Determine content type based on file extension
-                    if image_path.suffix.lower() == '.png':
-                        self.send_header('Content-Type', 'image/png')
-                    elif image_path.suffix.lower() == '.jpg' or image_path.suffix.lower() == '.jpeg':
-                        self.send_header('Content-Type', 'image/jpeg')
-                    else:
-                        self.send_header('Content-Type', 'application/octet-stream')
-                    self.send_header('Content-Length', str(len(content)))
-                    self.end_headers()
-                    self.wfile.write(content)
-                except Exception as e:
-                    self.send_error(500, f"Error serving image: {e}")
-            else:
-                self.send_error(404, "Image not found")
+        # Alarm clips and their listings
+        elif self.path.startswith('/clips'):
+            self.serve_clip()
         else:
-            # Serve static files normally
-            try:
-                super().do_GET()
-            except (BrokenPipeError, ConnectionResetError):
-                # Client disconnected, ignore the error
-                pass
+            # Static files and /Images/ from the shared asset cache
+            self.serve_static()
+
+    def do_HEAD(self):
+        self.serve_static(head_only=True)
+
+    def serve_clip(self):
+        """Serve /clips/<id>/<ts>.ts, or the clip list for /clips/ and /clips/<id>/"""
+        try:
+            file_path, cam_id = clips.resolve(self.path)
+        except LookupError as e:
+            self.send_error(404, str(e))
+            return
+        except ValueError:
+            self.send_error(404, "Clip not found")
+            return
+        if file_path is not None:
+            self.serve_static(file_path=file_path)
+            return
+        body = json.dumps(clips.list_clips(cam_id), indent=2).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def serve_static(self, head_only=False, file_path=None):
+        """Serve a static file with ETag/Range/compression support (see static_assets.py)"""
+        if file_path is None:
+            file_path = static_assets.resolve(self.path)
+        headers = {key.lower(): value for key, value in self.headers.items()}
+        response = static_assets.cache.respond(file_path, headers, head_only)
+        try:
+            self.send_response(response.status)
+            for key, value in response.headers:
+                self.send_header(key, value)
+            self.end_headers()
+            if response.file_path is None:
+                self.wfile.write(response.body)
+                return
+            self.wfile.flush()
+            with open(response.file_path, 'rb') as f:
+                self.connection.sendfile(f, response.offset, response.length)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client disconnected, ignore the error
+            pass
+        except OSError as e:
+            logger.warning("Error sending %s: %s", file_path, e)
     
     def proxy_sse(self):
-        """Proxy Server-Sent Events with CORS headers"""
-        
+        """Proxy Server-Sent Events with CORS headers
+        All browser clients share the single upstream subscription in sse_hub
+        """
+        client = None
+        flow = None
         try:
-            # Send response headers FIRST (before connecting to SOVEREIGN)
+            query = urllib.parse.urlsplit(self.path).query
+            try:
+                event_filter = priorities.EventFilter.from_query(query)
+            except ValueError as e:
+                self.send_error(400, f"Invalid filter: {e}")
+                return
+            
             self.send_response(200)
             self.send_header('Content-Type', 'text/event-stream')
             self.send_header('Cache-Control', 'no-cache, no-transform')
@@ -142,95 +309,101 @@ class CORSProxyHandler(http.server.SimpleHTTPRequestHandler):
             self.send_header('X-Accel-Buffering', 'no')  # Disable nginx buffering
             self.end_headers()
             
-            # Flush headers immediately so browser knows connection is established
-            self.wfile.flush()
-            
-            # Send initial keep-alive comment
+            # Send initial comment so the browser knows the connection is established
             self.wfile.write(b': connected\n\n')
             self.wfile.flush()
             
-            # Now connect to the sovereign server
-            url = f'{SOVEREIGN_URL}{self.path}'
-            req = urllib.request.Request(url)
-            req.add_header('Accept', 'text/event-stream')
-            req.add_header('Cache-Control', 'no-cache')
-            
-            # Open connection with no timeout (we already have keep-alive to client)
-            try:
-                response = urllib.request.urlopen(req, timeout=None)
-            except Exception as e:
-                self.wfile.write(f': error connecting to event server: {e}\n\n'.encode())
-                self.wfile.flush()
-                return  # Don't raise, just return to close connection gracefully
-            
-            # Use the underlying file object for better streaming control
-            # Read from the response's underlying file-like object
-            fp = response.fp
-            
-            # Stream data in small chunks for real-time forwarding
-            last_data_time = time.time()
-            try:
-                while True:
-                    # Read line by line for proper SSE format handling
-                    line = fp.readline()
-                    if line:
-                        # Write line immediately and flush
-                        self.wfile.write(line)
-                        self.wfile.flush()  # Critical: flush after each line for SSE
-                        last_data_time = time.time()
-                    else:
-                        # Send keep-alive comment every 15 seconds to prevent timeout
-                        if time.time() - last_data_time > 15:
-                            try:
-                                self.wfile.write(b': keep-alive\n\n')
-                                self.wfile.flush()
-                                last_data_time = time.time()
-                            except:
-                                break
-                        # No data available, small sleep
-                        time.sleep(0.1)
-                        continue
-                        
-            except (ConnectionResetError, BrokenPipeError, OSError) as e:
-                # Client disconnected, that's fine for SSE
-                pass
-            except Exception as e:
-                # Log unexpected errors
-                import sys
-                print(f"Proxy error: {e}", file=sys.stderr)
-            finally:
-                try:
-                    response.close()
-                except:
-                    pass
-                
-        except urllib.error.URLError as e:
-            logger.debug(f"SSE proxy error: {e}")
-            try:
-                self.wfile.write(f': error: {e}\n\n'.encode())
-                self.wfile.flush()
-            except:
-                pass
+            client = sse_hub.hub.subscribe(self.headers.get('Last-Event-ID'), event_filter)
+            if layout.wants_layout(query):
+                layout.engine.attach(client)
+            flow = egress.scheduler.open(egress.SSE)
+            while True:
+                data = client.get(timeout=60)
+                if data is None:
+                    break
+                if data:
+                    flow.acquire(len(data), droppable=False)
+                    self.wfile.write(data)
+                    self.wfile.flush()
+        except (ConnectionResetError, BrokenPipeError, OSError):
+            # Client disconnected, that's fine for SSE
+            pass
         except Exception as e:
-            logger.debug(f"SSE proxy error: {e}")
-            try:
-                self.wfile.write(f': error: {e}\n\n'.encode())
+            logger.debug("SSE proxy error: %s", e)
+        finally:
+            if flow is not None:
+                flow.close()
+            if client is not None:
+                layout.engine.detach(client)
+                sse_hub.hub.unsubscribe(client)
+    
+    def serve_preview(self):
+        """Serve a camera preview JPEG, or a multipart stream of previews or mosaics"""
+        url = urllib.parse.urlsplit(self.path)
+        name = url.path[len('/preview/'):]
+        params = urllib.parse.parse_qs(url.query)
+        try:
+            if name == 'mosaic':
+                cams, cols = preview.parse_mosaic_query(url.query)
+                fetch = lambda: preview.manager.request_mosaic(cams, cols)
+                stream = True
+            else:
+                cam_id = preview.parse_camera(name)
+                fetch = lambda: preview.manager.request(cam_id)
+                stream = params.get('stream', ['0'])[0] == '1'
+        except ValueError as e:
+            self.send_error(400, f"Invalid preview request: {e}")
+            return
+        except LookupError as e:
+            self.send_error(404, str(e))
+            return
+        
+        try:
+            seq, jpeg = preview.manager.wait(fetch, 0, timeout=10)
+            if jpeg is None:
+                self.send_error(503, "Preview not available yet")
+                return
+            if not stream:
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(jpeg)))
+                self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+                self.end_headers()
+                self.wfile.write(jpeg)
+                return
+            
+            self.send_response(200)
+            self.send_header('Content-Type', f"multipart/x-mixed-replace; boundary={preview.OUTPUT_BOUNDARY}")
+            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+            self.end_headers()
+            while True:
+                self.wfile.write(preview.format_part(jpeg))
                 self.wfile.flush()
-            except:
-                pass
+                last_seq = seq
+                while seq == last_seq:
+                    # Re-requesting keeps the preview alive while we wait
+                    seq, jpeg = preview.manager.wait(fetch, last_seq, timeout=preview.PREVIEW_INTERVAL * 2)
+        except (ConnectionResetError, BrokenPipeError, OSError):
+            # Client disconnected
+            pass
     
     def proxy_camera_stream(self):
-        """Proxy camera video streams with Digest authentication
-        Supports both MJPEG and H.264 streams based on requested format
+        """Proxy camera MJPEG streams from the shared per-camera ingest
+        Every viewer of a camera is served from one Digest-authenticated
+        camera connection and always receives the newest complete frame
         """
         cam_id = None
-        ip = None
-        url = None
+        broadcaster = None
+        flow = None
         try:
             # Parse camera ID and format from path
             # /video1 or /video1?format=h264 or /video1?format=mjpeg
             path_parts = self.path.split('?')
-            cam_id = path_parts[0].strip("/video")
+            try:
+                cam_id = int(path_parts[0].strip("/video"))
+            except ValueError:
+                self.send_error(400, "Invalid camera ID")
+                return
             
             # Parse query parameters
             format_type = 'mjpeg'  # default
@@ -245,95 +418,48 @@ class CORSProxyHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_error(500, "Camera password not configured")
                 return
             
-            camera_ip_prefix = os.environ.get('CAMERA_IP_PREFIX', '10.10.0')
-            ip = f"{camera_ip_prefix}.{cam_id}"
+            reason = health.prober.unavailable(cam_id, health.MJPEG)
+            if reason:
+                self.send_unavailable(reason)
+                return
             
-            # Use HTTP MJPEG stream for all cameras
-            uri = "/video1s3.mjpg"  # MJPEG
-            url = f"https://{ip}{uri}"
+            logger.debug("Camera %s: Proxying %s stream", cam_id, format_type)
             
-            logger.debug(f"camera{cam_id}: Proxying {format_type} stream from {ip}")
-
-            context = ssl._create_unverified_context()
-
-            # Step 1: Get Digest challenge
-            req1 = urllib.request.Request(url)
-            try:
-                response = urllib.request.urlopen(req1, context=context, timeout=5)
-            except urllib.error.HTTPError as e:
-                auth_header = e.headers.get("WWW-Authenticate", "")
-                if not auth_header.lower().startswith("digest"):
-                    raise Exception(f"No Digest challenge from camera")
-
-            # Parse Digest challenge
-            def extract(key):
-                match = re.search(f'{key}="([^"]+)"', auth_header)
-                return match.group(1) if match else None
-
-            realm = extract("realm")
-            nonce = extract("nonce")
-            qop = extract("qop") or "auth"
-            opaque = extract("opaque")
-            algorithm = extract("algorithm") or "md5"
-
-            nc = "00000001"
-            cnonce = secrets.token_hex(16)
-            method = "GET"
-
-            def H(x): return hash(x)
-
-            HA1 = H(f"{username}:{realm}:{password}")
-            HA2 = H(f"{method}:{uri}")
-            response = H(f"{HA1}:{nonce}:{nc}:{cnonce}:{qop}:{HA2}")
-
-            # Construct Authorization header
-            auth = (
-                f'Digest username="{username}", realm="{realm}", nonce="{nonce}", '
-                f'uri="{uri}", algorithm={algorithm}, response="{response}", '
-                f'qop={qop}, nc={nc}, cnonce="{cnonce}"'
-            )
-            if opaque:
-                auth += f', opaque="{opaque}"'
-
-            req2 = urllib.request.Request(url, headers={"Authorization": auth})
-            try:
-                stream = urllib.request.urlopen(req2, context=context, timeout=10)
-                pass  # Successfully connected, no need to log
-                self.send_response(200)
-                self.send_header("Content-Type", stream.headers.get("Content-Type", "multipart/x-mixed-replace"))
-                self.end_headers()
-
-                while True:
-                    try:
-                        chunk = stream.read(1024)
-                        if not chunk:
-                            break
-                        self.wfile.write(chunk)
-                    except (ConnectionResetError, BrokenPipeError, OSError):
-                        # Client disconnected or stream ended, that's normal
-                        break
-            except urllib.error.HTTPError as e:
-                logger.debug(f"Camera {cam_id}: HTTP error {e.code}")
-                raise
-            except urllib.error.URLError as e:
-                logger.debug(f"Camera {cam_id}: Connection error: {e}")
-                raise
-
-        except (ConnectionResetError, BrokenPipeError):
-            # Client disconnected, that's normal - don't log or send error response
-            pass
-        except urllib.error.URLError as err:
-            logger.debug(f'Camera {cam_id} at {ip}: {err}')
-            try:
+            broadcaster = mjpeg_stream.subscribe(cam_id, username, password)
+            
+            # Wait for the first frame so connection failures can still be
+            # reported as 502 before any response headers are sent
+            result = broadcaster.wait_frame(0, timeout=10)
+            if result is None or result[1] is None:
+                err = broadcaster.error or 'no frames received'
+                logger.debug('Camera %s: %s', cam_id, err)
                 self.send_response(502)
                 self.send_header('Content-Type', 'text/plain')
                 self.end_headers()
                 self.wfile.write(f'Camera {cam_id} unavailable: {err}'.encode())
-            except (ConnectionResetError, BrokenPipeError):
-                # Client already disconnected
-                pass
+                return
+            
+            self.send_response(200)
+            self.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={mjpeg_stream.OUTPUT_BOUNDARY}")
+            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+            self.end_headers()
+            
+            flow = egress.scheduler.open(egress.MJPEG, cam_id)
+            while result is not None:
+                seq, frame = result
+                if frame is not None:
+                    part = mjpeg_stream.format_part(frame)
+                    # A frame over the egress budget is skipped for a newer one
+                    if flow.acquire(len(part)):
+                        self.wfile.write(part)
+                        metrics.egress_bytes.inc(cam_id, 'mjpeg', amount=len(part))
+                result = broadcaster.wait_frame(seq, timeout=1.0)
+
+        except (ConnectionResetError, BrokenPipeError, OSError):
+            # Client disconnected, that's normal - don't log or send error response
+            pass
         except Exception as err:
-            logger.debug(f'Camera {cam_id} error: {err}')
+            logger.debug('Camera %s error: %s', cam_id, err)
             try:
                 self.send_response(502)
                 self.send_header('Content-Type', 'text/plain')
@@ -342,38 +468,140 @@ class CORSProxyHandler(http.server.SimpleHTTPRequestHandler):
             except (ConnectionResetError, BrokenPipeError):
                 # Client already disconnected
                 pass
+        finally:
+            if flow is not None:
+                flow.close()
+            if broadcaster is not None:
+                broadcaster.remove_viewer()
+
+class ProxyTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    
+    def __init__(self, *args, **kwargs):
+        # Connections passed to another worker (see CORSProxyHandler.hand_off)
+        self.handed_off = set()
+        super().__init__(*args, **kwargs)
+    
+    def server_bind(self):
+        if workers.enabled():
+            # Every worker listens on every port
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+    
+    def shutdown_request(self, request):
+        if request in self.handed_off:
+            # The connection lives on in the other worker: close, don't shut down
+            self.handed_off.discard(request)
+            self.close_request(request)
+            return
+        super().shutdown_request(request)
+
+
+# {port: ProxyTCPServer} once run_server() has bound them
+SERVERS = {}
+
+
+def adopt_connection(sock, port, head):
+    """Serve a connection another worker handed over (see workers.py)"""
+    server = SERVERS.get(port) or next(iter(SERVERS.values()))
+    server.process_request(workers.AdoptedSocket(sock, head), sock.getpeername())
+
 
 def run_server(port):
     """Run a single server instance on the specified port"""
-    class ReuseTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-        allow_reuse_address = True
-        daemon_threads = True
-    
-    with ReuseTCPServer(("", port), CORSProxyHandler) as httpd:
+    with ProxyTCPServer(("", port), CORSProxyHandler) as httpd:
+        SERVERS[port] = httpd
         httpd.serve_forever()
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Camera wall proxy server')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='serve all ports from a single asyncio event loop instead of a thread per connection')
+    parser.add_argument('--http2-port', type=int,
+                        help='also listen for HTTP/2 on this port (h2c, or TLS with --tls-cert/--tls-key); needs the h2 package')
+    parser.add_argument('--tls-cert', help='certificate file for the HTTP/2 listener')
+    parser.add_argument('--tls-key', help='private key file for the HTTP/2 listener')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='run this many worker processes sharing the ports, each ingesting a shard of the cameras')
+    parser.add_argument('--worker-index', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--handoff-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
     os.chdir(Path(__file__).parent)
     
+    # Exit through sys.exit on SIGTERM so atexit kills the FFmpeg children
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
     CAMERA_PASSWORD = os.environ.get('CAMERA_PASSWORD') or getpass.getpass('Honeywell IP camera password: ')
     
-    # Ports for camera servers
-    PORTS = [8000, 8001, 8002, 8003, 8004, 8005]
+    # Ports for camera servers, from the topology section of priorities.json
+    PORTS = topology.topology.ports()
+    
+    if args.worker_index is None:
+        print("Starting camera proxy servers...")
+        print("")
+        print("Camera distribution:")
+        for port, cams in topology.topology.shard().items():
+            print(f"  Port {port}: cameras {', '.join(str(cam) for cam in cams)}")
+        print("")
+        print(f"Open http://localhost:{PORTS[0]}/index.html in your browser")
+        print(f"SSE endpoint at http://localhost:{PORTS[0]}/api/v1/subscribe")
+        print("Press Ctrl+C to stop all servers")
+        print("")
+    
+    if args.workers > 1 and args.worker_index is None:
+        if not workers.SUPPORTED:
+            print("Error: --workers needs SO_REUSEPORT and socket.send_fds (Linux, Python 3.9+)")
+            sys.exit(1)
+        if args.http2_port:
+            # One HTTP/2 connection carries every camera, so it cannot be sharded
+            print("Error: --http2-port cannot be combined with --workers")
+            sys.exit(1)
+        print("Worker processes:")
+        for worker, cams in topology.topology.worker_shard(args.workers).items():
+            print(f"  Worker {worker}: cameras {', '.join(str(cam) for cam in cams)}")
+        print("")
+        env = dict(os.environ, CAMERA_PASSWORD=CAMERA_PASSWORD, CAMERA_USERNAME=CAMERA_USERNAME)
+        workers.run_supervisor(args.workers, os.path.abspath(Path(__file__).name), sys.argv[1:], env)
+        sys.exit(0)
+    if args.worker_index is not None:
+        workers.configure(args.worker_index, args.workers, args.handoff_dir)
+        logger.info("Worker %s of %s (pid %s)", args.worker_index, args.workers, os.getpid())
+    
+    # Resolve the FFmpeg binary once up front rather than per stream
+    logger.info("Using FFmpeg at %s", mpegts_stream.get_ffmpeg_path())
+    health.start(CAMERA_USERNAME, CAMERA_PASSWORD)
+    stream_lifecycle.start(sse_hub.hub, CAMERA_USERNAME, CAMERA_PASSWORD)
+    clips.start(sse_hub.hub, CAMERA_USERNAME, CAMERA_PASSWORD)
+    layout.start(sse_hub.hub, CAMERA_USERNAME, CAMERA_PASSWORD)
+    egress.start(sse_hub.hub)
+    preview.manager.configure(CAMERA_USERNAME, CAMERA_PASSWORD)
+    
+    http2_port = None
+    ssl_context = None
+    if args.http2_port:
+        import http2_server
+        if not http2_server.available():
+            print("Error: --http2-port needs the h2 package (pip install h2)")
+            sys.exit(1)
+        if args.tls_cert:
+            ssl_context = http2_server.create_ssl_context(args.tls_cert, args.tls_key)
+        http2_port = args.http2_port
+        scheme = 'https' if ssl_context else 'http'
+        print(f"HTTP/2 listener at {scheme}://localhost:{http2_port}/index.html (all cameras on one connection)")
+        print("")
+    
+    if args.asyncio:
+        import async_server
+        try:
+            async_server.run(PORTS, CAMERA_USERNAME, CAMERA_PASSWORD, http2_port, ssl_context)
+        except KeyboardInterrupt:
+            print("\nShutting down all servers...")
+        sys.exit(0)
     
-    print("Starting camera proxy servers...")
-    print("")
-    print("Camera distribution:")
-    print("  Port 8000: cameras 13, 11, 12, 9")
-    print("  Port 8001: cameras 10, 8, 7, 4")
-    print("  Port 8002: cameras 2, 3, 1, 5")
-    print("  Port 8003: cameras 6, 14, 15, 16")
-    print("  Port 8004: cameras 17, 18, 19, 20")
-    print("  Port 8005: cameras 21, 22, 23, 24, 25, 26")
-    print("")
-    print(f"Open http://localhost:8000/index.html in your browser")
-    print(f"SSE endpoint at http://localhost:8000/api/v1/subscribe")
-    print("Press Ctrl+C to stop all servers")
-    print("")
+    if http2_port:
+        http2_server.start(http2_port, CAMERA_USERNAME, CAMERA_PASSWORD, ssl_context)
     
     # Start servers in separate threads
     threads = []
@@ -381,6 +609,8 @@ if __name__ == '__main__':
         thread = threading.Thread(target=run_server, args=(port,), daemon=True)
         thread.start()
         threads.append(thread)
+    if workers.enabled():
+        workers.serve_handoffs(adopt_connection)
     
     try:
         # Keep main thread alive
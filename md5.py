@@ -1,11 +1,36 @@
 # correct_pure_md5.py
 # RFC 1321-compliant MD5 (pure Python)
+# Used as a fallback when hashlib has no MD5 (e.g. FIPS builds) and to
+# cross-check the C implementation; see digest_auth.py.
 
+import math
 import struct
 
+# Constants for MD5 (computed once at import)
+T = [int(abs(math.sin(i + 1)) * 2**32) & 0xffffffff for i in range(64)]
+SHIFTS = [7, 12, 17, 22] * 4 + \
+         [5, 9, 14, 20] * 4 + \
+         [4, 11, 16, 23] * 4 + \
+         [6, 10, 15, 21] * 4
+
 def left_rotate(x, c):
     return ((x << c) | (x >> (32 - c))) & 0xffffffff
 
+def F(i, b, c, d):
+    if i < 16: return (b & c) | (~b & d)
+    elif i < 32: return (d & b) | (~d & c)
+    elif i < 48: return b ^ c ^ d
+    else: return c ^ (b | ~d)
+
+def G(i):
+    if i < 16: return i
+    elif i < 32: return (5*i + 1) % 16
+    elif i < 48: return (3*i + 5) % 16
+    else: return (7*i) % 16
+
+# Message word index for each round
+G_INDEX = [G(i) for i in range(64)]
+
 def hash(message):
     if isinstance(message, str):
         message = message.encode("utf-8")
@@ -18,34 +43,14 @@ def hash(message):
     # Initial values per RFC
     a0, b0, c0, d0 = (0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476)
 
-    # Constants for MD5
-    T = [int(abs(__import__('math').sin(i + 1)) * 2**32) & 0xffffffff for i in range(64)]
-    shifts = [7, 12, 17, 22] * 4 + \
-             [5, 9, 14, 20] * 4 + \
-             [4, 11, 16, 23] * 4 + \
-             [6, 10, 15, 21] * 4
-
-    def F(i, b, c, d):
-        if i < 16: return (b & c) | (~b & d)
-        elif i < 32: return (d & b) | (~d & c)
-        elif i < 48: return b ^ c ^ d
-        else: return c ^ (b | ~d)
-
-    def G(i):
-        if i < 16: return i
-        elif i < 32: return (5*i + 1) % 16
-        elif i < 48: return (3*i + 5) % 16
-        else: return (7*i) % 16
-
     for chunk_offset in range(0, len(message), 64):
         a, b, c, d = a0, b0, c0, d0
-        M = list(struct.unpack('<16I', message[chunk_offset:chunk_offset + 64]))
+        M = struct.unpack('<16I', message[chunk_offset:chunk_offset + 64])
 
         for i in range(64):
             f = F(i, b, c, d)
-            g = G(i)
-            to_rotate = (a + f + T[i] + M[g]) & 0xffffffff
-            new_b = (b + left_rotate(to_rotate, shifts[i])) & 0xffffffff
+            to_rotate = (a + f + T[i] + M[G_INDEX[i]]) & 0xffffffff
+            new_b = (b + left_rotate(to_rotate, SHIFTS[i])) & 0xffffffff
             a, b, c, d = d, new_b, b, c
 
         a0 = (a0 + a) & 0xffffffff
@@ -53,4 +58,4 @@ def hash(message):
         c0 = (c0 + c) & 0xffffffff
         d0 = (d0 + d) & 0xffffffff
 
-    return ''.join(f'{x:02x}' for x in struct.pack('<4I', a0, b0, c0, d0))
\ No newline at end of file
+    return ''.join(f'{x:02x}' for x in struct.pack('<4I', a0, b0, c0, d0))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Prometheus-style metrics for the camera proxy
+A small in-process registry of counters, gauges and histograms (labelled,
+thread safe) plus collector callbacks that read state the other modules
+already keep (pool stats, FFmpeg supervisor, SSE hub), rendered in the
+Prometheus text exposition format for /metrics.
+"""
+
+import math
+import time
+import threading
+
+PREFIX = 'camproxy_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Default histogram buckets in seconds (connect, auth, first-output times)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+class Metric:
+    """Base for a named metric with a fixed set of label names"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(str(value) for value in labels)
+
+    def remove(self, *labels):
+        with self.lock:
+            self.values.pop(self._key(labels), None)
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        if not items and not self.labelnames:
+            # Unlabelled series are exported as 0 before their first update
+            items = [((), 0)]
+        for key, value in items:
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, *labels, value):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, *labels, value):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self.values.items())
+        for key, (counts, total, count) in items:
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', labels + (('le', _format_value(float(bound))),), cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+def snapshot(metric_class, name, documentation, labelnames, values):
+    """Build a one-off metric from {label values: value}, for collectors"""
+    metric = metric_class(name, documentation, labelnames)
+    metric.values = {tuple(str(label) for label in key): value for key, value in values.items()}
+    return metric
+
+
+class Timer:
+    """Context manager observing its elapsed time into a histogram"""
+
+    def __init__(self, histogram, *labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(*self.labels, value=time.monotonic() - self.start)
+
+
+class Registry:
+    """Metrics plus collectors rendered together for /metrics"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        """Register collector() returning an iterable of Metric snapshots, called per scrape"""
+        with self.lock:
+            self.collectors.append(collector)
+
+    def render(self):
+        """Return the text exposition of every metric as bytes"""
+        with self.lock:
+            metrics = list(self.metrics)
+            collectors = list(self.collectors)
+        for collector in collectors:
+            metrics.extend(collector())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+# Shared registry and the metrics updated inline by the streaming code
+registry = Registry()
+
+ingest_bytes = registry.counter(
+    'camera_ingest_bytes_total', 'Bytes received from cameras', ('camera', 'format'))
+egress_bytes = registry.counter(
+    'camera_egress_bytes_total', 'Bytes sent to viewers', ('camera', 'format'))
+frames = registry.counter(
+    'camera_frames_total', 'Video frames received from cameras (TS counts PES starts)', ('camera', 'format'))
+ts_dropped_packets = registry.counter(
+    'ts_dropped_packets_total', 'TS packets discarded for slow viewers', ('camera',))
+ffmpeg_first_output = registry.histogram(
+    'ffmpeg_first_output_seconds', 'Time from FFmpeg start to its first TS bytes')
+camera_connect = registry.histogram(
+    'camera_connect_seconds', 'TCP+TLS connect time to cameras')
+digest_auth = registry.histogram(
+    'digest_auth_seconds', 'Time to an authenticated camera response, including any 401 challenge',
+    ('result',))
+ffmpeg_starts = registry.counter(
+    'ffmpeg_starts_total', 'FFmpeg processes started (first start plus restarts)', ('camera',))
+ffmpeg_stalls = registry.counter(
+    'ffmpeg_stalls_total', 'FFmpeg processes killed by the stall watchdog', ('camera',))
+sse_events = registry.counter(
+    'sse_events_total', 'Events received from the upstream event server')
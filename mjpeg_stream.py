@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Shared MJPEG ingest for the /video<id> endpoints
+Opens one Digest-authenticated HTTPS connection per camera, splits the
+multipart/x-mixed-replace stream into whole JPEG frames once, and hands
+every viewer the newest complete frame. Slow viewers simply skip the
+frames they were too slow for instead of holding up the camera connection.
+"""
+
+import re
+import logging
+import threading
+
+import digest_auth
+import camera_pool
+import metrics
+from topology import topology
+
+logger = logging.getLogger(__name__)
+
+# MJPEG stream path on the camera
+MJPEG_URI = "/video1s3.mjpg"
+
+# Bytes requested per read from the camera connection
+READ_SIZE = 64 * 1024
+
+# Give up on a part that grows beyond this without a boundary
+MAX_FRAME_BYTES = 8 * 1024 * 1024
+
+# Boundary used for the multipart stream we send to viewers
+OUTPUT_BOUNDARY = 'frame'
+
+# Track active MJPEG ingests: {cam_id: MjpegBroadcaster}
+active_mjpeg_broadcasters = {}
+_broadcasters_lock = threading.Lock()
+
+
+def get_camera_host(cam_id):
+    """Get the host address for a camera"""
+    return topology.camera_ip(cam_id)
+
+
+def open_camera_stream(cam_id, username, password):
+    """Open an authenticated MJPEG stream from a camera using Digest auth"""
+    host = get_camera_host(cam_id)
+    auth = digest_auth.get_auth(host, username, password)
+    return camera_pool.pool.open_digest(host, MJPEG_URI, auth, timeout=10)
+
+
+def get_boundary(content_type):
+    """Extract the multipart boundary from a Content-Type header"""
+    match = re.search(r'boundary="?([^";]+)"?', content_type or '')
+    if not match:
+        return None
+    return match.group(1).strip().encode('latin-1')
+
+
+class MultipartFrameParser:
+    """Incrementally split a multipart/x-mixed-replace body into parts"""
+
+    def __init__(self, boundary):
+        # Some cameras include the leading "--" in the header value and some
+        # don't, so search for the bare boundary token
+        self.boundary = boundary[2:] if boundary.startswith(b'--') else boundary
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add data and return the list of complete part bodies"""
+        self.buffer += data
+        frames = []
+
+        while True:
+            start = self.buffer.find(self.boundary)
+            if start == -1:
+                break
+            header_end = self.buffer.find(b'\r\n\r\n', start)
+            if header_end == -1:
+                break
+            body_start = header_end + 4
+
+            length = None
+            headers = bytes(self.buffer[start:header_end]).lower()
+            match = re.search(rb'content-length:\s*(\d+)', headers)
+            if match:
+                length = int(match.group(1))
+
+            if length is not None:
+                if len(self.buffer) < body_start + length:
+                    break
+                frames.append(bytes(self.buffer[body_start:body_start + length]))
+                del self.buffer[:body_start + length]
+            else:
+                end = self.buffer.find(self.boundary, body_start)
+                if end == -1:
+                    break
+                body = bytes(self.buffer[body_start:end]).rstrip(b'-').rstrip(b'\r\n')
+                frames.append(body)
+                del self.buffer[:end]
+
+        if len(self.buffer) > MAX_FRAME_BYTES:
+            logger.debug("MJPEG part exceeded %s bytes, resyncing", MAX_FRAME_BYTES)
+            self.buffer.clear()
+
+        return frames
+
+
+def format_part(frame):
+    """Wrap a JPEG frame as one part of our outgoing multipart stream"""
+    header = (
+        f'--{OUTPUT_BOUNDARY}\r\n'
+        f'Content-Type: image/jpeg\r\n'
+        f'Content-Length: {len(frame)}\r\n\r\n'
+    ).encode()
+    return header + frame + b'\r\n'
+
+
+class MjpegBroadcaster:
+    """Single camera connection whose frames are shared by all viewers"""
+
+    def __init__(self, cam_id, username, password):
+        self.cam_id = cam_id
+        self.username = username
+        self.password = password
+        self.viewers = 0
+        self.cond = threading.Condition()
+        self.frame = None
+        self.seq = 0
+        self.closed = False
+        self.error = None
+        self.stream = None
+        self.thread = None
+        # Callables invoked on every new frame and on close, used by the
+        # asyncio server instead of blocking in wait_frame()
+        self.wakers = set()
+
+    def add_viewer(self):
+        with self.cond:
+            self.viewers += 1
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name=f'mjpeg-{self.cam_id}', daemon=True
+                )
+                self.thread.start()
+            count = self.viewers
+        logger.debug("Camera %s: MJPEG viewer joined (%s watching)", self.cam_id, count)
+
+    def remove_viewer(self):
+        with _broadcasters_lock:
+            with self.cond:
+                self.viewers -= 1
+                count = self.viewers
+            if count == 0 and active_mjpeg_broadcasters.get(self.cam_id) is self:
+                del active_mjpeg_broadcasters[self.cam_id]
+        logger.debug("Camera %s: MJPEG viewer left (%s watching)", self.cam_id, count)
+        if count == 0:
+            self.stop()
+
+    def wait_frame(self, last_seq, timeout=None):
+        """Wait for a frame newer than last_seq
+
+        Returns (seq, frame), (last_seq, None) on timeout, or None once the
+        ingest has ended.
+        """
+        with self.cond:
+            if self.seq == last_seq and not self.closed:
+                self.cond.wait(timeout)
+            if self.seq != last_seq and self.frame is not None:
+                return self.seq, self.frame
+            if self.closed:
+                return None
+            return last_seq, None
+
+    def add_waker(self, waker):
+        with self.cond:
+            self.wakers.add(waker)
+
+    def remove_waker(self, waker):
+        with self.cond:
+            self.wakers.discard(waker)
+
+    def latest(self):
+        """Return (seq, frame) for the newest frame without waiting"""
+        with self.cond:
+            return self.seq, self.frame
+
+    def _wake(self):
+        for waker in list(self.wakers):
+            waker()
+
+    def stop(self):
+        with _broadcasters_lock:
+            if active_mjpeg_broadcasters.get(self.cam_id) is self:
+                del active_mjpeg_broadcasters[self.cam_id]
+        with self.cond:
+            self.closed = True
+            stream = self.stream
+            self.cond.notify_all()
+            self._wake()
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    def _run(self):
+        try:
+            stream = open_camera_stream(self.cam_id, self.username, self.password)
+            with self.cond:
+                self.stream = stream
+                closed = self.closed
+            if closed:
+                stream.close()
+                return
+
+            boundary = get_boundary(stream.headers.get("Content-Type", ""))
+            if boundary is None:
+                raise Exception("Camera stream has no multipart boundary")
+            parser = MultipartFrameParser(boundary)
+
+            while not self.closed:
+                chunk = stream.read1(READ_SIZE)
+                if not chunk:
+                    break
+                metrics.ingest_bytes.inc(self.cam_id, 'mjpeg', amount=len(chunk))
+                frames = parser.feed(chunk)
+                if frames:
+                    metrics.frames.inc(self.cam_id, 'mjpeg', amount=len(frames))
+                    with self.cond:
+                        # Only the newest frame matters to viewers
+                        self.frame = frames[-1]
+                        self.seq += 1
+                        self.cond.notify_all()
+                        self._wake()
+        except Exception as err:
+            if not self.closed:
+                logger.debug('Camera %s MJPEG ingest error: %s', self.cam_id, err)
+                self.error = err
+        finally:
+            self.stop()
+
+
+def subscribe(cam_id, username, password):
+    """Attach a viewer to the camera's shared MJPEG ingest, creating it if needed"""
+    with _broadcasters_lock:
+        broadcaster = active_mjpeg_broadcasters.get(cam_id)
+        if broadcaster is None:
+            broadcaster = MjpegBroadcaster(cam_id, username, password)
+            active_mjpeg_broadcasters[cam_id] = broadcaster
+        broadcaster.add_viewer()
+    return broadcaster
+
+
+def _collect_metrics():
+    with _broadcasters_lock:
+        broadcasters = list(active_mjpeg_broadcasters.values())
+    viewers = {(broadcaster.cam_id,): broadcaster.viewers for broadcaster in broadcasters}
+    return [metrics.snapshot(metrics.Gauge, 'mjpeg_viewers', 'Connected MJPEG viewers', ('camera',), viewers)]
+
+
+metrics.registry.add_collector(_collect_metrics)
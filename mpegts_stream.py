@@ -3,218 +3,832 @@
 MPEG-TS over HTTP streaming for ultra-low latency
 Uses FFmpeg to transcode RTSP to MPEG-TS and stream over HTTP
 Target latency: 200-500ms (much better than HLS)
+
+Each camera has a single broadcaster that owns one FFmpeg/RTSP session and
+fans the TS packets out to every connected viewer through bounded per-client
+ring buffers, so N viewers cost one camera connection instead of N. New
+viewers are primed from a GOP cache so they can paint a frame immediately.
+A broadcaster lingers for a while after its last viewer leaves, and can be
+held open without viewers (prewarmed, see stream_lifecycle.py), so cameras
+rotating back into view skip the RTSP setup and keyframe wait.
+FFmpeg processes are owned by ffmpeg_supervisor, which drains their stderr,
+kills stalled ones and paces restarts.
+Broadcasters are per camera and quality tier (main or sub RTSP stream, see
+quality.py); a viewer following the quality policy moves between them at a
+keyframe without its HTTP response being interrupted.
 """
 
-import subprocess
+import os
+import time
+import shutil
 import urllib.parse
 import logging
 import threading
-import time
+import collections
 from pathlib import Path
 
+import egress
+import metrics
+import quality
+from topology import topology
+from gop_cache import GopCache, PacketHistory
+from ffmpeg_supervisor import supervisor, Backoff
+
 logger = logging.getLogger(__name__)
 
-# RTSP paths with fallback order
-RTSP_PATHS = [
-    '/live1s2.sdp',  # Sub-stream
-    '/live1s1.sdp',  # Main stream
-]
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+
+# Reusable ingest buffer: each read takes whatever the FFmpeg pipe holds,
+# up to 348 packets (~64 KB)
+INGEST_BUFFER_SIZE = TS_PACKET_SIZE * 348
+
+# Viewer writes are coalesced until this many bytes are queued or the oldest
+# queued data has waited WRITE_LATENCY_BUDGET seconds (0 disables)
+WRITE_COALESCE_BYTES = int(os.environ.get('MPEGTS_WRITE_COALESCE_BYTES', str(32 * 1024)))
+WRITE_LATENCY_BUDGET = float(os.environ.get('MPEGTS_WRITE_LATENCY_MS', '5')) / 1000
+
+# Max buffers per sendmsg() call
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# Per-client ring buffer capacity in TS packets (~940 KB by default). A client
+# that falls this far behind is skipped ahead to the next keyframe, and a
+# client that keeps falling behind is dropped so it cannot stall the others.
+CLIENT_BUFFER_PACKETS = int(os.environ.get('MPEGTS_CLIENT_BUFFER_PACKETS', '5000'))
+CLIENT_MAX_SKIPS = int(os.environ.get('MPEGTS_CLIENT_MAX_SKIPS', '5'))
 
-# Track active FFmpeg processes: {cam_id: process}
-active_mpegts_processes = {}
+# Seconds FFmpeg keeps running after the last viewer of a camera leaves
+LINGER_SECONDS = float(os.environ.get('MPEGTS_LINGER_SECONDS', '30'))
+
+# A tier switch is abandoned if the new stream has no keyframe by then, and
+# that tier is not tried again for this viewer for SWITCH_RETRY_SECONDS
+SWITCH_TIMEOUT = float(os.environ.get('MPEGTS_SWITCH_TIMEOUT', '10'))
+SWITCH_RETRY_SECONDS = 60
+
+# Seconds of recent stream each broadcaster keeps for pre-event clips
+# (clips.py), bounded in memory; 0 disables the history
+HISTORY_SECONDS = float(os.environ.get('MPEGTS_HISTORY_SECONDS', '10'))
+HISTORY_MAX_BYTES = int(os.environ.get('MPEGTS_HISTORY_MAX_BYTES', str(16 * 1024 * 1024)))
+
+# Track active broadcasters: {(cam_id, tier): MpegtsBroadcaster}
+active_broadcasters = {}
+_broadcasters_lock = threading.Lock()
+
+
+# Resolved once by get_ffmpeg_path()
+_ffmpeg_path = None
 
 
 def get_ffmpeg_path():
-    """Get FFmpeg binary path"""
+    """FFmpeg binary path, resolved on first use and cached"""
+    global _ffmpeg_path
+    if _ffmpeg_path is None:
+        _ffmpeg_path = _find_ffmpeg()
+    return _ffmpeg_path
+
+
+def _find_ffmpeg():
+    """FFMPEG_PATH, else the bundled binary, else ffmpeg from PATH"""
     import platform
-    
+
+    if os.environ.get('FFMPEG_PATH'):
+        return os.environ['FFMPEG_PATH']
+
     bin_dir = Path(__file__).parent / 'bin'
     os_name = platform.system().lower()
     arch = platform.machine().lower()
-    
+
     if arch in ['x86_64', 'amd64']:
         arch = 'amd64'
     elif arch in ['arm64', 'aarch64']:
         arch = 'arm64'
-    
+
     if os_name == 'darwin':
         os_name = 'darwin'
     elif os_name == 'linux':
         os_name = 'linux'
-    
+
     local_binary = bin_dir / f'ffmpeg-{os_name}-{arch}'
     if local_binary.exists() and local_binary.is_file():
         return str(local_binary)
-    
-    return 'ffmpeg'
+
+    return shutil.which('ffmpeg') or 'ffmpeg'
 
 
 def get_camera_ip(cam_id):
     """Get IP address for a camera"""
-    return f"10.10.0.{cam_id}"
+    return topology.camera_ip(cam_id)
+
+
+def build_ffmpeg_cmd(rtsp_url):
+    """Build the FFmpeg command line that remuxes RTSP to MPEG-TS on stdout"""
+    # ULTRA LOW LATENCY MPEG-TS COMMAND
+    return [
+        get_ffmpeg_path(),
+        '-hide_banner',
+        '-loglevel', 'warning',         # Show warnings for debugging
+        '-rtsp_transport', 'tcp',       # TCP for reliability
+        '-i', rtsp_url,                 # Input RTSP
+
+        # Video: Copy (no re-encoding for minimal latency)
+        '-c:v', 'copy',                 # Copy video stream
+        '-bsf:v', 'h264_mp4toannexb',   # Convert to Annex B
+
+        # Audio: Disable (saves bandwidth)
+        '-an',
+
+        # MPEG-TS output settings (ABSOLUTE MINIMUM LATENCY)
+        '-f', 'mpegts',                 # MPEG-TS format
+        '-mpegts_copyts', '1',          # Copy timestamps
+        '-mpegts_flags', 'initial_discontinuity', # Handle stream restarts
+        '-muxdelay', '0',               # Zero mux delay
+        '-muxpreload', '0',             # Zero preload
+        '-flush_packets', '1',          # Flush immediately
+        '-fflags', 'nobuffer',          # No buffering
+        '-flags', 'low_delay',          # Low delay mode
+        '-max_delay', '0',              # No delay
+
+        # Output to pipe (stdout)
+        'pipe:1'
+    ]
+
+
+class TSSubscriber:
+    """Bounded ring buffer of TS packets for a single viewer"""
+
+    def __init__(self, cam_id, max_packets=CLIENT_BUFFER_PACKETS, awaiting_keyframe=False):
+        self.cam_id = cam_id
+        self.max_packets = max_packets
+        self.chunks = collections.deque()
+        self.buffered_packets = 0
+        self.oldest_queued = None
+        self.dropped_packets = 0
+        self.skips = 0
+        # Start at the next keyframe (with PAT/PMT in front) rather than mid-GOP
+        self.awaiting_keyframe = awaiting_keyframe
+        self.closed = False
+        self.cond = threading.Condition()
+        # Optional callable invoked when data arrives or the subscriber
+        # closes, used by the asyncio server to wake its writer task
+        self.waker = None
+
+    def push(self, chunk, keyframe_offset=-1, tables=b''):
+        """Queue a packet-aligned chunk; called from the broadcaster thread
+
+        keyframe_offset is where a keyframe starts inside chunk (-1 if none)
+        and tables holds the PAT/PMT to resend when resyncing on it.
+        """
+        with self.cond:
+            if self.closed:
+                return
+            if self.buffered_packets + len(chunk) // TS_PACKET_SIZE > self.max_packets:
+                # Slow client: discard its backlog and skip ahead to the next keyframe
+                self.dropped_packets += self.buffered_packets
+                metrics.ts_dropped_packets.inc(self.cam_id, amount=self.buffered_packets)
+                self.chunks.clear()
+                self.buffered_packets = 0
+                self.skips += 1
+                if self.skips > CLIENT_MAX_SKIPS:
+                    logger.info("Camera %s: Dropping slow client after %s skips", self.cam_id, self.skips)
+                    self.closed = True
+                    self.cond.notify_all()
+                    if self.waker is not None:
+                        self.waker()
+                    return
+                logger.debug("Camera %s: Slow client skipped ahead (%s packets dropped)", self.cam_id, self.dropped_packets)
+                self.awaiting_keyframe = True
+            if self.awaiting_keyframe:
+                if keyframe_offset == -1:
+                    if self.skips:
+                        self.dropped_packets += len(chunk) // TS_PACKET_SIZE
+                        metrics.ts_dropped_packets.inc(self.cam_id, amount=len(chunk) // TS_PACKET_SIZE)
+                    return
+                chunk = tables + chunk[keyframe_offset:]
+                self.awaiting_keyframe = False
+            packets = len(chunk) // TS_PACKET_SIZE
+            if not self.chunks:
+                self.oldest_queued = time.monotonic()
+            self.chunks.append(chunk)
+            self.buffered_packets += packets
+            self.cond.notify()
+            if self.waker is not None:
+                self.waker()
+
+    def coalesce_delay(self, now=None):
+        """Seconds to keep waiting for more data before writing, 0 if ready"""
+        if not self.chunks or self.closed or WRITE_LATENCY_BUDGET <= 0:
+            return 0
+        if self.buffered_packets * TS_PACKET_SIZE >= WRITE_COALESCE_BYTES:
+            return 0
+        now = time.monotonic() if now is None else now
+        return max(self.oldest_queued + WRITE_LATENCY_BUDGET - now, 0)
+
+    def get_chunks(self, timeout=None, coalesce=True):
+        """Wait for queued data and return the list of queued chunks
+
+        With coalesce, small amounts of data are held back for up to
+        WRITE_LATENCY_BUDGET so they go out in fewer, larger writes.
+        Returns [] on timeout and None once the subscriber is closed.
+        """
+        with self.cond:
+            if not self.chunks and not self.closed:
+                self.cond.wait(timeout)
+            while coalesce:
+                delay = self.coalesce_delay()
+                if not delay:
+                    break
+                self.cond.wait(delay)
+            if self.chunks:
+                chunks = list(self.chunks)
+                self.chunks.clear()
+                self.buffered_packets = 0
+                return chunks
+            if self.closed:
+                return None
+            return []
+
+    def get(self, timeout=None):
+        """Wait for queued data and return it as one bytes object
+
+        Returns b'' on timeout and None once the subscriber is closed.
+        """
+        chunks = self.get_chunks(timeout, coalesce=False)
+        if chunks is None:
+            return None
+        return b''.join(chunks)
+
+    def resync(self, dropped_packets=0):
+        """Discard the backlog and restart at the next keyframe, after the
+        writer dropped dropped_packets (e.g. for the egress budget)"""
+        with self.cond:
+            dropped_packets += self.buffered_packets
+            self.dropped_packets += dropped_packets
+            metrics.ts_dropped_packets.inc(self.cam_id, amount=dropped_packets)
+            self.chunks.clear()
+            self.buffered_packets = 0
+            self.awaiting_keyframe = True
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            if self.waker is not None:
+                self.waker()
+
+
+class MpegtsBroadcaster:
+    """Single FFmpeg/RTSP session for one camera tier shared by all its viewers"""
+
+    def __init__(self, cam_id, username, password, tier=quality.DEFAULT_TIER):
+        self.cam_id = cam_id
+        self.tier = tier
+        self.key = (cam_id, tier)
+        # Names the stream for the supervisor's preferred RTSP paths
+        self.stream = f'{cam_id}/{tier}'
+        self.username = username
+        self.password = password
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.process = None
+        self.thread = None
+        self.stopping = False
+        # Set by stop() to cut a restart backoff short
+        self.wakeup = threading.Event()
+        self.gop = GopCache()
+        self.history = PacketHistory(HISTORY_SECONDS, HISTORY_MAX_BYTES) if HISTORY_SECONDS > 0 else None
+        # Prewarm references keeping the ingest alive without viewers
+        self.holds = 0
+        self.linger_timer = None
+
+    def _ensure_running(self):
+        # Caller holds self.lock
+        if self.linger_timer is not None:
+            self.linger_timer.cancel()
+            self.linger_timer = None
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._run, name=f'mpegts-{self.stream}', daemon=True
+            )
+            self.thread.start()
+
+    def _schedule_linger(self):
+        # Caller holds self.lock; stop after LINGER_SECONDS if still idle
+        if self.subscribers or self.holds or self.linger_timer is not None:
+            return
+        timer = threading.Timer(max(LINGER_SECONDS, 0), self._linger_expired)
+        timer.daemon = True
+        self.linger_timer = timer
+        timer.start()
+
+    def _linger_expired(self):
+        with _broadcasters_lock:
+            with self.lock:
+                if self.subscribers or self.holds or self.linger_timer is None:
+                    return
+                self.linger_timer = None
+            if active_broadcasters.get(self.key) is self:
+                del active_broadcasters[self.key]
+        logger.info("Camera %s: No viewers for %.0fs, stopping FFmpeg", self.cam_id, LINGER_SECONDS)
+        self.stop()
+
+    def hold(self):
+        """Keep the ingest running without viewers (prewarm)"""
+        with self.lock:
+            self.holds += 1
+            self._ensure_running()
+
+    def release(self):
+        """Drop a prewarm reference taken with hold()"""
+        with self.lock:
+            self.holds = max(self.holds - 1, 0)
+            self._schedule_linger()
+
+    def subscribe(self, prime=True, history=0):
+        """Register a new viewer, starting FFmpeg if this is the first one
+
+        With prime the viewer is sent the cached PAT/PMT and current GOP so
+        its first frame is decodable straight away; without it, or while
+        no keyframe has been cached yet, the viewer starts at the next
+        keyframe (PAT/PMT first; used when switching tiers). history
+        asks for up to that many seconds of past stream instead of the GOP
+        (used for clips).
+        """
+        with self.lock:
+            prefix = self.gop.snapshot() if prime else b''
+            if history and self.history is not None and prefix:
+                prefix = self.gop.tables() + self.history.snapshot(history, time.monotonic())
+            # Room for the whole prefix on top of the usual backlog
+            max_packets = CLIENT_BUFFER_PACKETS + len(prefix) // TS_PACKET_SIZE
+            subscriber = TSSubscriber(self.cam_id, max_packets, awaiting_keyframe=not prefix)
+            if prefix:
+                subscriber.push(prefix)
+            self.subscribers.add(subscriber)
+            self._ensure_running()
+            count = len(self.subscribers)
+        logger.info("Camera %s: Viewer joined (%s watching)", self.cam_id, count)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Remove a viewer; FFmpeg lingers once nobody is left watching"""
+        subscriber.close()
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            count = len(self.subscribers)
+            self._schedule_linger()
+        logger.info("Camera %s: Viewer left (%s watching)", self.cam_id, count)
+
+    def stop(self):
+        """Terminate FFmpeg and disconnect every viewer"""
+        with _broadcasters_lock:
+            if active_broadcasters.get(self.key) is self:
+                del active_broadcasters[self.key]
+            with self.lock:
+                self.stopping = True
+                self.wakeup.set()
+                if self.linger_timer is not None:
+                    self.linger_timer.cancel()
+                    self.linger_timer = None
+                process = self.process
+                subscribers = list(self.subscribers)
+                self.subscribers.clear()
+        for subscriber in subscribers:
+            subscriber.close()
+        if process is not None:
+            supervisor.terminate(process)
+
+    def keyframe_snapshot(self):
+        """Return (keyframe id, PAT + PMT + current GOP) for preview decoding
+
+        The id changes whenever a new keyframe arrives or FFmpeg restarts;
+        the data is b'' until the first keyframe.
+        """
+        with self.lock:
+            return (id(self.process), self.gop.keyframes), self.gop.snapshot()
+
+    def _publish(self, chunk):
+        # Update the GOP cache and snapshot viewers atomically with respect to
+        # subscribe() so a joining viewer gets each packet exactly once
+        with self.lock:
+            frames = self.gop.frames
+            keyframe_offset = self.gop.feed(chunk)
+            if self.history is not None:
+                self.history.feed(chunk, keyframe_offset, time.monotonic())
+            frames = self.gop.frames - frames
+            tables = self.gop.tables()
+            subscribers = list(self.subscribers)
+        metrics.ingest_bytes.inc(self.cam_id, 'ts', amount=len(chunk))
+        if frames:
+            metrics.frames.inc(self.cam_id, 'ts', amount=frames)
+        for subscriber in subscribers:
+            subscriber.push(chunk, keyframe_offset, tables)
+            if subscriber.closed:
+                with self.lock:
+                    self.subscribers.discard(subscriber)
+
+    def _run(self):
+        """Ingest loop: run FFmpeg and fan packet-aligned chunks out to viewers
+
+        FFmpeg is restarted with exponential backoff whenever it exits or the
+        supervisor's watchdog kills it for stalling; viewers stay connected
+        across restarts. Each round starts with the RTSP path that last
+        worked for this camera. After MAX_FAILED_STARTS rounds without any
+        output the camera is given up on and its viewers are disconnected.
+        """
+        ip = get_camera_ip(self.cam_id)
+        backoff = Backoff()
+        paths = quality.RTSP_PATHS[self.tier]
+
+        try:
+            while not self.stopping:
+                started = time.monotonic()
+                bytes_sent = 0
+                # Try each RTSP path
+                for rtsp_path in supervisor.ordered_paths(self.stream, paths):
+                    if self.stopping:
+                        return
+                    started = time.monotonic()
+                    bytes_sent = self._run_ffmpeg(ip, rtsp_path)
+                    if bytes_sent:
+                        supervisor.path_worked(self.stream, rtsp_path)
+                        break
+                    if self.stopping:
+                        return
+                    logger.warning("Camera %s: No output from %s", self.cam_id, rtsp_path)
+
+                delay = backoff.record(time.monotonic() - started, bytes_sent > 0)
+                if backoff.exhausted:
+                    logger.error("Camera %s: Giving up after %s failed starts", self.cam_id, backoff.failed_starts)
+                    return
+                logger.info("Camera %s: Restarting FFmpeg in %ss", self.cam_id, delay)
+                if self.wakeup.wait(delay):
+                    return
+        except Exception:
+            logger.exception("Camera %s: Unexpected error", self.cam_id)
+        finally:
+            # Upstream is gone: disconnect viewers so browsers retry
+            self.stop()
+
+    def _run_ffmpeg(self, ip, rtsp_path):
+        """Run one FFmpeg process until it exits; returns bytes streamed"""
+        encoded_username = urllib.parse.quote(self.username, safe='')
+        encoded_password = urllib.parse.quote(self.password, safe='')
+        rtsp_url = f"rtsp://{encoded_username}:{encoded_password}@{ip}:554{rtsp_path}"
+        ffmpeg_cmd = build_ffmpeg_cmd(rtsp_url)
+
+        logger.info("Camera %s: Starting MPEG-TS %s stream from %s", self.cam_id, self.tier, ip)
+        safe_cmd = ' '.join(ffmpeg_cmd).replace(encoded_password, '***')
+        logger.info("Camera %s: %s", self.cam_id, safe_cmd)
+
+        try:
+            process = supervisor.spawn(self.cam_id, ffmpeg_cmd)
+        except Exception as e:
+            logger.error("Camera %s: Stream error: %s", self.cam_id, e)
+            return 0
+
+        with self.lock:
+            self.process = process
+            self.gop.reset()
+            if self.history is not None:
+                self.history.reset()
+            stopping = self.stopping
+        if stopping:
+            supervisor.terminate(process)
+            return 0
+        logger.info("Camera %s: FFmpeg started (PID %s)", self.cam_id, process.pid)
+
+        try:
+            bytes_sent = self._pump(process)
+        finally:
+            supervisor.terminate(process)
+            process.stdout.close()
+            with self.lock:
+                if self.process is process:
+                    self.process = None
+
+        if not self.stopping:
+            reason = 'stalled' if process.stalled else f'exit {process.returncode}'
+            logger.error("Camera %s: FFmpeg died (%s, sent %s bytes)", self.cam_id, reason, bytes_sent)
+            stderr = process.stderr_tail()
+            if stderr:
+                logger.error("Camera %s: FFmpeg stderr: %s", self.cam_id, stderr)
+        return bytes_sent
+
+    def _pump(self, process):
+        """Copy FFmpeg output to subscribers until EOF; returns bytes read
+
+        Reads straight into one reusable buffer with readinto(), blocking in
+        the kernel until FFmpeg writes, and publishes only whole packets.
+        The partial packet at the end is moved to the front of the buffer.
+        Each published chunk is copied once and shared by every viewer.
+        """
+        buf = bytearray(INGEST_BUFFER_SIZE)
+        view = memoryview(buf)
+        fill = 0
+        bytes_sent = 0
+        pipe = process.stdout
 
+        while not self.stopping:
+            n = pipe.readinto(view[fill:])
+            if not n:
+                break
+            if not process.bytes_read:
+                metrics.ffmpeg_first_output.observe(value=time.monotonic() - process.started)
+            process.record_output(n)
+            fill += n
 
-def stream_mpegts(cam_id, username, password, output_pipe):
+            # Resynchronise on the sync byte if FFmpeg output ever drifts
+            if buf[0] != TS_SYNC_BYTE:
+                offset = buf.find(TS_SYNC_BYTE, 0, fill)
+                if offset == -1:
+                    fill = 0
+                    continue
+                view[:fill - offset] = bytes(view[offset:fill])
+                fill -= offset
+
+            aligned = fill - fill % TS_PACKET_SIZE
+            if aligned:
+                self._publish(bytes(view[:aligned]))
+                bytes_sent += aligned
+                rest = fill - aligned
+                if rest:
+                    view[:rest] = bytes(view[aligned:fill])
+                fill = rest
+
+        return bytes_sent
+
+
+def _get_broadcaster(cam_id, username, password, tier):
+    # Caller holds _broadcasters_lock
+    broadcaster = active_broadcasters.get((cam_id, tier))
+    if broadcaster is None:
+        broadcaster = MpegtsBroadcaster(cam_id, username, password, tier)
+        active_broadcasters[(cam_id, tier)] = broadcaster
+    return broadcaster
+
+
+def subscribe(cam_id, username, password, tier=quality.DEFAULT_TIER, prime=True, history=0):
+    """Attach a viewer to the camera tier's shared broadcaster, creating it if needed
+
+    Returns (broadcaster, subscriber).
+    """
+    with _broadcasters_lock:
+        broadcaster = _get_broadcaster(cam_id, username, password, tier)
+        subscriber = broadcaster.subscribe(prime, history)
+    return broadcaster, subscriber
+
+
+def running_tier(cam_id):
+    """Tier of the camera's running ingest, main preferred; None if none runs"""
+    with _broadcasters_lock:
+        for tier in (quality.MAIN, quality.SUB):
+            broadcaster = active_broadcasters.get((cam_id, tier))
+            if broadcaster is not None and not broadcaster.stopping:
+                return tier
+    return None
+
+
+def prewarm(cam_id, username, password, tier=quality.DEFAULT_TIER):
+    """Start (or keep) a camera's ingest without a viewer; returns the broadcaster
+
+    Call release() on the returned broadcaster when it is no longer wanted.
+    """
+    with _broadcasters_lock:
+        broadcaster = _get_broadcaster(cam_id, username, password, tier)
+        broadcaster.hold()
+    return broadcaster
+
+
+class TieredViewer:
+    """One viewer connection whose stream can move between quality tiers
+
+    Offers the TSSubscriber reading interface. switch() subscribes to the
+    new tier straight away, but that subscriber only starts at the new
+    stream's next keyframe (PAT/PMT first); until then the viewer keeps
+    reading the old tier, and then cuts over between two packets. The player
+    sees one continuous TS whose resolution changes at a keyframe.
+    """
+
+    def __init__(self, cam_id, username, password, tier, follow_policy=False):
+        self.cam_id = cam_id
+        self.username = username
+        self.password = password
+        self.follow_policy = follow_policy
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.waker = None
+        self.closed = False
+        # (tier, broadcaster, subscriber, started) while a switch is in progress
+        self.pending = None
+        # {tier: monotonic time before which it is not retried}
+        self.failed = {}
+        if follow_policy:
+            tier = quality.policy.tier_for(cam_id)
+        self.tier = tier
+        self.broadcaster, self.subscriber = subscribe(cam_id, username, password, tier)
+        self.subscriber.waker = self._wake
+        if follow_policy:
+            quality.policy.register(self)
+
+    def _wake(self):
+        self.event.set()
+        waker = self.waker
+        if waker is not None:
+            waker()
+
+    def switch(self, tier):
+        """Start moving to tier at its next keyframe; returns True if a switch began"""
+        with self.lock:
+            if self.closed:
+                return False
+            target = self.pending[0] if self.pending else self.tier
+            if tier == target or time.monotonic() < self.failed.get(tier, 0):
+                return False
+            abandoned = self.pending
+            self.pending = None
+            switching = tier != self.tier
+            if switching:
+                broadcaster, subscriber = subscribe(
+                    self.cam_id, self.username, self.password, tier, prime=False)
+                subscriber.waker = self._wake
+                self.pending = (tier, broadcaster, subscriber, time.monotonic())
+                logger.info("Camera %s: Viewer switching %s -> %s", self.cam_id, self.tier, tier)
+        if abandoned is not None:
+            abandoned[1].unsubscribe(abandoned[2])
+        return switching
+
+    def _cut_over(self):
+        """Complete or abandon a pending switch; returns data left on the old tier"""
+        with self.lock:
+            if self.pending is None:
+                return []
+            tier, broadcaster, subscriber, started = self.pending
+            if subscriber.chunks:
+                old_broadcaster, old_subscriber = self.broadcaster, self.subscriber
+                self.tier, self.broadcaster, self.subscriber = tier, broadcaster, subscriber
+                self.pending = None
+            elif subscriber.closed or time.monotonic() - started > SWITCH_TIMEOUT:
+                logger.warning("Camera %s: No keyframe on the %s stream, staying on %s", self.cam_id, tier, self.tier)
+                self.failed[tier] = time.monotonic() + SWITCH_RETRY_SECONDS
+                self.pending = None
+                broadcaster.unsubscribe(subscriber)
+                return []
+            else:
+                return []
+        leftover = old_subscriber.get_chunks(timeout=0, coalesce=False) or []
+        old_broadcaster.unsubscribe(old_subscriber)
+        logger.info("Camera %s: Viewer now on the %s stream", self.cam_id, tier)
+        return leftover
+
+    def coalesce_delay(self, now=None):
+        pending = self.pending
+        if pending is not None and pending[2].chunks:
+            return 0
+        return self.subscriber.coalesce_delay(now)
+
+    def get_chunks(self, timeout=None, coalesce=True):
+        """Same contract as TSSubscriber.get_chunks, across tier switches"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self.event.clear()
+            leftover = self._cut_over()
+            delay = self.coalesce_delay() if coalesce and not leftover else 0
+            if not delay:
+                chunks = self.subscriber.get_chunks(timeout=0, coalesce=False)
+                if chunks is None:
+                    return leftover or None
+                if chunks or leftover:
+                    return leftover + chunks
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return []
+            if delay and (remaining is None or delay < remaining):
+                remaining = delay
+            self.event.wait(remaining)
+
+    def get(self, timeout=None):
+        chunks = self.get_chunks(timeout, coalesce=False)
+        if chunks is None:
+            return None
+        return b''.join(chunks)
+
+    def resync(self, dropped_packets=0):
+        """Same as TSSubscriber.resync; a pending switch already starts at a keyframe"""
+        self.subscriber.resync(dropped_packets)
+
+    def close(self):
+        """Leave the broadcaster(s) and stop following the policy"""
+        with self.lock:
+            self.closed = True
+            pending = self.pending
+            self.pending = None
+        if self.follow_policy:
+            quality.policy.unregister(self)
+        if pending is not None:
+            pending[1].unsubscribe(pending[2])
+        self.broadcaster.unsubscribe(self.subscriber)
+
+
+def open_viewer(cam_id, username, password, tier=quality.AUTO):
+    """Attach a viewer at tier ('main', 'sub' or 'auto' to follow the quality policy)"""
+    if tier == quality.AUTO:
+        return TieredViewer(cam_id, username, password, quality.DEFAULT_TIER, follow_policy=True)
+    return TieredViewer(cam_id, username, password, tier)
+
+
+def sendmsg_all(sock, buffers):
+    """Send a list of buffers with scatter-gather sendmsg() instead of joining them"""
+    views = collections.deque(memoryview(b) for b in buffers)
+    while views:
+        sent = sock.sendmsg(list(views)[:IOV_MAX])
+        while sent:
+            head = views[0]
+            if sent >= len(head):
+                sent -= len(head)
+                views.popleft()
+            else:
+                views[0] = head[sent:]
+                sent = 0
+
+
+def stream_mpegts(cam_id, username, password, output_pipe, sock=None, tier=quality.AUTO):
     """
     Stream MPEG-TS from RTSP camera to output pipe
-    This runs in a background thread and writes to the HTTP response
-    
+    Blocks in the request thread until the client disconnects or the
+    camera's shared FFmpeg session ends
+
     Args:
         cam_id: Camera ID
         username: RTSP username
         password: RTSP password
         output_pipe: File-like object to write MPEG-TS data to (HTTP response wfile)
+        sock: Optional client socket; when given, queued chunks are sent
+            with one sendmsg() call instead of being joined and written
+        tier: 'main', 'sub' or 'auto' to follow the quality policy
     """
+    if sock is not None and not hasattr(sock, 'sendmsg'):
+        sock = None
+    viewer = open_viewer(cam_id, username, password, tier)
+    flow = egress.scheduler.open(egress.TS, cam_id)
     try:
-        ip = get_camera_ip(cam_id)
-        encoded_username = urllib.parse.quote(username, safe='')
-        encoded_password = urllib.parse.quote(password, safe='')
-        
-        # Try each RTSP path
-        for rtsp_path in RTSP_PATHS:
-            rtsp_url = f"rtsp://{encoded_username}:{encoded_password}@{ip}:554{rtsp_path}"
-            
-            ffmpeg_path = get_ffmpeg_path()
-            
-            # ULTRA LOW LATENCY MPEG-TS COMMAND
-            ffmpeg_cmd = [
-                ffmpeg_path,
-                '-hide_banner',
-                '-loglevel', 'warning',         # Show warnings for debugging
-                '-rtsp_transport', 'tcp',       # TCP for reliability
-                '-i', rtsp_url,                 # Input RTSP
-                
-                # Video: Copy (no re-encoding for minimal latency)
-                '-c:v', 'copy',                 # Copy video stream
-                '-bsf:v', 'h264_mp4toannexb',   # Convert to Annex B
-                
-                # Audio: Disable (saves bandwidth)
-                '-an',
-                
-                # MPEG-TS output settings (ABSOLUTE MINIMUM LATENCY)
-                '-f', 'mpegts',                 # MPEG-TS format
-                '-mpegts_copyts', '1',          # Copy timestamps
-                '-mpegts_flags', 'initial_discontinuity', # Handle stream restarts
-                '-muxdelay', '0',               # Zero mux delay
-                '-muxpreload', '0',             # Zero preload
-                '-flush_packets', '1',          # Flush immediately
-                '-fflags', 'nobuffer',          # No buffering
-                '-flags', 'low_delay',          # Low delay mode
-                '-max_delay', '0',              # No delay
-                
-                # Output to pipe (stdout)
-                'pipe:1'
-            ]
-            
-            logger.info(f"Camera {cam_id}: Starting MPEG-TS stream from {ip}")
-            safe_cmd = ' '.join(ffmpeg_cmd).replace(encoded_password, '***')
-            logger.info(f"Camera {cam_id}: {safe_cmd}")
-            
+        while True:
+            chunks = viewer.get_chunks(timeout=1.0)
+            if chunks is None:
+                # Upstream ended or we were dropped as a slow client
+                return
+            if not chunks:
+                continue
+            size = sum(len(chunk) for chunk in chunks)
+            if not flow.acquire(size):
+                # Over the egress budget: skip to the next keyframe
+                viewer.resync(size // TS_PACKET_SIZE)
+                continue
             try:
-                process = subprocess.Popen(
-                    ffmpeg_cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    bufsize=0  # Unbuffered for minimal latency
-                )
-                
-                active_mpegts_processes[cam_id] = process
-                logger.info(f"Camera {cam_id}: FFmpeg started (PID {process.pid})")
-                
-                # Wait a moment for FFmpeg to connect and start producing data
-                time.sleep(0.5)
-                
-                # Check if process died immediately
-                if process.poll() is not None:
-                    stderr = process.stderr.read().decode('utf-8', errors='replace')
-                    logger.error(f"Camera {cam_id}: FFmpeg died immediately (exit {process.returncode})")
-                    logger.error(f"Camera {cam_id}: FFmpeg stderr: {stderr}")
-                    
-                    # Try next RTSP path
-                    if rtsp_path != RTSP_PATHS[-1]:
-                        logger.warning(f"Camera {cam_id}: Trying next RTSP path...")
-                        continue
-                    return
-                
-                logger.info(f"Camera {cam_id}: FFmpeg connected, starting stream...")
-                
-                # Stream data from FFmpeg to HTTP response
-                chunk_size = 1880  # MPEG-TS packet size (188 * 10 packets)
-                bytes_sent = 0
-                
-                while True:
-                    chunk = process.stdout.read(chunk_size)
-                    if not chunk:
-                        # Check if process died
-                        if process.poll() is not None:
-                            stderr = process.stderr.read().decode('utf-8', errors='replace')
-                            logger.error(f"Camera {cam_id}: FFmpeg died (exit {process.returncode}, sent {bytes_sent} bytes)")
-                            if stderr:
-                                logger.error(f"Camera {cam_id}: FFmpeg stderr: {stderr}")
-                            
-                            # Try next RTSP path if available
-                            if rtsp_path != RTSP_PATHS[-1]:
-                                logger.warning(f"Camera {cam_id}: Trying next RTSP path...")
-                                break
-                            return
-                        continue
-                    
-                    bytes_sent += len(chunk)
-                    
-                    try:
-                        output_pipe.write(chunk)
-                        output_pipe.flush()
-                    except (BrokenPipeError, ConnectionResetError, OSError):
-                        # Client disconnected
-                        logger.info(f"Camera {cam_id}: Client disconnected")
-                        process.terminate()
-                        return
-                
-                # If we get here, try next RTSP path
-                process.terminate()
-                process.wait(timeout=2)
-                
-            except Exception as e:
-                logger.error(f"Camera {cam_id}: Stream error: {e}")
-                if rtsp_path == RTSP_PATHS[-1]:
-                    return
-                
-    except Exception as e:
-        logger.exception(f"Camera {cam_id}: Unexpected error")
+                if sock is not None:
+                    sendmsg_all(sock, chunks)
+                else:
+                    output_pipe.write(b''.join(chunks))
+                    output_pipe.flush()
+                metrics.egress_bytes.inc(cam_id, 'ts', amount=size)
+            except (BrokenPipeError, ConnectionResetError, OSError):
+                # Client disconnected
+                logger.info("Camera %s: Client disconnected", cam_id)
+                return
     finally:
-        if cam_id in active_mpegts_processes:
-            process = active_mpegts_processes[cam_id]
-            try:
-                if process.poll() is None:
-                    process.terminate()
-                    process.wait(timeout=2)
-            except:
-                try:
-                    process.kill()
-                except:
-                    pass
-            del active_mpegts_processes[cam_id]
+        flow.close()
+        viewer.close()
 
 
 def cleanup_mpegts_stream(cam_id):
-    """Stop MPEG-TS stream for a camera"""
-    if cam_id in active_mpegts_processes:
-        process = active_mpegts_processes[cam_id]
-        try:
-            if process.poll() is None:
-                logger.info(f"Camera {cam_id}: Stopping MPEG-TS stream (PID {process.pid})")
-                process.terminate()
-                process.wait(timeout=2)
-        except:
-            try:
-                process.kill()
-            except:
-                pass
-        del active_mpegts_processes[cam_id]
+    """Stop every MPEG-TS stream (all tiers) of a camera"""
+    with _broadcasters_lock:
+        broadcasters = [broadcaster for key, broadcaster in active_broadcasters.items() if key[0] == cam_id]
+    for broadcaster in broadcasters:
+        logger.info("Camera %s: Stopping MPEG-TS %s stream", cam_id, broadcaster.tier)
+        broadcaster.stop()
 
 
 def cleanup_all_mpegts():
     """Stop all MPEG-TS streams"""
     logger.info("Cleaning up all MPEG-TS streams")
-    for cam_id in list(active_mpegts_processes.keys()):
+    with _broadcasters_lock:
+        cam_ids = sorted({cam_id for cam_id, tier in active_broadcasters})
+    for cam_id in cam_ids:
         cleanup_mpegts_stream(cam_id)
+    # Anything left over, e.g. a process whose broadcaster is mid-restart
+    supervisor.shutdown()
+
+
+def _collect_metrics():
+    with _broadcasters_lock:
+        broadcasters = list(active_broadcasters.values())
+    viewers = {}
+    for broadcaster in broadcasters:
+        with broadcaster.lock:
+            viewers[broadcaster.key] = len(broadcaster.subscribers)
+    return [metrics.snapshot(metrics.Gauge, 'ts_viewers', 'Connected MPEG-TS viewers', ('camera', 'tier'), viewers)]
+
+
+metrics.registry.add_collector(_collect_metrics)
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Low-rate JPEG previews for the "recent" grid
+Tiles that only give context do not need full-rate video. While previews of
+a camera are being requested, its shared MPEG-TS ingest is held open (as a
+prewarm would) and every PREVIEW_INTERVAL seconds the latest keyframe from
+its GOP cache is decoded by FFmpeg (keyframes only, scaled down) into a
+small JPEG. Previews are served per camera at /preview/<id> (one JPEG, or a
+multipart stream with ?stream=1) and composited into one mosaic stream at
+/preview/mosaic?cams=1,2,3&cols=4.
+"""
+
+import os
+import math
+import time
+import logging
+import threading
+import subprocess
+import urllib.parse
+
+import mpegts_stream
+import workers
+from topology import topology
+
+logger = logging.getLogger(__name__)
+
+# Seconds between previews of one camera (and between mosaic frames)
+PREVIEW_INTERVAL = float(os.environ.get('PREVIEW_INTERVAL', '2.0'))
+
+# Preview width in pixels (height keeps the aspect ratio) and JPEG quality (2-31, lower is better)
+PREVIEW_WIDTH = int(os.environ.get('PREVIEW_WIDTH', '320'))
+PREVIEW_QUALITY = int(os.environ.get('PREVIEW_QUALITY', '7'))
+
+# Mosaic tile size in pixels
+MOSAIC_TILE_WIDTH = PREVIEW_WIDTH
+MOSAIC_TILE_HEIGHT = PREVIEW_WIDTH * 9 // 16
+
+# Distinct mosaics kept at once; the least recently requested is dropped
+MAX_MOSAICS = int(os.environ.get('PREVIEW_MAX_MOSAICS', '16'))
+
+# A camera's ingest is released when nobody asked for its preview this long
+PREVIEW_IDLE_SECONDS = float(os.environ.get('PREVIEW_IDLE_SECONDS', '30'))
+
+# Upper bound on one FFmpeg decode
+DECODE_TIMEOUT = 5
+
+OUTPUT_BOUNDARY = 'preview'
+
+
+def _run_ffmpeg(args, data):
+    """Run FFmpeg with data on stdin; returns stdout or None on failure"""
+    cmd = [mpegts_stream.get_ffmpeg_path(), '-hide_banner', '-loglevel', 'error'] + args
+    try:
+        result = subprocess.run(cmd, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                timeout=DECODE_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.debug("Preview FFmpeg failed: %s", e)
+        return None
+    if result.returncode != 0 or not result.stdout:
+        logger.debug("Preview FFmpeg exit %s: %s", result.returncode,
+                     result.stderr.decode('utf-8', errors='replace').strip())
+        return None
+    return result.stdout
+
+
+def decode_keyframe(ts_data, width=PREVIEW_WIDTH, quality=PREVIEW_QUALITY):
+    """Decode the first keyframe of a TS snapshot into a scaled JPEG"""
+    return _run_ffmpeg([
+        '-skip_frame', 'nokey',         # Decode keyframes only
+        '-f', 'mpegts', '-i', 'pipe:0',
+        '-an',
+        '-vf', f'scale={width}:-2',
+        '-frames:v', '1',
+        '-q:v', str(quality),
+        '-f', 'image2', '-c:v', 'mjpeg', 'pipe:1',
+    ], ts_data)
+
+
+def compose_mosaic(jpegs, cols, tile_width=MOSAIC_TILE_WIDTH, tile_height=MOSAIC_TILE_HEIGHT,
+                   quality=PREVIEW_QUALITY):
+    """Tile JPEGs (None for a missing camera) into one JPEG, cols tiles wide"""
+    frames = [jpeg for jpeg in jpegs if jpeg]
+    if not frames:
+        return None
+    rows = max(math.ceil(len(frames) / cols), 1)
+    return _run_ffmpeg([
+        '-f', 'image2pipe', '-c:v', 'mjpeg', '-i', 'pipe:0',
+        '-vf', (f'scale={tile_width}:{tile_height}:force_original_aspect_ratio=decrease,'
+                f'pad={tile_width}:{tile_height}:(ow-iw)/2:(oh-ih)/2,setsar=1,'
+                f'tile={cols}x{rows}:nb_frames={len(frames)}'),
+        '-frames:v', '1',
+        '-q:v', str(quality),
+        '-f', 'image2', '-c:v', 'mjpeg', 'pipe:1',
+    ], b''.join(frames))
+
+
+def format_part(jpeg):
+    """Format one preview as a multipart/x-mixed-replace part"""
+    return (f"--{OUTPUT_BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+            f"Content-Length: {len(jpeg)}\r\n\r\n").encode() + jpeg + b"\r\n"
+
+
+class CameraPreview:
+    """Preview state for one camera"""
+
+    def __init__(self, cam_id):
+        self.cam_id = cam_id
+        self.broadcaster = None
+        self.jpeg = None
+        self.seq = 0
+        self.keyframe = None
+        self.generated = 0
+        self.requested = time.monotonic()
+
+
+class MosaicPreview:
+    """Composited preview of several cameras"""
+
+    def __init__(self, cams, cols):
+        self.cams = cams
+        self.cols = cols
+        self.jpeg = None
+        self.seq = 0
+        self.sources = None
+        self.requested = time.monotonic()
+
+
+class PreviewManager:
+    """Generates previews for the cameras and mosaics currently requested"""
+
+    def __init__(self, username=None, password=None, interval=PREVIEW_INTERVAL):
+        self.username = username
+        self.password = password
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.cameras = {}
+        self.mosaics = {}
+        self.thread = None
+        # Callables invoked whenever a preview changes (asyncio server)
+        self.wakers = set()
+
+    def configure(self, username, password):
+        self.username = username
+        self.password = password
+
+    def _ensure_running(self):
+        # Caller holds self.cond
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='preview', daemon=True)
+            self.thread.start()
+
+    def request(self, cam_id):
+        """Note demand for a camera's preview; returns (seq, jpeg or None)"""
+        with self.cond:
+            preview = self.cameras.get(cam_id)
+            if preview is None:
+                preview = self.cameras[cam_id] = CameraPreview(cam_id)
+                self.cond.notify_all()
+            preview.requested = time.monotonic()
+            self._ensure_running()
+            return preview.seq, preview.jpeg
+
+    def request_mosaic(self, cams, cols):
+        """Note demand for a mosaic (and its cameras); returns (seq, jpeg or None)"""
+        key = (tuple(cams), cols)
+        for cam_id in cams:
+            self.request(cam_id)
+        with self.cond:
+            mosaic = self.mosaics.get(key)
+            if mosaic is None:
+                if len(self.mosaics) >= MAX_MOSAICS:
+                    oldest = min(self.mosaics, key=lambda k: self.mosaics[k].requested)
+                    del self.mosaics[oldest]
+                mosaic = self.mosaics[key] = MosaicPreview(tuple(cams), cols)
+                self.cond.notify_all()
+            mosaic.requested = time.monotonic()
+            return mosaic.seq, mosaic.jpeg
+
+    def wait(self, fetch, last_seq, timeout):
+        """Block until fetch() returns a seq other than last_seq, or timeout"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                seq, jpeg = fetch()
+                remaining = deadline - time.monotonic()
+                if (seq != last_seq and jpeg is not None) or remaining <= 0:
+                    return seq, jpeg
+                self.cond.wait(remaining)
+
+    def add_waker(self, waker):
+        with self.cond:
+            self.wakers.add(waker)
+
+    def remove_waker(self, waker):
+        with self.cond:
+            self.wakers.discard(waker)
+
+    def _publish(self):
+        # Caller holds self.cond
+        self.cond.notify_all()
+        for waker in self.wakers:
+            waker()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait(self.interval / 4)
+                now = time.monotonic()
+                idle = [preview for preview in self.cameras.values()
+                        if now - preview.requested > PREVIEW_IDLE_SECONDS]
+                for preview in idle:
+                    del self.cameras[preview.cam_id]
+                for key in [key for key, mosaic in self.mosaics.items()
+                            if now - mosaic.requested > PREVIEW_IDLE_SECONDS]:
+                    del self.mosaics[key]
+                due = [preview for preview in self.cameras.values()
+                       if now - preview.generated >= self.interval]
+                mosaics = list(self.mosaics.values())
+
+            for preview in idle:
+                if preview.broadcaster is not None:
+                    logger.debug("Camera %s: Preview idle, releasing ingest", preview.cam_id)
+                    preview.broadcaster.release()
+            for preview in due:
+                try:
+                    self._update_camera(preview)
+                except Exception:
+                    logger.exception("Camera %s: Preview failed", preview.cam_id)
+            for mosaic in mosaics:
+                try:
+                    self._update_mosaic(mosaic)
+                except Exception:
+                    logger.exception("Mosaic preview failed")
+
+    def _update_camera(self, preview):
+        if not workers.owns(preview.cam_id):
+            # Another worker ingests this camera (mosaic tiles); use its preview
+            preview.generated = time.monotonic()
+            jpeg = workers.fetch(f'/preview/{preview.cam_id}')
+            if jpeg is not None and jpeg != preview.jpeg:
+                with self.cond:
+                    preview.jpeg = jpeg
+                    preview.seq += 1
+                    self._publish()
+            return
+        if preview.broadcaster is None or preview.broadcaster.stopping:
+            if not self.password:
+                return
+            # Keep the shared ingest running while the preview is wanted
+            preview.broadcaster = mpegts_stream.prewarm(preview.cam_id, self.username, self.password)
+        preview.generated = time.monotonic()
+        keyframe, data = preview.broadcaster.keyframe_snapshot()
+        if not data or keyframe == preview.keyframe:
+            return
+        jpeg = decode_keyframe(data)
+        if jpeg is None:
+            return
+        with self.cond:
+            preview.keyframe = keyframe
+            preview.jpeg = jpeg
+            preview.seq += 1
+            self._publish()
+
+    def _update_mosaic(self, mosaic):
+        with self.cond:
+            sources = tuple(
+                (self.cameras[cam_id].seq if cam_id in self.cameras else None) for cam_id in mosaic.cams)
+            jpegs = [self.cameras[cam_id].jpeg if cam_id in self.cameras else None for cam_id in mosaic.cams]
+        if sources == mosaic.sources:
+            return
+        jpeg = compose_mosaic(jpegs, mosaic.cols)
+        if jpeg is None:
+            return
+        with self.cond:
+            mosaic.sources = sources
+            mosaic.jpeg = jpeg
+            mosaic.seq += 1
+            self._publish()
+
+    def get_stats(self):
+        with self.cond:
+            return {
+                'interval': self.interval,
+                'cameras': {str(cam_id): {'seq': preview.seq, 'bytes': len(preview.jpeg or b'')}
+                            for cam_id, preview in sorted(self.cameras.items())},
+                'mosaics': len(self.mosaics),
+            }
+
+
+def parse_camera(name):
+    """Camera id from /preview/<id>; raises ValueError, or LookupError for an unknown camera"""
+    cam_id = int(name)
+    if cam_id not in topology.cameras():
+        raise LookupError(f"Unknown camera {cam_id}")
+    return cam_id
+
+
+def parse_mosaic_query(query):
+    """Return (cams, cols) from ?cams=1,2,3&cols=4; raises ValueError, or LookupError for an unknown camera"""
+    params = urllib.parse.parse_qs(query or '')
+    cams = []
+    for value in params.get('cams', []):
+        cams.extend(int(cam) for cam in value.split(',') if cam)
+    if not cams:
+        raise ValueError("cams is required")
+    known = topology.cameras()
+    if len(cams) > len(known):
+        raise ValueError(f"at most {len(known)} cams")
+    for cam_id in cams:
+        if cam_id not in known:
+            raise LookupError(f"Unknown camera {cam_id}")
+    cols = int(params.get('cols', [str(math.ceil(math.sqrt(len(cams))))])[0])
+    if cols < 1:
+        raise ValueError("cols must be positive")
+    return cams, cols
+
+
+# Shared preview manager; credentials are set by main via configure()
+manager = PreviewManager()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Server-side event priorities from priorities.json
+Loads the file once (reloading when its mtime changes), precomputes a
+(camera, event_type) -> priority index plus each camera's zone, annotates
+events with their resolved priority and zone, and evaluates the per-client
+filters given as /api/v1/subscribe query parameters.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import urllib.parse
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES_FILE = Path(os.environ.get('PRIORITIES_FILE', Path(__file__).parent / 'priorities.json'))
+
+# Known priority names in increasing order of importance
+PRIORITY_LEVELS = {'LOW': 0, 'MEDIUM': 1, 'HIGH': 2}
+DEFAULT_PRIORITY = 'LOW'
+
+# Seconds between mtime checks of priorities.json
+RELOAD_CHECK_INTERVAL = 1.0
+
+# Subscribe query parameters the proxy applies itself (layout: see layout.py);
+# the shared upstream subscription carries no query, so others are rejected
+SUBSCRIBE_PARAMS = ('min_priority', 'zone', 'layout')
+
+
+def normalize_event_type(event_type):
+    """Canonical event type: lower case with underscores (smart-motion -> smart_motion)"""
+    return str(event_type).strip().lower().replace('-', '_')
+
+
+class PriorityIndex:
+    """Precomputed priority and zone lookups, reloaded when the file changes"""
+
+    def __init__(self, path=PRIORITIES_FILE):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.last_check = 0
+        self.priorities = {}
+        self.zones = {}
+        self.config = {}
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self.last_check < RELOAD_CHECK_INTERVAL and self.mtime is not None:
+            return
+        self.last_check = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as e:
+            if self.mtime is not None:
+                logger.warning("Cannot stat %s: %s", self.path, e)
+            return
+        if mtime == self.mtime:
+            return
+        try:
+            with open(self.path) as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Failed to load %s: %s", self.path, e)
+            return
+        self._build(config)
+        self.mtime = mtime
+        logger.info("Loaded priorities for %d cameras from %s", len(self.zones), self.path.name)
+
+    def _build(self, config):
+        priorities = {}
+        zones = {}
+        for cam, cam_config in config.items():
+            if not isinstance(cam_config, dict):
+                continue
+            try:
+                cam_id = int(cam)
+            except ValueError:
+                continue
+            zones[cam_id] = cam_config.get('zone')
+            for event_type, priority in (cam_config.get('events') or {}).items():
+                priorities[(cam_id, normalize_event_type(event_type))] = str(priority).upper()
+        self.config = config
+        self.priorities = priorities
+        self.zones = zones
+
+    def resolve(self, cam_id, event_type):
+        """Return (priority, zone) for an event"""
+        with self.lock:
+            self._maybe_reload()
+            priority = self.priorities.get((cam_id, normalize_event_type(event_type)), DEFAULT_PRIORITY)
+            return priority, self.zones.get(cam_id)
+
+    def get_config(self):
+        """Return the parsed priorities.json, reloading it if it changed"""
+        with self.lock:
+            self._maybe_reload()
+            return self.config
+
+
+def annotate(event, priority_index=None):
+    """Resolve an SSEEvent's camera, type, priority and zone, adding them to its JSON data"""
+    priority_index = priority_index or index
+    try:
+        data = json.loads(event.data)
+    except ValueError:
+        return
+    if not isinstance(data, dict):
+        return
+    try:
+        cam_id = int(data.get('camera'))
+    except (TypeError, ValueError):
+        return
+    event_type = data.get('event_type') or 'unknown'
+    priority, zone = priority_index.resolve(cam_id, event_type)
+
+    event.camera = cam_id
+    event.event_type = normalize_event_type(event_type)
+    event.priority = priority
+    event.zone = zone
+    data['priority'] = priority
+    data['zone'] = zone
+    event.data = json.dumps(data, separators=(',', ':'))
+
+
+class EventFilter:
+    """Per-client filter built from subscribe query parameters
+
+    ?min_priority=HIGH drops less important events, ?zone=1 (repeatable or
+    comma separated) keeps only those zones. Events whose camera could not
+    be resolved only pass when no filter is set. Parameters outside
+    SUBSCRIBE_PARAMS raise ValueError rather than being dropped unnoticed.
+    """
+
+    def __init__(self, min_priority=None, zones=None):
+        self.min_level = PRIORITY_LEVELS.get(min_priority.upper()) if min_priority else None
+        self.zones = zones
+
+    @classmethod
+    def from_query(cls, query):
+        names = {name for name, _ in urllib.parse.parse_qsl(query or '', keep_blank_values=True)}
+        unsupported = sorted(names - set(SUBSCRIBE_PARAMS))
+        if unsupported:
+            raise ValueError(f"Unsupported parameter: {', '.join(unsupported)}")
+        params = urllib.parse.parse_qs(query or '')
+        min_priority = params.get('min_priority', [None])[0]
+        if min_priority and min_priority.upper() not in PRIORITY_LEVELS:
+            raise ValueError(f"Unknown priority: {min_priority}")
+        zones = None
+        if 'zone' in params:
+            zones = set()
+            for value in params['zone']:
+                for zone in value.split(','):
+                    zones.add(int(zone))
+        return cls(min_priority, zones)
+
+    @property
+    def active(self):
+        return self.min_level is not None or self.zones is not None
+
+    def matches(self, event):
+        if not self.active:
+            return True
+        priority = getattr(event, 'priority', None)
+        if priority is None:
+            return False
+        if self.min_level is not None and PRIORITY_LEVELS.get(priority, 0) < self.min_level:
+            return False
+        if self.zones is not None and event.zone not in self.zones:
+            return False
+        return True
+
+
+# Shared index for priorities.json
+index = PriorityIndex()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Quality tiers for MPEG-TS streams
+Every camera offers a full resolution main stream and a sub stream over
+RTSP. A viewer picks one with /mpegts/<id>?q=main|sub, or leaves it to the
+policy here (q=auto, the default). Each display reports its layout with
+/quality?client=<id>&active=1,2&recent=3,4: cameras in an active slot get the
+main stream, everything else the sub stream, and when the main streams would
+push the expected ingest of all displayed cameras over the server-wide
+budget the later active cameras stay on the sub stream. Policy-driven
+viewers move between tiers at a keyframe without reconnecting (see
+TieredViewer in mpegts_stream.py).
+"""
+
+import os
+import time
+import logging
+import threading
+import urllib.parse
+
+from topology import topology
+
+logger = logging.getLogger(__name__)
+
+MAIN = 'main'
+SUB = 'sub'
+AUTO = 'auto'
+
+# RTSP paths per tier, in fallback order
+RTSP_PATHS = {
+    MAIN: ['/live1s1.sdp', '/live1s2.sdp'],
+    SUB: ['/live1s2.sdp', '/live1s1.sdp'],
+}
+DEFAULT_TIER = SUB
+
+# A display's layout report is forgotten after this long without a refresh
+REPORT_TTL = float(os.environ.get('QUALITY_REPORT_TTL', '60'))
+
+# Seconds between re-evaluations (expired reports, priorities.json edits)
+EVALUATE_INTERVAL = 5.0
+
+
+def parse_tier(query):
+    """Tier requested by ?q= (main, sub or auto); raises ValueError"""
+    params = urllib.parse.parse_qs(query or '')
+    tier = params.get('q', [AUTO])[0].lower()
+    if tier not in (MAIN, SUB, AUTO):
+        raise ValueError(f"Unknown quality: {tier}")
+    return tier
+
+
+def parse_report(query):
+    """Return (client, active, recent) from a /quality query; raises ValueError"""
+    params = urllib.parse.parse_qs(query or '')
+    client = params.get('client', [''])[0]
+    if not client:
+        raise ValueError("client is required")
+
+    def cameras(name):
+        cams = []
+        for value in params.get(name, []):
+            cams.extend(int(cam) for cam in value.split(',') if cam)
+        return cams
+
+    return client, cameras('active'), cameras('recent')
+
+
+class LayoutReport:
+    """The cameras one display currently shows"""
+
+    def __init__(self, active, recent):
+        self.active = active
+        self.recent = recent
+        self.received = time.monotonic()
+
+
+class QualityPolicy:
+    """Chooses each camera's tier and moves policy-driven viewers to it"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reports = {}
+        self.tiers = {}
+        # {cam_id: set of viewers following the policy}
+        self.viewers = {}
+        self.switches = 0
+        self.thread = None
+
+    def report(self, client, active, recent):
+        """Record a display's layout and apply the resulting tiers"""
+        with self.lock:
+            self.reports[client] = LayoutReport(active, recent)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='quality-policy', daemon=True)
+                self.thread.start()
+        return self.apply()
+
+    def register(self, viewer):
+        """Move viewer with its camera's tier from now on"""
+        with self.lock:
+            self.viewers.setdefault(viewer.cam_id, set()).add(viewer)
+
+    def unregister(self, viewer):
+        with self.lock:
+            viewers = self.viewers.get(viewer.cam_id)
+            if viewers is not None:
+                viewers.discard(viewer)
+                if not viewers:
+                    del self.viewers[viewer.cam_id]
+
+    def active_cameras(self):
+        """Cameras in an active slot of any display"""
+        now = time.monotonic()
+        with self.lock:
+            return {cam_id for report in self.reports.values() if now - report.received <= REPORT_TTL
+                    for cam_id in report.active}
+
+    def tier_for(self, cam_id):
+        with self.lock:
+            return self.tiers.get(cam_id, DEFAULT_TIER)
+
+    def _decide(self, now):
+        # Caller holds self.lock
+        for client in [client for client, report in self.reports.items()
+                       if now - report.received > REPORT_TTL]:
+            del self.reports[client]
+
+        # Most recent report first, each display's active slots in order
+        reports = sorted(self.reports.values(), key=lambda report: -report.received)
+        active = []
+        shown = set(self.viewers)
+        for report in reports:
+            active.extend(cam_id for cam_id in report.active if cam_id not in active)
+            shown.update(report.active)
+            shown.update(report.recent)
+
+        budget = topology.quality_budget_kbps()
+        load = sum(topology.expected_kbps(cam_id, tier=SUB) for cam_id in shown)
+        tiers = {}
+        for cam_id in active:
+            extra = topology.expected_kbps(cam_id, tier=MAIN) - topology.expected_kbps(cam_id, tier=SUB)
+            if budget and load + extra > budget:
+                logger.debug("Camera %s: Main stream would exceed the %.0f kbps budget", cam_id, budget)
+                continue
+            tiers[cam_id] = MAIN
+            load += extra
+        return tiers
+
+    def apply(self):
+        """Recompute every camera's tier and switch viewers; returns the tiers"""
+        with self.lock:
+            tiers = self._decide(time.monotonic())
+            changed = {cam_id for cam_id in set(tiers) | set(self.tiers)
+                       if tiers.get(cam_id) != self.tiers.get(cam_id)}
+            self.tiers = tiers
+            moves = [(viewer, tiers.get(cam_id, DEFAULT_TIER))
+                     for cam_id, viewers in self.viewers.items() for viewer in viewers]
+        for cam_id in sorted(changed):
+            logger.info("Camera %s: Quality tier -> %s", cam_id, tiers.get(cam_id, DEFAULT_TIER))
+        # Retried every round, so a switch that timed out is attempted again
+        for viewer, tier in moves:
+            if viewer.switch(tier):
+                with self.lock:
+                    self.switches += 1
+        return tiers
+
+    def _run(self):
+        while True:
+            time.sleep(EVALUATE_INTERVAL)
+            try:
+                self.apply()
+            except Exception:
+                logger.exception("Quality policy evaluation failed")
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'budget_kbps': topology.quality_budget_kbps(),
+                'displays': len(self.reports),
+                'main': sorted(cam_id for cam_id, tier in self.tiers.items() if tier == MAIN),
+                'viewers': {str(cam_id): [viewer.tier for viewer in viewers]
+                            for cam_id, viewers in sorted(self.viewers.items())},
+                'switches': self.switches,
+            }
+
+
+# Shared policy for every port
+policy = QualityPolicy()
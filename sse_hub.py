@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Shared Server-Sent Events hub
+Holds a single upstream subscription to the event server (reconnecting with
+Last-Event-ID resumption), parses each event once and pushes it to every
+browser through a bounded per-client queue. Events are annotated with their
+priority and zone from priorities.json, and each client only receives the
+events matching its subscribe filter. The upstream subscription carries no
+query: the subscribe parameters are applied here, per client, and any the
+proxy does not implement are refused with 400 (see EventFilter). Repeated events are debounced and
+bursts are sent as one "batch" message (see coalesce.py). Keep-alive comments
+come from a timer thread, so nothing polls.
+"""
+
+import os
+import time
+import logging
+import itertools
+import threading
+import collections
+import urllib.request
+import urllib.error
+
+import priorities
+import coalesce
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SOVEREIGN_URL = os.environ.get('SOVEREIGN_URL', 'http://127.0.0.1:8080')
+SUBSCRIBE_PATH = '/api/v1/subscribe'
+
+# Seconds of silence on a client before a keep-alive comment is sent
+KEEPALIVE_INTERVAL = 15
+
+# Events buffered per client before the oldest are dropped
+CLIENT_QUEUE_SIZE = 256
+
+# Recent events kept for replay to clients reconnecting with Last-Event-ID
+HISTORY_SIZE = 100
+
+# Upstream reconnect backoff bounds in seconds
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+
+KEEPALIVE = b': keep-alive\n\n'
+
+_client_ids = itertools.count(1)
+
+
+class SSEEvent:
+    """One parsed event from the upstream stream"""
+
+    def __init__(self, data, event=None, event_id=None):
+        self.data = data
+        self.event = event
+        self.id = event_id
+        # Filled in by priorities.annotate() for camera events
+        self.camera = None
+        self.event_type = None
+        self.priority = None
+        self.zone = None
+        self._encoded = None
+
+    def encode(self):
+        """Wire format of the event, computed once and shared by all clients"""
+        if self._encoded is None:
+            lines = []
+            if self.id is not None:
+                lines.append(f'id: {self.id}')
+            if self.event:
+                lines.append(f'event: {self.event}')
+            for line in self.data.split('\n'):
+                lines.append(f'data: {line}')
+            self._encoded = ('\n'.join(lines) + '\n\n').encode('utf-8')
+        return self._encoded
+
+
+class SSEParser:
+    """Incremental parser for text/event-stream lines"""
+
+    def __init__(self):
+        self.data = []
+        self.event = None
+        self.id = None
+        self.retry = None
+
+    def feed_line(self, line):
+        """Process one decoded line (without newline); returns an SSEEvent or None"""
+        if not line:
+            if not self.data:
+                self.event = None
+                return None
+            event = SSEEvent('\n'.join(self.data), self.event, self.id)
+            self.data = []
+            self.event = None
+            return event
+        if line.startswith(':'):
+            # Upstream comment; we send our own keep-alives
+            return None
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'data':
+            self.data.append(value)
+        elif field == 'event':
+            self.event = value
+        elif field == 'id':
+            self.id = value
+        elif field == 'retry' and value.isdigit():
+            self.retry = int(value)
+        return None
+
+
+class SSEClient:
+    """Bounded outgoing queue for one browser connection"""
+
+    def __init__(self, event_filter=None, max_size=CLIENT_QUEUE_SIZE):
+        self.id = next(_client_ids)
+        self.event_filter = event_filter or priorities.EventFilter()
+        self.queue = collections.deque()
+        self.max_size = max_size
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.last_sent = time.monotonic()
+        # Optional callable used by the asyncio server to wake its writer
+        self.waker = None
+
+    def push(self, data):
+        with self.cond:
+            if self.closed:
+                return
+            if len(self.queue) >= self.max_size:
+                # Slow client: drop the oldest event rather than block the hub
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(data)
+            self.last_sent = time.monotonic()
+            self.cond.notify()
+            if self.waker is not None:
+                self.waker()
+
+    def get(self, timeout=None):
+        """Return queued data as one bytes object, b'' on timeout, None once closed"""
+        with self.cond:
+            if not self.queue and not self.closed:
+                self.cond.wait(timeout)
+            if self.queue:
+                data = b''.join(self.queue)
+                self.queue.clear()
+                return data
+            if self.closed:
+                return None
+            return b''
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            if self.waker is not None:
+                self.waker()
+
+
+class SSEHub:
+    """One upstream event subscription fanned out to all browser clients"""
+
+    def __init__(self, url):
+        self.url = url
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.history = collections.deque(maxlen=HISTORY_SIZE)
+        self.last_event_id = None
+        self.connected = False
+        self.response = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.coalescer = coalesce.EventCoalescer(self._deliver)
+        # In-process consumers of delivered events, called as listener(events)
+        self.listeners = []
+
+    def subscribe(self, last_event_id=None, event_filter=None):
+        """Register a browser client, replaying missed events if possible"""
+        client = SSEClient(event_filter)
+        with self.lock:
+            if last_event_id:
+                ids = [event.id for event in self.history]
+                if last_event_id in ids:
+                    for event in list(self.history)[ids.index(last_event_id) + 1:]:
+                        if client.event_filter.matches(event):
+                            client.push(event.encode())
+            self.clients.add(client)
+            count = len(self.clients)
+            self._start()
+        logger.debug("SSE client connected (%s connected)", count)
+        return client
+
+    def add_listener(self, listener):
+        """Register a callable receiving every delivered burst of events"""
+        with self.lock:
+            self.listeners.append(listener)
+
+    def start(self):
+        """Connect upstream even before any browser subscribes"""
+        with self.lock:
+            self._start()
+
+    def unsubscribe(self, client):
+        client.close()
+        with self.lock:
+            self.clients.discard(client)
+            count = len(self.clients)
+        logger.debug("SSE client disconnected (%s connected)", count)
+
+    def broadcast(self, data):
+        """Push already-encoded data to every client"""
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.push(data)
+
+    def publish(self, event):
+        metrics.sse_events.inc()
+        priorities.annotate(event)
+        with self.lock:
+            if event.id is not None:
+                self.last_event_id = event.id
+        self.coalescer.add(event)
+
+    def _deliver(self, events):
+        """Send a coalesced burst to each client, filtered per client"""
+        with self.lock:
+            self.history.extend(events)
+            clients = list(self.clients)
+            listeners = list(self.listeners)
+
+        for listener in listeners:
+            try:
+                listener(events)
+            except Exception:
+                logger.exception("SSE listener failed")
+
+        # Clients with the same filter share one encoding
+        encoded = {}
+        for client in clients:
+            matching = [event for event in events if client.event_filter.matches(event)]
+            if not matching:
+                continue
+            key = tuple(id(event) for event in matching)
+            data = encoded.get(key)
+            if data is None:
+                camera_events = [event for event in matching if event.camera is not None]
+                other = [event.encode() for event in matching if event.camera is None]
+                if len(camera_events) > 1:
+                    other.append(coalesce.encode_batch(camera_events))
+                else:
+                    other.extend(event.encode() for event in camera_events)
+                data = encoded[key] = b''.join(other)
+            client.push(data)
+
+    def stop(self):
+        self.stopping.set()
+        response = self.response
+        if response is not None:
+            try:
+                response.close()
+            except Exception:
+                pass
+
+    def _start(self):
+        # Caller holds self.lock
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run_upstream, name='sse-upstream', daemon=True)
+            self.thread.start()
+            threading.Thread(target=self._run_keepalive, name='sse-keepalive', daemon=True).start()
+
+    def _run_keepalive(self):
+        """Timer loop sending keep-alives to clients that have been idle"""
+        while not self.stopping.wait(1):
+            now = time.monotonic()
+            with self.lock:
+                clients = list(self.clients)
+            for client in clients:
+                if now - client.last_sent >= KEEPALIVE_INTERVAL:
+                    client.push(KEEPALIVE)
+
+    def _run_upstream(self):
+        delay = RECONNECT_MIN_DELAY
+        while not self.stopping.is_set():
+            req = urllib.request.Request(self.url)
+            req.add_header('Accept', 'text/event-stream')
+            req.add_header('Cache-Control', 'no-cache')
+            if self.last_event_id is not None:
+                req.add_header('Last-Event-ID', self.last_event_id)
+            try:
+                self.response = urllib.request.urlopen(req, timeout=None)
+                self.connected = True
+                delay = RECONNECT_MIN_DELAY
+                logger.info("SSE hub connected to %s", self.url)
+                self._read_events(self.response)
+                logger.info("SSE upstream closed, reconnecting")
+            except Exception as e:
+                logger.debug("SSE upstream error: %s", e)
+                self.broadcast(f': error connecting to event server: {e}\n\n'.encode())
+            finally:
+                self.connected = False
+                if self.response is not None:
+                    try:
+                        self.response.close()
+                    except Exception:
+                        pass
+                    self.response = None
+            if self.stopping.wait(delay):
+                break
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def _read_events(self, response):
+        parser = SSEParser()
+        fp = response.fp
+        while not self.stopping.is_set():
+            line = fp.readline()
+            if not line:
+                return
+            event = parser.feed_line(line.decode('utf-8', errors='replace').rstrip('\r\n'))
+            if event is not None:
+                self.publish(event)
+
+
+def _collect_metrics():
+    with hub.lock:
+        clients = list(hub.clients)
+    depth = {(client.id,): len(client.queue) for client in clients}
+    dropped = {(client.id,): client.dropped for client in clients}
+    stats = hub.coalescer.get_stats()
+    rates = {(cam_id,): camera['events_per_second'] for cam_id, camera in stats['cameras'].items()}
+    suppressed = {(cam_id,): camera['events_suppressed'] for cam_id, camera in stats['cameras'].items()}
+    return [
+        metrics.snapshot(metrics.Gauge, 'sse_upstream_connected', 'Whether the event server subscription is up',
+                         (), {(): int(hub.connected)}),
+        metrics.snapshot(metrics.Gauge, 'sse_clients', 'Connected SSE clients', (), {(): len(clients)}),
+        metrics.snapshot(metrics.Gauge, 'sse_client_queue_depth', 'Messages queued per SSE client',
+                         ('client',), depth),
+        metrics.snapshot(metrics.Counter, 'sse_client_dropped_total', 'Messages dropped per slow SSE client',
+                         ('client',), dropped),
+        metrics.snapshot(metrics.Gauge, 'sse_camera_events_per_second', 'Moving average of events per camera',
+                         ('camera',), rates),
+        metrics.snapshot(metrics.Counter, 'sse_camera_events_suppressed_total', 'Debounced events per camera',
+                         ('camera',), suppressed),
+    ]
+
+
+# Shared hub for /api/v1/subscribe
+hub = SSEHub(f'{SOVEREIGN_URL}{SUBSCRIBE_PATH}')
+metrics.registry.add_collector(_collect_metrics)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Static asset serving for the web UI and /Images/
+Small files (index.html, the scripts, lib/mpegts.js, priorities.json,
+images) are kept in memory together with gzip (and, if the brotli package is
+installed, brotli) variants, and revalidated against the file's mtime and
+size on every request. Responses carry ETags (a distinct one per content
+coding) and honour If-None-Match and single byte ranges, which are served
+uncompressed; files too large to cache are streamed with sendfile.
+Both the threaded handler in main.py and async_server.py use this module.
+"""
+
+import os
+import gzip
+import logging
+import mimetypes
+import posixpath
+import threading
+import urllib.parse
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = Path(__file__).parent
+# /Images/ is served from the parent directory
+PARENT_DIR = Path(__file__).parent.parent
+
+# Files up to this size are cached in memory; larger ones use sendfile
+CACHE_MAX_FILE_BYTES = int(os.environ.get('STATIC_CACHE_MAX_FILE_BYTES', str(1024 * 1024)))
+CACHE_MAX_TOTAL_BYTES = int(os.environ.get('STATIC_CACHE_MAX_TOTAL_BYTES', str(64 * 1024 * 1024)))
+
+# Only text-like types are worth compressing, and only above this size
+COMPRESS_MIN_BYTES = 1024
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+# ETag suffixes of the encoded variants
+CODING_TAGS = {'gzip': 'gz', 'br': 'br'}
+
+# Browsers revalidate with the ETag on every load, so edits show up at once
+CACHE_CONTROL = 'no-cache'
+
+
+def translate_path(path, root):
+    """Map a URL path to a file under root, refusing anything outside it"""
+    path = urllib.parse.unquote(path.split('?', 1)[0].split('#', 1)[0])
+    path = posixpath.normpath(path)
+    parts = [part for part in path.split('/') if part and part not in ('.', '..')]
+    return Path(root).joinpath(*parts)
+
+
+def resolve(url_path):
+    """File path for a request path: /Images/ from the parent directory, the rest from here"""
+    if url_path.startswith('/Images/'):
+        file_path = translate_path(url_path, PARENT_DIR)
+    else:
+        file_path = translate_path(url_path, STATIC_DIR)
+    if file_path.is_dir():
+        file_path = file_path / 'index.html'
+    return file_path
+
+
+def guess_type(path):
+    return mimetypes.guess_type(str(path))[0] or 'application/octet-stream'
+
+
+class Asset:
+    """One file as of a given mtime/size, with its cached encodings"""
+
+    def __init__(self, path, stat):
+        self.path = path
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.content_type = guess_type(path)
+        self.etag = f'"{self.mtime_ns:x}-{self.size:x}"'
+        # {encoding: bytes}; identity is only present for cached files
+        self.variants = {}
+
+    def etag_for(self, encoding):
+        """Strong ETag of one content coding; each coding needs its own"""
+        if encoding is None:
+            return self.etag
+        return f'"{self.mtime_ns:x}-{self.size:x}-{CODING_TAGS.get(encoding, encoding)}"'
+
+    @property
+    def cached(self):
+        return 'identity' in self.variants
+
+    def load(self):
+        data = self.path.read_bytes()
+        self.variants['identity'] = data
+        if len(data) >= COMPRESS_MIN_BYTES and self.content_type.startswith(COMPRESSIBLE_TYPES):
+            self.variants['gzip'] = self._precompressed('.gz') or gzip.compress(data, 9, mtime=0)
+            if brotli is not None:
+                self.variants['br'] = self._precompressed('.br') or brotli.compress(data)
+            elif self._precompressed('.br'):
+                self.variants['br'] = self._precompressed('.br')
+
+    def _precompressed(self, suffix):
+        """Use a build-time foo.js.gz / foo.js.br sibling if it is up to date"""
+        sibling = self.path.with_name(self.path.name + suffix)
+        try:
+            if sibling.stat().st_mtime_ns >= self.mtime_ns:
+                return sibling.read_bytes()
+        except OSError:
+            pass
+        return None
+
+    def cost(self):
+        return sum(len(data) for data in self.variants.values())
+
+
+class Response:
+    """What to send: status, headers, and either body bytes or a file range"""
+
+    def __init__(self, status, headers, body=b'', file_path=None, offset=0, length=0):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.file_path = file_path
+        self.offset = offset
+        self.length = length
+
+
+def _parse_range(header, size):
+    """Return (start, end) inclusive for a single "bytes=" range, None if absent/ignored
+
+    Raises ValueError for an unsatisfiable range.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length == 0:
+                raise ValueError("empty suffix range")
+            start = max(size - length, 0)
+            end = size - 1
+    except ValueError:
+        if first or last:
+            raise
+        return None
+    if start >= size or end < start:
+        raise ValueError("unsatisfiable range")
+    return start, min(end, size - 1)
+
+
+def _accepts(accept_encoding, coding):
+    """Whether an Accept-Encoding header allows coding (q=0 refuses it)"""
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        if name.strip().lower() != coding:
+            continue
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+class StaticCache:
+    """mtime-validated in-memory cache of static assets"""
+
+    def __init__(self, max_file_bytes=CACHE_MAX_FILE_BYTES, max_total_bytes=CACHE_MAX_TOTAL_BYTES):
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self.lock = threading.Lock()
+        self.assets = {}
+        self.total_bytes = 0
+        self.stats = {'hits': 0, 'loads': 0, 'not_modified': 0, 'sendfile': 0}
+
+    def get(self, file_path):
+        """Return the current Asset for a file, (re)loading it if it changed; None if missing"""
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        if not os.path.isfile(file_path):
+            return None
+        key = str(file_path)
+        with self.lock:
+            asset = self.assets.get(key)
+            if asset is not None and asset.mtime_ns == stat.st_mtime_ns and asset.size == stat.st_size:
+                self.stats['hits'] += 1
+                return asset
+
+        asset = Asset(Path(file_path), stat)
+        if asset.size <= self.max_file_bytes:
+            try:
+                asset.load()
+            except OSError as e:
+                logger.warning("Cannot read %s: %s", file_path, e)
+                return None
+        with self.lock:
+            old = self.assets.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old.cost()
+            if asset.cached and self.total_bytes + asset.cost() <= self.max_total_bytes:
+                self.assets[key] = asset
+                self.total_bytes += asset.cost()
+            elif not asset.cached:
+                # Remember the ETag of large files too; they are served with sendfile
+                self.assets[key] = asset
+            self.stats['loads'] += 1
+        return asset
+
+    def respond(self, file_path, headers, head_only=False):
+        """Build the Response for a GET/HEAD of file_path given request headers (lowercase keys)"""
+        asset = self.get(file_path)
+        if asset is None:
+            return Response(404, [('Content-Type', 'text/plain')], b'File not found')
+
+        # Ranges are only served from the identity representation
+        try:
+            byte_range = _parse_range(headers.get('range'), asset.size)
+            range_error = False
+        except ValueError:
+            byte_range, range_error = None, True
+        if byte_range is not None and headers.get('if-range') not in (None, asset.etag):
+            byte_range = None
+
+        encoding = None
+        if byte_range is None and not range_error and asset.cached:
+            accept = headers.get('accept-encoding', '')
+            for coding in ('br', 'gzip'):
+                if coding in asset.variants and _accepts(accept, coding):
+                    encoding = coding
+                    break
+
+        etag = asset.etag_for(encoding)
+        common = [('ETag', etag), ('Cache-Control', CACHE_CONTROL), ('Accept-Ranges', 'bytes')]
+        if asset.cached and len(asset.variants) > 1:
+            common.append(('Vary', 'Accept-Encoding'))
+        if_none_match = headers.get('if-none-match')
+        if if_none_match and (if_none_match.strip() == '*' or etag in
+                              [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]):
+            with self.lock:
+                self.stats['not_modified'] += 1
+            return Response(304, common)
+        if range_error:
+            return Response(416, common + [('Content-Range', f'bytes */{asset.size}'), ('Content-Length', '0')])
+
+        response_headers = common + [('Content-Type', asset.content_type)]
+
+        if byte_range is not None:
+            start, end = byte_range
+            length = end - start + 1
+            status = 206
+            response_headers.append(('Content-Range', f'bytes {start}-{end}/{asset.size}'))
+        else:
+            start, length, status = 0, asset.size, 200
+
+        if encoding is not None:
+            body = asset.variants[encoding]
+            response_headers.append(('Content-Encoding', encoding))
+            response_headers.append(('Content-Length', str(len(body))))
+            return Response(status, response_headers, b'' if head_only else body)
+
+        response_headers.append(('Content-Length', str(length)))
+        if head_only:
+            return Response(status, response_headers)
+        if asset.cached:
+            return Response(status, response_headers, asset.variants['identity'][start:start + length])
+        with self.lock:
+            self.stats['sendfile'] += 1
+        return Response(status, response_headers, file_path=asset.path, offset=start, length=length)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['cached_files'] = sum(1 for asset in self.assets.values() if asset.cached)
+            stats['cached_bytes'] = self.total_bytes
+            return stats
+
+
+# Shared cache for both server modes
+cache = StaticCache()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+MPEG-TS stream lifecycle: prewarming from SSE activity
+Keeps the FFmpeg ingest of the N most recently active cameras (as seen in
+the events the proxy already relays) running even without viewers, so a
+camera that algorithm.js rotates into an active slot is served from a warm
+GOP cache. Cameras falling out of the recent set are released and then
+linger for MPEGTS_LINGER_SECONDS like any other idle broadcaster.
+"""
+
+import os
+import logging
+import threading
+import collections
+
+import mpegts_stream
+import priorities
+import workers
+
+logger = logging.getLogger(__name__)
+
+# Number of recently active cameras to keep warm (0 disables prewarming)
+PREWARM_COUNT = int(os.environ.get('MPEGTS_PREWARM_COUNT', '0'))
+
+# Only events at or above this priority count as activity
+PREWARM_MIN_PRIORITY = os.environ.get('MPEGTS_PREWARM_MIN_PRIORITY', 'LOW').upper()
+
+
+class PrewarmManager:
+    """Holds broadcasters for the most recently active cameras"""
+
+    def __init__(self, username, password, count=PREWARM_COUNT, min_priority=PREWARM_MIN_PRIORITY):
+        self.username = username
+        self.password = password
+        self.count = count
+        self.min_level = priorities.PRIORITY_LEVELS.get(min_priority, 0)
+        self.lock = threading.Lock()
+        # Most recently active last: {cam_id: MpegtsBroadcaster}
+        self.recent = collections.OrderedDict()
+
+    def on_events(self, events):
+        """SSE hub listener"""
+        for event in events:
+            # With --workers, only the worker ingesting the camera prewarms it
+            if event.camera is None or not workers.owns(event.camera):
+                continue
+            if priorities.PRIORITY_LEVELS.get(event.priority, 0) < self.min_level:
+                continue
+            self.touch(event.camera)
+
+    def touch(self, cam_id):
+        """Mark a camera as active, prewarming it and evicting the least recent"""
+        released = []
+        with self.lock:
+            broadcaster = self.recent.get(cam_id)
+            if broadcaster is not None and not broadcaster.stopping:
+                self.recent.move_to_end(cam_id)
+                return
+            if broadcaster is not None:
+                # Its ingest died since it was prewarmed; start a new one
+                del self.recent[cam_id]
+            logger.debug("Camera %s: Prewarming MPEG-TS ingest", cam_id)
+            self.recent[cam_id] = mpegts_stream.prewarm(cam_id, self.username, self.password)
+            while len(self.recent) > self.count:
+                _, old = self.recent.popitem(last=False)
+                released.append(old)
+        for old in released:
+            old.release()
+
+    def get_stats(self):
+        with self.lock:
+            return {'prewarm_count': self.count, 'prewarmed_cameras': list(self.recent)}
+
+
+# Active manager once start() has been called
+manager = None
+
+
+def start(hub, username, password, count=PREWARM_COUNT):
+    """Prewarm cameras from hub activity; does nothing when count is 0"""
+    global manager
+    if count <= 0 or not password:
+        return None
+    manager = PrewarmManager(username, password, count)
+    hub.add_listener(manager.on_events)
+    hub.start()
+    logger.info("Prewarming the %d most recently active cameras", count)
+    return manager
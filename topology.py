@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Camera topology from priorities.json
+The camera list is the set of numbered entries in priorities.json; each may
+carry an "ip" and an expected "bitrate_kbps". A top-level "topology" section
+holds the listening ports, the default camera IP prefix and the per-port
+budgets. Cameras are sharded across ports by bitrate (measured from the
+ingest byte counters once streams have run, configured or default before
+that) so that no port exceeds the browser's per-host connection limit or
+its bandwidth budget. The result is served to the browser as /topology.json.
+"""
+
+import os
+import time
+import logging
+import threading
+
+import metrics
+import priorities
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORTS = [8000, 8001, 8002, 8003, 8004, 8005]
+DEFAULT_IP_PREFIX = os.environ.get('CAMERA_IP_PREFIX', '10.10.0')
+
+# Browsers allow 6 concurrent HTTP/1.1 connections per host:port
+DEFAULT_MAX_CAMERAS_PER_PORT = 6
+DEFAULT_PORT_BUDGET_KBPS = 40000
+DEFAULT_BITRATE_KBPS = 2000
+DEFAULT_MAIN_BITRATE_KBPS = 6000
+
+# Outbound budget for all viewers together (0 is unlimited)
+DEFAULT_EGRESS_BUDGET_KBPS = float(os.environ.get('EGRESS_BUDGET_KBPS', '0'))
+
+# Measured bitrates are averaged over at least this many seconds
+BITRATE_SAMPLE_SECONDS = 10.0
+BITRATE_SMOOTHING = 0.3
+
+
+class BitrateMeter:
+    """Per-camera ingest kbps derived from the metrics byte counters"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_time = None
+        self.last_bytes = {}
+        self.kbps = {}
+
+    def sample(self):
+        """Update the per-camera averages if enough time has passed; returns them"""
+        now = time.monotonic()
+        with self.lock:
+            if self.last_time is not None and now - self.last_time < BITRATE_SAMPLE_SECONDS:
+                return dict(self.kbps)
+            totals = {}
+            for name, labels, value in metrics.ingest_bytes.samples():
+                cam_id = int(dict(labels)['camera'])
+                totals[cam_id] = totals.get(cam_id, 0) + value
+            if self.last_time is not None:
+                elapsed = now - self.last_time
+                for cam_id, total in totals.items():
+                    delta = total - self.last_bytes.get(cam_id, 0)
+                    if delta <= 0:
+                        continue
+                    kbps = delta * 8 / 1000 / elapsed
+                    previous = self.kbps.get(cam_id)
+                    self.kbps[cam_id] = kbps if previous is None else \
+                        previous + BITRATE_SMOOTHING * (kbps - previous)
+            self.last_time = now
+            self.last_bytes = totals
+            return dict(self.kbps)
+
+
+class Topology:
+    """Camera addresses, listening ports and the camera -> port sharding"""
+
+    def __init__(self, priority_index=None):
+        self.priority_index = priority_index or priorities.index
+        self.meter = BitrateMeter()
+
+    def _settings(self):
+        config = self.priority_index.get_config()
+        settings = config.get('topology')
+        return config, settings if isinstance(settings, dict) else {}
+
+    def cameras(self):
+        """Configured camera ids in ascending order"""
+        config, _ = self._settings()
+        cam_ids = []
+        for cam in config:
+            try:
+                cam_ids.append(int(cam))
+            except ValueError:
+                continue
+        return sorted(cam_ids)
+
+    def ports(self):
+        _, settings = self._settings()
+        return [int(port) for port in settings.get('ports') or DEFAULT_PORTS]
+
+    def _camera_config(self, cam_id):
+        config, _ = self._settings()
+        cam_config = config.get(str(cam_id))
+        return cam_config if isinstance(cam_config, dict) else {}
+
+    def camera_ip(self, cam_id):
+        """The camera's "ip", else the configured prefix plus its id"""
+        ip = self._camera_config(cam_id).get('ip')
+        if ip:
+            return ip
+        _, settings = self._settings()
+        prefix = str(settings.get('camera_ip_prefix') or DEFAULT_IP_PREFIX).rstrip('.')
+        return f"{prefix}.{cam_id}"
+
+    def expected_kbps(self, cam_id, measured=None, tier=None):
+        """Bitrate used for sharding: measured, configured or the default
+
+        tier='main' gives the configured bitrate of the camera's main stream
+        ("main_bitrate_kbps") instead of the sub stream it normally runs.
+        """
+        if measured and cam_id in measured:
+            return measured[cam_id]
+        _, settings = self._settings()
+        if tier == 'main':
+            bitrate = self._camera_config(cam_id).get('main_bitrate_kbps')
+            if bitrate is None:
+                bitrate = settings.get('default_main_bitrate_kbps', DEFAULT_MAIN_BITRATE_KBPS)
+            return float(bitrate)
+        bitrate = self._camera_config(cam_id).get('bitrate_kbps')
+        if bitrate is None:
+            bitrate = settings.get('default_bitrate_kbps', DEFAULT_BITRATE_KBPS)
+        return float(bitrate)
+
+    def quality_budget_kbps(self):
+        """Server-wide camera ingest budget for the quality policy (0 is unlimited)"""
+        _, settings = self._settings()
+        return float(settings.get('quality_budget_kbps', 0))
+
+    def egress_budget_kbps(self):
+        """Server-wide budget for bytes sent to viewers (0 is unlimited)"""
+        _, settings = self._settings()
+        return float(settings.get('egress_budget_kbps', DEFAULT_EGRESS_BUDGET_KBPS))
+
+    def shard(self):
+        """Assign cameras to ports; returns {port: [cam_id, ...]}
+
+        Longest-processing-time greedy packing: heaviest camera first, each
+        onto the least loaded port that still has a connection slot. The
+        first port (which serves the page) keeps one slot for the SSE
+        connection. If every port is full or over budget the least loaded one
+        is used anyway and a warning is logged.
+        """
+        _, settings = self._settings()
+        ports = self.ports()
+        max_cameras = int(settings.get('max_cameras_per_port', DEFAULT_MAX_CAMERAS_PER_PORT))
+        budget = float(settings.get('port_budget_kbps', DEFAULT_PORT_BUDGET_KBPS))
+        measured = self.meter.sample()
+
+        load = {port: 0.0 for port in ports}
+        assignment = {port: [] for port in ports}
+        capacity = {port: max_cameras for port in ports}
+        capacity[ports[0]] -= 1
+        weights = {cam_id: self.expected_kbps(cam_id, measured) for cam_id in self.cameras()}
+        for cam_id in sorted(weights, key=lambda cam: (-weights[cam], cam)):
+            weight = weights[cam_id]
+            fits = [port for port in ports
+                    if len(assignment[port]) < capacity[port] and load[port] + weight <= budget]
+            if not fits:
+                logger.warning("Camera %s: every port is at its connection or bandwidth budget", cam_id)
+                fits = ports
+            port = min(fits, key=lambda p: (load[p], len(assignment[p]), p))
+            assignment[port].append(cam_id)
+            load[port] += weight
+
+        for cams in assignment.values():
+            cams.sort()
+        return assignment
+
+    def worker_shard(self, count):
+        """Assign cameras to worker processes; returns {worker: [cam_id, ...]}
+
+        The same greedy packing as shard(), but from configured bitrates
+        only: every process must arrive at the same owner for a camera.
+        """
+        load = [0.0] * count
+        assignment = {worker: [] for worker in range(count)}
+        weights = {cam_id: self.expected_kbps(cam_id) for cam_id in self.cameras()}
+        for cam_id in sorted(weights, key=lambda cam: (-weights[cam], cam)):
+            worker = min(range(count), key=lambda w: (load[w], len(assignment[w]), w))
+            assignment[worker].append(cam_id)
+            load[worker] += weights[cam_id]
+        for cams in assignment.values():
+            cams.sort()
+        return assignment
+
+    def port_for(self, cam_id):
+        for port, cams in self.shard().items():
+            if cam_id in cams:
+                return port
+        return self.ports()[0]
+
+    def to_json(self, multiplexed=False):
+        """Topology served to the browser as /topology.json
+
+        multiplexed tells a client that loaded it over HTTP/2 to fetch every
+        camera from its own origin instead of the per-port shards.
+        """
+        shards = self.shard()
+        return {
+            'cameras': self.cameras(),
+            'ports': self.ports(),
+            'camera_ports': {str(cam_id): port for port, cams in shards.items() for cam_id in cams},
+            'multiplexed': multiplexed,
+            'previews': bool(self._settings()[1].get('previews', True)),
+        }
+
+
+# Shared topology backed by priorities.json
+topology = Topology()
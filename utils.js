@@ -35,7 +35,13 @@ const cameraFailureStatus=new Map(); // tracks if camera has failed many times
 const cameraStreamType=new Map(); // 'mpegts' or 'mjpeg' for each camera
 const cameraRetryState=new Map(); // {attempts: 0, lastAttempt: timestamp, currentDelay: 1000}
 
-const workingCameras = Array.from({length:26}, (_, i) => i + 1);
+// Camera list and camera -> port map, replaced by /topology.json in loadTopology()
+let workingCameras = Array.from({length:26}, (_, i) => i + 1);
+let cameraPorts = new Map();
+// True when the page came over HTTP/2: all streams share its one connection
+let multiplexed = false;
+// Recent-grid tiles show low-rate server previews instead of live video
+let previewsEnabled = false;
 const MAX_RETRY_DELAY = 64000; // Cap at 64 seconds
 const INITIAL_RETRY_DELAY = 1000; // Start at 1 second
 
@@ -46,15 +52,63 @@ const INITIAL_RETRY_DELAY = 1000; // Start at 1 second
 // Exponential backoff retry: 1s, 2s, 4s, 8s, 16s, 32s, 64s (cap)
 // ============================================================================
 
+// Each camera's MJPEG stream goes to the port the server assigned it, which
+// keeps every port under the browser's per-host connection limit
+function getCameraPort(cam) {
+    return cameraPorts.get(cam) || window.location.port || 8000;
+}
+
 function getMJPEGSource(cam) {
-        let port = 8001;
-        if([13, 11, 12, 9].includes(cam)) port = 8000;
-        else if([10, 8, 7, 4].includes(cam)) port = 8001;
-        else if([2, 3, 1, 5].includes(cam)) port = 8002;
-        else if([6, 14, 15, 16].includes(cam)) port = 8003;
-        else if([17, 18, 19, 20].includes(cam)) port = 8004;
-        else if([21, 22, 23, 24, 25, 26].includes(cam)) port = 8005;
-    return `http://127.0.0.1:${port}/video${cam}`;
+    if(multiplexed) return `${window.location.origin}/video${cam}`;
+    return `http://127.0.0.1:${getCameraPort(cam)}/video${cam}`;
+}
+
+function getMPEGTSSource(cam) {
+    if(multiplexed) return `${window.location.origin}/mpegts/${cam}`;
+    return `${window.location.protocol}//${window.location.hostname}:${getCameraPort(cam)}/mpegts/${cam}`;
+}
+
+async function loadTopology(){
+    try{
+        const response=await fetch('/topology.json');
+        if(!response.ok){
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        const config=await response.json();
+        if(Array.isArray(config.cameras)&&config.cameras.length){
+            workingCameras=config.cameras.map(cam=>parseInt(cam));
+        }
+        const ports=new Map();
+        for(const [cam,port] of Object.entries(config.camera_ports||{})){
+            ports.set(parseInt(cam),parseInt(port));
+        }
+        cameraPorts=ports;
+        multiplexed=config.multiplexed===true;
+        previewsEnabled=config.previews===true;
+    }catch(e){
+        // Keep the defaults
+    }
+}
+
+// Identifies this display in layout reports to the server's quality policy
+const displayId = Math.random().toString(36).slice(2);
+const LAYOUT_REPORT_INTERVAL = 30000; // Server forgets a display after 60s
+let lastLayoutReport = '';
+let lastLayoutReportTime = 0;
+
+// Tell the server which cameras are in active slots (main stream) and which
+// are in the recent grid (sub stream); unchanged layouts are only refreshed.
+// Not needed when the layout comes from the server, which reports it itself.
+function reportLayout(activeCams, recentCams){
+    if(typeof serverLayout!=='undefined' && serverLayout)return;
+    const query=`client=${displayId}&active=${activeCams.join(',')}&recent=${recentCams.join(',')}`;
+    const now=Date.now();
+    if(query===lastLayoutReport && now-lastLayoutReportTime<LAYOUT_REPORT_INTERVAL){
+        return;
+    }
+    lastLayoutReport=query;
+    lastLayoutReportTime=now;
+    fetch(`/quality?${query}`).catch(()=>{});
 }
 
 function setLiveFeedSources(){
@@ -67,7 +121,7 @@ function setLiveFeedSources(){
         // Set source based on current stream type
         const streamType = cameraStreamType.get(cam);
         if(streamType === 'mpegts'){
-            cameraSources.set(cam, `${window.location.origin}/mpegts/${cam}`);
+            cameraSources.set(cam, getMPEGTSSource(cam));
         } else {
             cameraSources.set(cam, getMJPEGSource(cam));
         }
@@ -103,7 +157,41 @@ function fallbackToMJPEG(camNum){
     cameraRetryState.delete(camNum);
 }
 
+// Camera health from the proxy's prober (/status). A camera it reports down
+// is retried once it recovers instead of on a blind per-client backoff.
+const STATUS_POLL_INTERVAL = 15000;
+const cameraHealth = new Map();
+const pendingRetries = new Map();
+
+async function pollCameraStatus(){
+    try{
+        const response=await fetch('/status');
+        if(response.ok){
+            const status=await response.json();
+            for(const [cam,health] of Object.entries(status.cameras||{})){
+                const camNum=parseInt(cam);
+                cameraHealth.set(camNum,health.state);
+                if(health.state!=='down' && pendingRetries.has(camNum)){
+                    const callback=pendingRetries.get(camNum);
+                    pendingRetries.delete(camNum);
+                    console.log(`Camera ${camNum}: Proxy reports it ${health.state}, retrying`);
+                    callback();
+                }
+            }
+        }
+    }catch(e){
+        // Retries fall back to the backoff below
+    }
+    setTimeout(pollCameraStatus, STATUS_POLL_INTERVAL);
+}
+
 function scheduleRetry(camNum, callback){
+    if(cameraHealth.get(camNum)==='down'){
+        console.log(`Camera ${camNum}: Down according to the proxy, waiting for it to recover`);
+        pendingRetries.set(camNum, callback);
+        return;
+    }
+    
     // Get or initialize retry state
     let state = cameraRetryState.get(camNum);
     if(!state){
@@ -133,6 +221,7 @@ function scheduleRetry(camNum, callback){
 function resetRetryState(camNum){
     // Reset retry state on successful connection
     cameraRetryState.delete(camNum);
+    pendingRetries.delete(camNum);
     cameraRetryCounts.delete(camNum);
     cameraFailureStatus.delete(camNum);
 }
@@ -252,6 +341,50 @@ function preloadCamera(camNum,useCacheBust=false){
     return promise;
 }
 
+// On the camera's shard port like the live streams, so the previews of a
+// full grid do not exhaust the page origin's 6 HTTP/1.1 connections
+function getPreviewSource(cam) {
+    if(multiplexed) return `${window.location.origin}/preview/${cam}?stream=1`;
+    return `${window.location.protocol}//${window.location.hostname}:${getCameraPort(cam)}/preview/${cam}?stream=1`;
+}
+
+// Show a camera's low-rate preview stream in a recent-grid tile, falling
+// back to the live stream if the proxy cannot produce previews for it
+function setPreviewSource(element,camNum){
+    if(element.tagName.toLowerCase()!=='img'){
+        if(element.mpegtsPlayer){
+            element.mpegtsPlayer.destroy();
+            element.mpegtsPlayer = null;
+        }
+        const img=document.createElement('img');
+        Array.from(element.attributes).forEach(attr=>{
+            if(attr.name!=='src'){
+                img.setAttribute(attr.name,attr.value);
+            }
+        });
+        img.style.cssText=element.style.cssText;
+        if(element.parentNode){
+            element.parentNode.replaceChild(img,element);
+        }
+        element=img;
+    }
+    element.dataset.camera=camNum;
+    const targetSrc=getPreviewSource(camNum);
+    if(element.src===targetSrc)return element;
+    element.onload=()=>hideCameraError(camNum);
+    element.onerror=(e)=>{
+        if(e) e.preventDefault();
+        element.onerror=null;
+        element.removeAttribute('src');
+        if(element.parentNode&&element.dataset.camera==camNum.toString()){
+            setImageSource(element,camNum);
+        }
+        return true;
+    };
+    element.src=targetSrc;
+    return element;
+}
+
 function setImageSource(element,camNum){
     if(!element.dataset.camera){
         element.dataset.camera=camNum;
@@ -326,7 +459,7 @@ function setImageSource(element,camNum){
                 scheduleRetry(camNum, () => {
                     console.log(`Camera ${camNum}: Retrying MPEG-TS...`);
                     cameraStreamType.set(camNum, 'mpegts');
-                    cameraSources.set(camNum, `${window.location.origin}/mpegts/${camNum}`);
+                    cameraSources.set(camNum, getMPEGTSSource(camNum));
                     cameraFailureStatus.delete(camNum);
                     
                     const retryElement = document.querySelector(`[data-camera="${camNum}"]`);
@@ -363,7 +496,7 @@ function setImageSource(element,camNum){
             scheduleRetry(camNum, () => {
                 console.log(`Camera ${camNum}: Retrying MPEG-TS...`);
                 cameraStreamType.set(camNum, 'mpegts');
-                cameraSources.set(camNum, `${window.location.origin}/mpegts/${camNum}`);
+                cameraSources.set(camNum, getMPEGTSSource(camNum));
                 cameraFailureStatus.delete(camNum);
                 
                 const retryElement = document.querySelector(`[data-camera="${camNum}"]`);
@@ -444,7 +577,7 @@ function setImageSource(element,camNum){
                     console.log(`Camera ${camNum}: Retrying MPEG-TS...`);
                     // Reset to try MPEG-TS again
                     cameraStreamType.set(camNum, 'mpegts');
-                    cameraSources.set(camNum, `${window.location.origin}/mpegts/${camNum}`);
+                    cameraSources.set(camNum, getMPEGTSSource(camNum));
                     cameraFailureStatus.delete(camNum);
                     
                     // Find the element and reload
@@ -576,7 +709,7 @@ function setImageSource(element,camNum){
                 console.log(`Camera ${camNum}: Retrying MPEG-TS...`);
                 // Reset to try MPEG-TS again
                 cameraStreamType.set(camNum, 'mpegts');
-                cameraSources.set(camNum, `${window.location.origin}/mpegts/${camNum}`);
+                cameraSources.set(camNum, getMPEGTSSource(camNum));
                 cameraFailureStatus.delete(camNum);
                 
                 // Find the element and reload
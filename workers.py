@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Multi-process mode: SO_REUSEPORT workers with camera affinity
+main.py --workers N runs N copies of the proxy. Every worker listens on all
+ports with SO_REUSEPORT, so the kernel spreads connections across the
+processes (and cores). Each worker owns a shard of the cameras
+(Topology.worker_shard) and is the only one ingesting them. A request for
+another worker's camera is handed to its owner with the connection itself:
+the socket is passed over a Unix socket (SCM_RIGHTS) together with the
+request head already read, and the owner answers it as if it had accepted
+the connection. The server-side layout and the preview mosaic live in
+worker 0. Workers publish small state snapshots (health results) as files
+in the shared handoff directory, so any of them can answer for all cameras.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+import http.client
+import urllib.parse
+
+from topology import topology
+
+logger = logging.getLogger(__name__)
+
+# Worker count and this process's index; 1 and 0 in single-process mode
+count = 1
+index = 0
+handoff_dir = None
+
+# Passing sockets needs SO_REUSEPORT and SCM_RIGHTS (socket.send_fds)
+SUPPORTED = hasattr(socket, 'SO_REUSEPORT') and hasattr(socket, 'send_fds')
+
+# Paths served by worker 0, which holds the one instance of their state
+PRIMARY_PATHS = ('/layout.json', '/layout_stats', '/preview/mosaic')
+
+# A worker that exits sooner than this after starting is restarted only after it
+RESTART_DELAY = 2.0
+
+stats = {'handed_off': 0, 'adopted': 0, 'handoff_errors': 0}
+
+
+def configure(worker_index, worker_count, directory):
+    global index, count, handoff_dir
+    index = worker_index
+    count = worker_count
+    handoff_dir = directory
+
+
+def enabled():
+    return count > 1
+
+
+def owner(cam_id):
+    """Index of the worker ingesting cam_id"""
+    if count <= 1:
+        return index
+    for worker, cams in topology.worker_shard(count).items():
+        if cam_id in cams:
+            return worker
+    return 0
+
+
+def owns(cam_id):
+    return count <= 1 or owner(cam_id) == index
+
+
+def _camera_in_path(path):
+    """Camera addressed by a stream or preview path, or None"""
+    url_path = urllib.parse.urlsplit(path).path
+    try:
+        if url_path.startswith('/mpegts/'):
+            return int(url_path.split('/')[-1])
+        if url_path.startswith('/video'):
+            return int(url_path[len('/video'):].strip('/'))
+        if url_path.startswith('/preview/') and url_path != '/preview/mosaic':
+            return int(url_path[len('/preview/'):])
+    except ValueError:
+        pass
+    return None
+
+
+def route(path):
+    """Worker that has to serve path, or None when any worker can"""
+    if count <= 1:
+        return None
+    cam_id = _camera_in_path(path)
+    if cam_id is not None:
+        return owner(cam_id)
+    url = urllib.parse.urlsplit(path)
+    if url.path in PRIMARY_PATHS:
+        return 0
+    if url.path.startswith('/api/v1/subscribe') and \
+            urllib.parse.parse_qs(url.query).get('layout', ['0'])[0] == '1':
+        return 0
+    return None
+
+
+def _socket_path(worker):
+    return os.path.join(handoff_dir, f'worker-{worker}.sock')
+
+
+def hand_off(sock, worker, port, head):
+    """Pass an accepted connection and the bytes already read from it to worker
+
+    head is the request head followed by anything the client sent after it
+    that was read along with it (a pipelined request).
+
+    Raises OSError if the worker cannot be reached. Afterwards the caller
+    closes its socket without shutting it down; the connection lives on in
+    the other process.
+    """
+    header = json.dumps({'port': port, 'from': index}).encode() + b'\n'
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as channel:
+        channel.connect(_socket_path(worker))
+        socket.send_fds(channel, [header + head], [sock.fileno()])
+    stats['handed_off'] += 1
+
+
+def serve_handoffs(adopt):
+    """Accept connections handed over by other workers; adopt(sock, port, head) serves each"""
+    path = _socket_path(index)
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(128)
+
+    def run():
+        while True:
+            channel, _ = listener.accept()
+            fds = []
+            try:
+                with channel:
+                    data, fds, _, _ = socket.recv_fds(channel, 65536, 1)
+                    while True:
+                        more = channel.recv(65536)
+                        if not more:
+                            break
+                        data += more
+                if not fds:
+                    continue
+                header, _, head = data.partition(b'\n')
+                port = json.loads(header)['port']
+                sock = socket.socket(fileno=fds.pop(0))
+                stats['adopted'] += 1
+                adopt(sock, port, head)
+            except Exception:
+                stats['handoff_errors'] += 1
+                logger.exception("Failed to adopt a handed-off connection")
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+    threading.Thread(target=run, name='handoff', daemon=True).start()
+
+
+class _PrefixedReader(io.RawIOBase):
+    """Raw reader returning prefix before reading from the socket"""
+
+    def __init__(self, prefix, sock):
+        self.prefix = prefix
+        self.sock = sock
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.prefix:
+            size = min(len(buffer), len(self.prefix))
+            buffer[:size] = self.prefix[:size]
+            self.prefix = self.prefix[size:]
+            return size
+        try:
+            return self.sock.recv_into(buffer)
+        except BlockingIOError:
+            return None
+
+
+class AdoptedSocket:
+    """A handed-off socket whose reads start with the request head already read
+
+    Serves as the connection of a socketserver request handler. adopted
+    stays true until its first request has been routed, which is answered
+    here whatever route() says, so a connection never bounces between workers.
+    """
+
+    def __init__(self, sock, head):
+        self.sock = sock
+        self.head = head
+        self.adopted = True
+
+    def makefile(self, mode='r', buffering=None, **kwargs):
+        if 'r' in mode and self.head:
+            reader = io.BufferedReader(_PrefixedReader(self.head, self.sock),
+                                       buffering if buffering and buffering > 0 else io.DEFAULT_BUFFER_SIZE)
+            self.head = b''
+            return reader
+        return self.sock.makefile(mode, buffering, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def publish_state(name, data):
+    """Share a JSON snapshot with the other workers"""
+    if count <= 1:
+        return
+    path = os.path.join(handoff_dir, f'{name}-{index}.json')
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        logger.warning("Cannot publish %s state: %s", name, e)
+
+
+def collect_state(name):
+    """Snapshots the other workers published under name"""
+    snapshots = []
+    for worker in range(count):
+        if worker == index:
+            continue
+        try:
+            with open(os.path.join(handoff_dir, f'{name}-{worker}.json')) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            pass
+    return snapshots
+
+
+def fetch(path, timeout=10):
+    """GET path from whichever worker serves it, over loopback; body or None"""
+    conn = http.client.HTTPConnection('127.0.0.1', topology.ports()[0], timeout=timeout)
+    try:
+        conn.request('GET', path)
+        response = conn.getresponse()
+        body = response.read()
+        return body if response.status == 200 else None
+    except (OSError, http.client.HTTPException) as e:
+        logger.debug("Loopback fetch of %s failed: %s", path, e)
+        return None
+    finally:
+        conn.close()
+
+
+def get_stats():
+    return dict(stats, workers=count, worker=index,
+                cameras=topology.worker_shard(count)[index] if count > 1 else topology.cameras())
+
+
+def run_supervisor(worker_count, script, argv, env):
+    """Run worker_count copies of script until interrupted, restarting any that exit"""
+    directory = tempfile.mkdtemp(prefix='camera-proxy-')
+    started = {}
+
+    def spawn(worker):
+        started[worker] = time.monotonic()
+        command = [sys.executable, script] + argv + ['--worker-index', str(worker), '--handoff-dir', directory]
+        return subprocess.Popen(command, env=env)
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    processes = {worker: spawn(worker) for worker in range(worker_count)}
+    try:
+        while not stopping.wait(1):
+            for worker, process in list(processes.items()):
+                if process.poll() is None or time.monotonic() - started[worker] < RESTART_DELAY:
+                    continue
+                logger.warning("Worker %s exited with status %s, restarting", worker, process.returncode)
+                processes[worker] = spawn(worker)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(directory, ignore_errors=True)